@@ -0,0 +1,548 @@
+"""
+Module with pluggable nearest-neighbour indexes over the chunk embeddings.
+
+LocalChunkStorage scores queries through one of these backends:
+- "exact": brute-force matrix-vector product over all rows (default)
+- "ivf":   inverted file index with spherical k-means centroids, pure NumPy
+- "hnsw":  HNSW graph, requires the optional hnswlib package
+- "int8":  int8 scalar-quantized codes (4x smaller), shortlist rescored in float
+- "binary": sign-bit codes (32x smaller) scanned by Hamming distance, shortlist
+           rescored in float
+
+The quantized backends keep only their codes in memory; the float embeddings
+stay memory-mapped and only the shortlisted rows are read from them.
+
+Indexes are built at ingestion time and persisted next to index.json. Run this
+module directly to build an index or to measure recall@k and latency of
+different settings against exact search.
+"""
+import os
+import time
+import json
+import logging
+import numpy as np
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+IVF_INDEX_FILE = "ann_ivf.npz"
+HNSW_INDEX_FILE = "ann_hnsw.bin"
+INT8_INDEX_FILE = "ann_int8.npz"
+BINARY_INDEX_FILE = "ann_binary.npy"
+
+# Memory bound of the score matrix of one block of a batched exact search
+EXACT_BATCH_BYTES = 256 * 1024 * 1024
+
+# Rows quantized or scanned per step by the int8 and binary indexes
+QUANTIZE_BLOCK = 16384
+
+
+def top_k(scores: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Select the k highest scores without sorting the whole array.
+
+    Results are ordered by descending score, with ties broken by row number so
+    the order matches a stable descending sort over all rows.
+
+    Args:
+        scores: Score of each candidate
+        k: Number of results to return
+        rows: Row number of each candidate (defaults to its position)
+
+    Returns:
+        Tuple of (rows, scores) of the top k candidates
+    """
+    if rows is None:
+        rows = np.arange(len(scores))
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.lexsort((rows[top], -scores[top]))]
+    return rows[top], scores[top]
+
+
+class VectorIndex:
+    """
+    Base class of the nearest-neighbour backends. Embeddings are expected to be
+    L2-normalized, so inner product equals cosine similarity.
+    """
+    backend = ""
+
+    def __init__(self, **params: Any):
+        self.params = params
+        self.embeddings: Optional[np.ndarray] = None
+
+    def build(self, embeddings: np.ndarray) -> None:
+        """Build the index over an (N, dim) embeddings matrix."""
+        self.embeddings = embeddings
+
+    def attach(self, embeddings: np.ndarray) -> None:
+        """Attach the embeddings matrix to an index loaded from disk."""
+        self.embeddings = embeddings
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows most similar to a normalized query vector.
+
+        Returns:
+            Tuple of (rows, scores), best match first
+        """
+        raise NotImplementedError
+
+    def search_batch(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Find the most similar rows for each row of a (Q, dim) matrix of
+        normalized queries.
+
+        Returns:
+            One (rows, scores) tuple per query, best match first
+        """
+        return [self.search(query, k) for query in queries]
+
+    def set_search_params(self, **params: Any) -> None:
+        """Adjust query-time knobs (for example nprobe or ef_search)."""
+        for name, value in params.items():
+            if name not in self.params:
+                raise ValueError(f"Unknown search parameter for {self.backend} index: {name}")
+            self.params[name] = value
+
+    def nbytes(self) -> int:
+        """Memory held by the index itself, not counting the attached float embeddings."""
+        return 0
+
+    def save(self, storage_dir: str) -> None:
+        """Persist the index next to index.json."""
+
+    def load(self, storage_dir: str) -> None:
+        """Load a persisted index."""
+
+
+class ExactIndex(VectorIndex):
+    """Brute-force search: one matrix-vector product over every row."""
+    backend = "exact"
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return top_k(self.embeddings @ query, k)
+
+    def search_batch(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # One matrix-matrix product per block of queries, so the (block, N)
+        # score matrix stays within EXACT_BATCH_BYTES
+        block = max(1, EXACT_BATCH_BYTES // (4 * max(1, len(self.embeddings))))
+        results = []
+        for start in range(0, len(queries), block):
+            scores = queries[start:start + block] @ self.embeddings.T
+            results.extend(top_k(row, k) for row in scores)
+        return results
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted file index. Rows are clustered around nlist k-means centroids; a
+    query only scores the rows of its nprobe closest clusters. Higher nprobe
+    raises recall at the cost of latency.
+    """
+    backend = "ivf"
+
+    def __init__(self, nlist: int = 64, nprobe: int = 8, train_iterations: int = 20, seed: int = 0):
+        super().__init__(nlist=nlist, nprobe=nprobe, train_iterations=train_iterations, seed=seed)
+        self.centroids: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+        self.list_rows: Optional[np.ndarray] = None
+
+    def _assign(self, vectors: np.ndarray, block: int = 65536) -> np.ndarray:
+        """Assign each vector to its closest centroid, in blocks to bound memory."""
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block):
+            labels[start:start + block] = np.argmax(
+                np.asarray(vectors[start:start + block]) @ self.centroids.T, axis=1
+            )
+        return labels
+
+    def build(self, embeddings: np.ndarray) -> None:
+        super().build(embeddings)
+        rng = np.random.default_rng(self.params["seed"])
+        nlist = max(1, min(self.params["nlist"], len(embeddings)))
+
+        # Spherical k-means on a sample of the rows
+        sample_size = min(len(embeddings), nlist * 256)
+        sample = np.asarray(embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))])
+        self.centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.params["train_iterations"]):
+            labels = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            # Re-seed empty clusters with random sample points
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self.centroids = (sums / norms).astype(np.float32)
+
+        # Inverted lists: row ids grouped by cluster
+        labels = self._assign(embeddings)
+        order = np.argsort(labels, kind="stable")
+        self.list_rows = order.astype(np.int64)
+        self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=self.list_offsets[1:])
+        logger.info(f"Built IVF index with {nlist} lists over {len(embeddings)} rows")
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = max(1, min(self.params["nprobe"], len(self.centroids)))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([
+            self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probe
+        ])
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        rows.sort()  # Sorted rows keep memory-mapped reads sequential
+        return top_k(self.embeddings[rows] @ query, k, rows)
+
+    def nbytes(self) -> int:
+        return self.centroids.nbytes + self.list_offsets.nbytes + self.list_rows.nbytes
+
+    def save(self, storage_dir: str) -> None:
+        np.savez(
+            os.path.join(storage_dir, IVF_INDEX_FILE),
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_rows=self.list_rows
+        )
+
+    def load(self, storage_dir: str) -> None:
+        with np.load(os.path.join(storage_dir, IVF_INDEX_FILE)) as data:
+            self.centroids = data["centroids"]
+            self.list_offsets = data["list_offsets"]
+            self.list_rows = data["list_rows"]
+
+
+class HNSWIndex(VectorIndex):
+    """
+    Hierarchical navigable small world graph from the optional hnswlib
+    package. ef_search trades latency for recall at query time.
+    """
+    backend = "hnsw"
+
+    def __init__(self, M: int = 16, ef_construction: int = 200, ef_search: int = 64):
+        super().__init__(M=M, ef_construction=ef_construction, ef_search=ef_search)
+        self._graph: Any = None
+        self._path: Optional[str] = None
+
+    @staticmethod
+    def _hnswlib() -> Any:
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("The hnsw index backend requires hnswlib: pip install hnswlib")
+        return hnswlib
+
+    def build(self, embeddings: np.ndarray) -> None:
+        super().build(embeddings)
+        hnswlib = self._hnswlib()
+        self._graph = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+        self._graph.init_index(
+            max_elements=len(embeddings),
+            ef_construction=self.params["ef_construction"],
+            M=self.params["M"]
+        )
+        self._graph.add_items(np.asarray(embeddings), np.arange(len(embeddings)))
+        logger.info(f"Built HNSW index over {len(embeddings)} rows")
+
+    def attach(self, embeddings: np.ndarray) -> None:
+        super().attach(embeddings)
+        if self._graph is None:
+            hnswlib = self._hnswlib()
+            self._graph = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+            self._graph.load_index(self._path, max_elements=len(embeddings))
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, self._graph.get_current_count())
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        self._graph.set_ef(max(self.params["ef_search"], k))
+        labels, distances = self._graph.knn_query(query.reshape(1, -1), k=k)
+        # hnswlib's "ip" distance is 1 - inner product
+        return labels[0].astype(np.int64), (1.0 - distances[0]).astype(np.float32)
+
+    def search_batch(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        k = min(k, self._graph.get_current_count())
+        if k <= 0 or len(queries) == 0:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+        self._graph.set_ef(max(self.params["ef_search"], k))
+        labels, distances = self._graph.knn_query(np.asarray(queries), k=k)
+        return [(row_labels.astype(np.int64), (1.0 - row_distances).astype(np.float32)) for row_labels, row_distances in zip(labels, distances)]
+
+    def save(self, storage_dir: str) -> None:
+        self._graph.save_index(os.path.join(storage_dir, HNSW_INDEX_FILE))
+
+    def load(self, storage_dir: str) -> None:
+        # The graph is opened in attach(), once the row count is known
+        self._path = os.path.join(storage_dir, HNSW_INDEX_FILE)
+
+
+def _rescore(embeddings: np.ndarray, query: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact float scores of a shortlist of rows, best k first."""
+    candidates = np.sort(candidates)  # Sorted rows keep memory-mapped reads sequential
+    return top_k(np.asarray(embeddings[candidates]) @ query, k, candidates)
+
+
+def _shortlist(scores: np.ndarray, size: int) -> np.ndarray:
+    """Rows of the size highest approximate scores, in no particular order."""
+    if size >= len(scores):
+        return np.arange(len(scores))
+    return np.argpartition(-scores, size - 1)[:size]
+
+
+class Int8Index(VectorIndex):
+    """
+    Scalar quantization: each dimension is scaled to [-127, 127] and stored as
+    int8. Queries are scored against the codes, and the best k * rescore rows
+    are rescored with the float embeddings (rescore=0 returns the approximate
+    scores as they are).
+    """
+    backend = "int8"
+
+    def __init__(self, rescore: int = 4):
+        super().__init__(rescore=rescore)
+        self.codes: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+
+    def build(self, embeddings: np.ndarray) -> None:
+        super().build(embeddings)
+        dim = embeddings.shape[1]
+        self.scales = np.ones(dim, dtype=np.float32)
+        max_abs = np.zeros(dim, dtype=np.float32)
+        for start in range(0, len(embeddings), QUANTIZE_BLOCK):
+            np.maximum(max_abs, np.abs(embeddings[start:start + QUANTIZE_BLOCK]).max(axis=0), out=max_abs)
+        self.scales[max_abs > 0] = max_abs[max_abs > 0] / 127.0
+        self.codes = np.empty(embeddings.shape, dtype=np.int8)
+        for start in range(0, len(embeddings), QUANTIZE_BLOCK):
+            block = np.asarray(embeddings[start:start + QUANTIZE_BLOCK]) / self.scales
+            self.codes[start:start + QUANTIZE_BLOCK] = np.clip(np.rint(block), -127, 127)
+        logger.info(f"Built int8 index over {len(embeddings)} rows ({self.codes.nbytes / 2**20:.1f} MB of codes)")
+
+    def _approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        # einsum casts the codes in small buffers instead of materializing a
+        # float copy of the whole matrix
+        return np.einsum("ij,j->i", self.codes, (query * self.scales).astype(np.float32))
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self._approximate_scores(query)
+        if not self.params["rescore"]:
+            return top_k(scores, k)
+        return _rescore(self.embeddings, query, _shortlist(scores, k * self.params["rescore"]), k)
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    def save(self, storage_dir: str) -> None:
+        np.savez(os.path.join(storage_dir, INT8_INDEX_FILE), codes=self.codes, scales=self.scales)
+
+    def load(self, storage_dir: str) -> None:
+        with np.load(os.path.join(storage_dir, INT8_INDEX_FILE)) as data:
+            self.codes = data["codes"]
+            self.scales = data["scales"]
+
+
+# Number of set bits of every byte value, for NumPy without bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount_rows(bits: np.ndarray) -> np.ndarray:
+    """Number of set bits in each row of a uint8 matrix."""
+    if hasattr(np, "bitwise_count"):
+        if bits.shape[1] % 8 == 0:
+            # Eight bytes at a time
+            bits = np.ascontiguousarray(bits).view(np.uint64)
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT[bits].sum(axis=1, dtype=np.int32)
+
+
+class BinaryIndex(VectorIndex):
+    """
+    Binary quantization: one sign bit per dimension (48 bytes for MiniLM's 384
+    dimensions). The first pass ranks rows by Hamming distance to the query's
+    sign bits; the k * rescore closest rows are rescored with the float
+    embeddings.
+    """
+    backend = "binary"
+
+    def __init__(self, rescore: int = 10):
+        super().__init__(rescore=rescore)
+        self.codes: Optional[np.ndarray] = None
+
+    def build(self, embeddings: np.ndarray) -> None:
+        super().build(embeddings)
+        self.codes = np.empty((len(embeddings), (embeddings.shape[1] + 7) // 8), dtype=np.uint8)
+        for start in range(0, len(embeddings), QUANTIZE_BLOCK):
+            self.codes[start:start + QUANTIZE_BLOCK] = np.packbits(np.asarray(embeddings[start:start + QUANTIZE_BLOCK]) > 0, axis=1)
+        logger.info(f"Built binary index over {len(embeddings)} rows ({self.codes.nbytes / 2**20:.1f} MB of codes)")
+
+    def hamming_distances(self, query: np.ndarray) -> np.ndarray:
+        """Hamming distance between the query's sign bits and every row's code."""
+        query_bits = np.packbits(query > 0)
+        distances = np.empty(len(self.codes), dtype=np.int32)
+        for start in range(0, len(self.codes), QUANTIZE_BLOCK):
+            distances[start:start + QUANTIZE_BLOCK] = _popcount_rows(np.bitwise_xor(self.codes[start:start + QUANTIZE_BLOCK], query_bits))
+        return distances
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        distances = self.hamming_distances(query)
+        candidates = _shortlist(-distances, k * max(1, self.params["rescore"]))
+        return _rescore(self.embeddings, query, candidates, k)
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def save(self, storage_dir: str) -> None:
+        np.save(os.path.join(storage_dir, BINARY_INDEX_FILE), self.codes)
+
+    def load(self, storage_dir: str) -> None:
+        self.codes = np.load(os.path.join(storage_dir, BINARY_INDEX_FILE))
+
+
+INDEX_BACKENDS = {
+    ExactIndex.backend: ExactIndex,
+    IVFIndex.backend: IVFIndex,
+    HNSWIndex.backend: HNSWIndex,
+    Int8Index.backend: Int8Index,
+    BinaryIndex.backend: BinaryIndex,
+}
+
+
+def create_index(backend: str = "exact", **params: Any) -> VectorIndex:
+    """
+    Create an empty index of the given backend.
+
+    Args:
+        backend: One of INDEX_BACKENDS
+        **params: Build and search parameters of the backend
+
+    Returns:
+        Unbuilt index
+    """
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"Unknown index backend '{backend}', expected one of {sorted(INDEX_BACKENDS)}")
+    return INDEX_BACKENDS[backend](**params)
+
+
+def load_index(storage_dir: str, config: Optional[Dict[str, Any]], embeddings: np.ndarray) -> VectorIndex:
+    """
+    Load the index described by the "ann_index" entry of index.json metadata.
+    Falls back to exact search if no index was built or it is out of date.
+
+    Args:
+        storage_dir: Directory of the store
+        config: The stored {"backend", "params", "rows"} entry, or None
+        embeddings: The store's embeddings matrix
+
+    Returns:
+        Index ready to search
+    """
+    if not config or config["backend"] == ExactIndex.backend:
+        index = ExactIndex()
+    elif config.get("rows") != len(embeddings):
+        logger.warning(
+            f"{config['backend']} index covers {config.get('rows')} rows but the store has "
+            f"{len(embeddings)}; using exact search until it is rebuilt"
+        )
+        index = ExactIndex()
+    else:
+        index = create_index(config["backend"], **config.get("params", {}))
+        index.load(storage_dir)
+    index.attach(embeddings)
+    return index
+
+
+def recall_report(
+    index: VectorIndex,
+    embeddings: np.ndarray,
+    queries: np.ndarray,
+    ks: List[int],
+    settings: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Measure recall@k and latency of an index against exact search.
+
+    Args:
+        index: Built index to evaluate
+        embeddings: The store's embeddings matrix
+        queries: (Q, dim) normalized query vectors
+        ks: Values of k to evaluate
+        settings: Search parameter sets to try, e.g. [{"nprobe": 4}, {"nprobe": 16}]
+
+    Returns:
+        One entry per (setting, k) with recall, mean and p95 latency in ms, and
+        the memory of the index next to that of the float embeddings
+    """
+    exact = ExactIndex()
+    exact.attach(embeddings)
+    truth = {k: [set(exact.search(q, k)[0].tolist()) for q in queries] for k in ks}
+
+    report = []
+    for setting in settings:
+        index.set_search_params(**setting)
+        for k in ks:
+            hits = 0
+            latencies = []
+            for q, expected in zip(queries, truth[k]):
+                started = time.perf_counter()
+                rows, _ = index.search(q, k)
+                latencies.append((time.perf_counter() - started) * 1000)
+                hits += len(expected.intersection(rows.tolist()))
+            report.append({
+                "backend": index.backend,
+                "params": dict(index.params),
+                "k": k,
+                "recall": hits / max(1, sum(len(expected) for expected in truth[k])),
+                "mean_ms": float(np.mean(latencies)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "index_mb": index.nbytes() / 2**20,
+                "embeddings_mb": embeddings.nbytes / 2**20
+            })
+    return report
+
+
+if __name__ == "__main__":
+    # Build an index for a store and/or report recall against exact search
+    import argparse
+    from chunks import LocalChunkStorage
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build and evaluate nearest-neighbour indexes")
+    parser.add_argument("--storage-dir", default="data_blocks", help="Directory of the chunk store")
+    parser.add_argument("--backend", default="ivf", choices=sorted(INDEX_BACKENDS), help="Index backend")
+    parser.add_argument("--params", default="{}", help='Build parameters as JSON, e.g. \'{"nlist": 128}\'')
+    parser.add_argument("--build", action="store_true", help="Build and persist the index for the store")
+    parser.add_argument("--sweep", default='[{}]', help='Search settings to evaluate as a JSON list, e.g. \'[{"nprobe": 4}, {"nprobe": 16}]\'')
+    parser.add_argument("--k", default="3,10", help="Comma-separated values of k")
+    parser.add_argument("--queries", type=int, default=200, help="Number of evaluation queries")
+    args = parser.parse_args()
+
+    storage = LocalChunkStorage(args.storage_dir, embedding_model=None)
+    if args.build:
+        storage.build_ann_index(args.backend, **json.loads(args.params))
+
+    embeddings = storage.get_embeddings()
+    index = create_index(args.backend, **json.loads(args.params))
+    if args.build:
+        index.load(args.storage_dir)
+        index.attach(embeddings)
+    else:
+        index.build(embeddings)
+
+    # Evaluation queries: stored rows with noise, so they are near but not on a row
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)
+    noise = rng.normal(0, 0.3 / np.sqrt(embeddings.shape[1]), (len(rows), embeddings.shape[1]))
+    queries = np.asarray(embeddings[np.sort(rows)]) + noise
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+    ks = [int(k) for k in args.k.split(",")]
+    for entry in recall_report(index, embeddings, queries, ks, json.loads(args.sweep)):
+        print(json.dumps(entry))
@@ -1,143 +1,420 @@
+import time
+_MODULE_STARTED = time.perf_counter()
+
 import os
 import sys
+import asyncio
 import logging
-import datetime
+import functools
+import json
+import threading
+import queue
+import contextvars
+import numpy as np
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from llm_ai import get_gemini_llm
-from chunks import LocalChunkStorage, process_pdf_to_chunks
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.agents import Tool, initialize_agent
-from langchain.agents.agent_types import AgentType
-from langchain.callbacks import StdOutCallbackHandler
-from flask import Flask, render_template, request, jsonify, send_file, send_file
-
-# Configure logging
-log_filename = os.path.join("agent_logs", f"bhagavad_gita_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-os.makedirs("agent_logs", exist_ok=True)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
+from cache import LRUCache, CachedEmbeddings, ResponseCache, SessionStore
+from embedding_models import get_embedding_model, preload_embedding_model
+from context_builder import assemble_context, compact_summary
+from assets import AssetManifest, BUILD_DIR, IMMUTABLE_CACHE_CONTROL, content_etag
+from router import route_query, record_decision, routing_stats, find_verse_reference, evaluate_arithmetic
+from metrics import REGISTRY, span, start_trace, summarize_trace, format_samples
+from chunks import (
+    LocalChunkStorage, process_pdf_to_chunks, compute_fingerprint, is_storage_current, EMBEDDING_MODEL_NAME,
+    CHUNKING as DEFAULT_CHUNKING
 )
+from flask import (
+    Blueprint, Flask, Response, abort, current_app, render_template, request, jsonify, make_response, send_file,
+    stream_with_context, url_for
+)
+
+# langchain, the Gemini client, torch and sentence-transformers are imported
+# where they are first needed, so importing this module (and forking workers
+# from it) stays cheap. See --profile-startup for the breakdown.
+
 logger = logging.getLogger(__name__)
 
 # Load configuration from .env file
 load_dotenv()
 
+# APP_ENV=production turns off the agent's verbose ReAct trace on stdout and
+# defaults to JSON log lines (LOG_FORMAT overrides the format either way)
+PRODUCTION = os.getenv("APP_ENV", "development").lower() == "production"
+
+def setup_logging():
+    """Log through a background queue to the console and agent_logs/ (once per process)"""
+    from log_config import setup_logging as setup_queued_logging
+    setup_queued_logging(json_format=None if os.getenv("LOG_FORMAT") else PRODUCTION)
+
 # Define paths
 pdf_path = os.path.join("Data", "The_Bhagavad_Gita.pdf")
 storage_dir = "data_blocks"
 
-# Ensure PDF exists
-if not os.path.exists(pdf_path):
-    logger.error(f"PDF file not found at {pdf_path}")
-    print(f"Error: PDF file not found at {pdf_path}")
-    sys.exit(1)
+# Cache settings (see .env): query embedding cache size, response cache size
+# and lifetime, and the cosine threshold for semantic response-cache hits
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD")) if os.getenv("SEMANTIC_CACHE_THRESHOLD") else None
+
+# Retrieval: "dense" (embeddings), "hybrid" (embeddings fused with BM25 keyword
+# search) or "lexical" (BM25 only; the embedding model and torch are never loaded)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+
+# Query encoder: "torch" (sentence-transformers) or "onnx" (the model exported by
+# onnx_embeddings.py --export, run by onnxruntime, int8 unless ONNX_QUANTIZED=0).
+# ONNX_THREADS caps the runtime's threads per process (0 for its default).
+# Chunk embeddings are always computed with torch at ingestion time.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join("models", "all-MiniLM-L6-v2-onnx"))
+ONNX_QUANTIZED = os.getenv("ONNX_QUANTIZED", "1").lower() not in ("0", "false", "no")
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
+ONNX_OPTIONS = {"model_dir": ONNX_MODEL_DIR, "quantized": ONNX_QUANTIZED, "threads": ONNX_THREADS}
+
+# Context sent to the QA chain: similarity search returns CONTEXT_CANDIDATES
+# chunks, of which 3 are picked by MMR (CONTEXT_MMR_LAMBDA=1 picks the most
+# relevant, lower values favour diversity); adjacent ones are merged, repeated
+# sentences dropped, and the result cut to CONTEXT_MAX_TOKENS (0 for no limit)
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "8"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "800"))
+
+# Conversation sessions for follow-up questions (kept per worker process):
+# sessions kept, seconds a session lives after its last turn, and turns and
+# estimated bytes kept per session. A question whose embedding is at least
+# SESSION_REUSE_THRESHOLD similar to the previous one reuses its retrieval
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1024"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "5"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(16 * 1024)))
+SESSION_REUSE_THRESHOLD = float(os.getenv("SESSION_REUSE_THRESHOLD", "0.9"))
+
+# Browser cache lifetime of the PDF download in seconds; it is revalidated with
+# its ETag afterwards, and interrupted downloads resume with Range requests
+PDF_MAX_AGE = int(os.getenv("PDF_MAX_AGE", str(24 * 3600)))
+
+# Load the torch query encoder in the server's parent process before it forks
+# workers (serve.py), so they share the weights copy-on-write instead of each
+# loading a copy
+PRELOAD_MODEL = os.getenv("PRELOAD_MODEL", "0").lower() in ("1", "true", "yes")
+
+# "fixed" for fixed-size chunks or "verse" for one chunk per verse (changing it re-ingests the PDF)
+CHUNKING = os.getenv("CHUNKING", DEFAULT_CHUNKING)
+
+# Start loading the embedding model, store, QA chain and agent in a background
+# thread as soon as the app is created, instead of on the first query
+WARM_UP = os.getenv("WARM_UP", "1").lower() not in ("0", "false", "no")
+
+# Serving limits: agent runs allowed in flight per process, how long a request
+# may wait for a slot before getting 429, and the per-request time budget
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "8"))
+REQUEST_QUEUE_TIMEOUT = float(os.getenv("REQUEST_QUEUE_TIMEOUT", "2"))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))
+
+# Include the per-stage timing breakdown in every /query response (clients can
+# also ask for it per request with {"timings": true} or ?timings=1)
+QUERY_TIMINGS = os.getenv("QUERY_TIMINGS", "0").lower() in ("1", "true", "yes")
+
+# Batch answering (/query/batch and --batch): questions per request, concurrent
+# LLM calls, and LLM calls started per second (0 for no rate limit)
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "1000"))
+# Largest number of passages per question a /query/batch request may ask for
+BATCH_MAX_K = int(os.getenv("BATCH_MAX_K", "10"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_RATE_LIMIT = float(os.getenv("BATCH_RATE_LIMIT", "0"))
+
+# Startup profile: (step, seconds, modules imported) in the order the steps ran
+STARTUP_TIMINGS = []
+
+@contextmanager
+def startup_step(name):
+    """Time a startup step and count the modules it imported"""
+    modules_before = len(sys.modules)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STARTUP_TIMINGS.append((name, seconds, len(sys.modules) - modules_before))
+        logger.info(f"Startup: {name} took {seconds:.2f}s")
+
+STARTUP_TIMINGS.append(("import app.py (flask, numpy, storage, caches)", time.perf_counter() - _MODULE_STARTED, len(sys.modules)))
 
 # Initialize the local storage
 def initialize_storage():
     """Initialize or load the local storage"""
     logger.info("Initializing local storage...")
     
-    # Check if data needs to be processed
-    if not os.path.exists(os.path.join(storage_dir, "index.json")):
-        logger.info("Processing PDF and creating chunks...")
-        process_pdf_to_chunks(pdf_path, storage_dir)
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file not found at {pdf_path}")
+    
+    # Check if data needs to be processed: the PDF, splitter settings or
+    # embedding model may have changed since the chunks were stored
+    with startup_step("check stored chunks"):
+        storage_current = is_storage_current(storage_dir, compute_fingerprint(pdf_path, chunking=CHUNKING))
+    if not storage_current:
+        logger.info("Processing PDF and updating chunks...")
+        with startup_step("process PDF"):
+            process_pdf_to_chunks(pdf_path, storage_dir, chunking=CHUNKING)
     else:
         logger.info("Using existing chunks from storage")
     
+    if RETRIEVAL_MODE == "lexical":
+        logger.info("Lexical retrieval: the embedding model is not loaded")
+        return LocalChunkStorage(storage_dir, None, search_mode=RETRIEVAL_MODE)
+    
     # Initialize embedding model
     try:
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
-        )
-        logger.info("Using sentence-transformers/all-MiniLM-L6-v2 embedding model")
+        # One shared instance per process: ingestion above used the same one
+        if EMBEDDING_BACKEND == "onnx":
+            # Encoding queries without torch: faster per query, smaller and quicker to load
+            with startup_step("load ONNX embedding model"):
+                embeddings = get_embedding_model(EMBEDDING_MODEL_NAME, "onnx", **ONNX_OPTIONS)
+            logger.info(f"Using {EMBEDDING_MODEL_NAME} embedding model (ONNX, {os.path.basename(embeddings.model_file)})")
+        else:
+            with startup_step("load embedding model (torch, sentence-transformers)"):
+                embeddings = get_embedding_model(EMBEDDING_MODEL_NAME)
+            logger.info(f"Using {EMBEDDING_MODEL_NAME} embedding model")
     except Exception as e:
         logger.error(f"Failed to load embedding model: {e}")
         raise
 
+    # Cache query embeddings so repeated questions skip the forward pass
+    embeddings = CachedEmbeddings(embeddings, LRUCache(max_entries=EMBEDDING_CACHE_SIZE))
+    
     # Initialize local storage
-    storage = LocalChunkStorage(storage_dir, embeddings)
+    storage = LocalChunkStorage(storage_dir, embeddings, search_mode=RETRIEVAL_MODE)
     
     return storage
 
-# Custom callback handler to log agent steps
-class LoggingCallbackHandler(StdOutCallbackHandler):
-    def on_agent_action(self, action, **kwargs):
-        """Log agent action decision"""
-        logger.info(f"Agent decided to use: {action.tool}")
-        logger.info(f"Tool input: {action.tool_input}")
-        
-    def on_agent_finish(self, finish, **kwargs):
-        """Log agent finish"""
-        logger.info(f"Agent finished: {finish.return_values}")
-
 # Create a simple calculator tool
 def simple_calculator(query):
-    """Simple calculator function"""
+    """Simple calculator function (bounded arithmetic only, see router.evaluate_arithmetic)"""
     try:
         logger.info(f"Calculator input: {query}")
-        result = str(eval(query))
+        result = str(evaluate_arithmetic(query))
         logger.info(f"Calculator result: {result}")
         return result
     except Exception as e:
         logger.error(f"Calculation error: {e}")
         return "Calculation error."
 
-def setup_rag_agent():
-    """Set up the RAG agent with tools"""
-    # Initialize the local storage
-    storage = initialize_storage()
+def explain_prompt(query):
+    """
+    Build the elaboration prompt for an "Explain more:" request: from the
+    session's previous turn if it was answered from retrieved chunks,
+    otherwise from the answer quoted in the query
+    """
+    turn = _turn.get()
+    if explains_session_turn(query, turn):
+        return session_explain_prompt(turn)
+    original_response = query.split(":", 1)[1].strip()
+    logger.info(f"Explain more request for: {original_response[:50]}...")
+    return f"Please elaborate on the following information from the Bhagavad Gita in about 50-60 words, providing deeper insights: {original_response}"
+
+def session_explain_prompt(turn):
+    """
+    Elaboration prompt from the previous turn of a session: its question, the
+    summary of its answer and the chunks it was based on, instead of the whole
+    answer
+    """
+    previous = turn["previous"]
+    passages = session_passages(get_storage(), previous)
+    turn["session_context"] = True
+    logger.info(f"Explain more request for session turn {previous['turn']}: {previous['query'][:50]}")
+    context = "\n\n".join(passage["text"] for passage in passages)
+    return (
+        f"A reader asked: {previous['query']}\n"
+        f"They were told: {previous['summary']}\n\n"
+        f"Using these passages of the Bhagavad Gita:\n{context}\n\n"
+        "Please elaborate on that answer in about 50-60 words, providing deeper insights."
+    )
+
+def to_documents(retrieved_chunks):
+    """Format retrieved chunks for LLM"""
+    from langchain_core.documents import Document
+    logger.info(f"Retrieved {len(retrieved_chunks)} relevant chunks")
+    docs = []
+    for chunk in retrieved_chunks:
+        doc = Document(
+            page_content=chunk["text"],
+            metadata=chunk["metadata"]
+        )
+        docs.append(doc)
+    return docs
+
+def extract_sources(answer):
+    """Extract the references listed after "SOURCES:" in a QA chain answer"""
+    sources_section = answer.split("SOURCES:", 1)
+    if len(sources_section) > 1:
+        return [s.strip() for s in sources_section[1].split("\n") if s.strip()]
+    return []
+
+NO_RESULTS_ANSWER = "I couldn't find any relevant information in the Bhagavad Gita to answer this question."
+
+def retrieve_chunks(storage, query, k=3):
+    """
+    Retrieve the chunks for a query: a chapter/verse reference is answered
+    from the verse table, anything else by similarity search
+    """
+    reference = find_verse_reference(query)
+    if reference is not None:
+        with span("verse_lookup"):
+            verse = storage.lookup_verse(*reference)
+        if verse is not None:
+            logger.info(f"Verse lookup for {reference[0]}.{reference[1]}")
+            record_retrieval(storage, None, [verse])
+            return [verse]
+        logger.info(f"Verse {reference[0]}.{reference[1]} not in the verse table, using similarity search")
+    passages = reuse_previous_retrieval(storage, query)
+    if passages is None:
+        with span("similarity_search", mode=storage.search_mode, batch="false"):
+            candidates = storage.similarity_search(query, k=max(k, CONTEXT_CANDIDATES))
+        passages = build_context(storage, query, candidates, k)
+    record_retrieval(storage, query, passages)
+    return passages
+
+# The session turn being answered (set by start_turn), for retrieve_chunks and
+# explain_prompt to read and record its retrieval in
+_turn = contextvars.ContextVar("turn", default=None)
+
+def query_embedding(storage, query):
+    """
+    The normalized query embedding, as float16 to keep sessions small (after
+    the search it is a hit in the embedding cache); None without an embedding model
+    """
+    if storage.embedding_model is None:
+        return None
+    vector = np.asarray(storage.embedding_model.embed_query(query), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).astype(np.float16)
+
+def reuse_previous_retrieval(storage, query):
+    """
+    Passages of the session's previous turn if the query is a near-repeat of
+    its question (embedding similarity >= SESSION_REUSE_THRESHOLD), else None
+    """
+    turn = _turn.get()
+    if turn is None or turn["previous"] is None or turn["previous"]["embedding"] is None:
+        return None
+    previous = turn["previous"]
+    embedding = query_embedding(storage, query)
+    similarity = float(embedding.astype(np.float32) @ previous["embedding"].astype(np.float32))
+    if similarity < SESSION_REUSE_THRESHOLD or not previous["chunk_ids"]:
+        return None
+    passages = session_passages(storage, previous)
+    turn["session_context"] = bool(passages)
+    logger.info(f"Reusing the retrieval of session turn {previous['turn']} (similarity {similarity:.3f})")
+    return passages or None
+
+def session_passages(storage, previous):
+    """The passages of an earlier session turn, rebuilt from its chunk ids without searching"""
+    with span("session_reuse") as details:
+        details["chunks"] = len(previous["chunk_ids"])
+        chunks = storage.get_chunks(previous["chunk_ids"])
+        passages, _ = assemble_context(chunks, len(chunks), CONTEXT_MAX_TOKENS)
+    return passages
+
+def record_retrieval(storage, query, passages):
+    """
+    Remember the chunks and query embedding of the current session turn
+    (verse lookups, with query None, have no embedding to compare)
+    """
+    turn = _turn.get()
+    if turn is None:
+        return
+    turn["chunk_ids"] = [chunk_id for passage in passages for chunk_id in passage.get("chunk_ids", [passage["id"]])]
+    turn["embedding"] = query_embedding(storage, query) if query is not None else None
+
+def build_context(storage, query, candidates, k=3):
+    """
+    Pick, merge, deduplicate and trim the retrieved candidates into the
+    passages sent to the QA chain (see context_builder.py)
+    """
+    with span("context_assembly") as details:
+        embeddings = None
+        if CONTEXT_MMR_LAMBDA < 1.0 and len(candidates) > k:
+            embeddings = storage.row_embeddings([candidate["row"] for candidate in candidates])
+        passages, stats = assemble_context(candidates, k, CONTEXT_MAX_TOKENS, CONTEXT_MMR_LAMBDA, embeddings)
+        details.update(stats)
+    for stage in ("before", "after"):
+        REGISTRY.inc(
+            "gita_context_tokens_total", stats[f"tokens_{stage}"], stage=stage,
+            help="Estimated context tokens of the top retrieved chunks (before) and of the passages sent to the LLM (after)"
+        )
+    logger.info(
+        f"Context: {stats['chunks_before']} chunks, ~{stats['tokens_before']} tokens -> "
+        f"{stats['chunks_after']} passages, ~{stats['tokens_after']} tokens"
+    )
+    return passages
+
+def run_rag_pipeline(storage, qa_chain, query):
+    """
+    Run the Retrieval-Augmented Generation pipeline using local storage
+    """
+    from llm_ai import get_gemini_llm
+    logger.info(f"RAG Query: {query}")
     
-    # Initialize the Gemini LLM
-    llm = get_gemini_llm()
+    # Check if this is an "explain more" request
+    if query.lower().startswith("explain more:"):
+        # Call Gemini directly for elaboration
+        response = get_gemini_llm().invoke(explain_prompt(query))
+        return {"output_text": response.content}
     
-    # Create the RAG function that uses local storage
-    def run_rag_pipeline(query):
-        """
-        Run the Retrieval-Augmented Generation pipeline using local storage
-        """
-        logger.info(f"RAG Query: {query}")
-        
-        # Check if this is an "explain more" request
-        if query.lower().startswith("explain more:"):
-            # Extract the original query
-            original_response = query.split(":", 1)[1].strip()
-            explain_prompt = f"Please elaborate on the following information from the Bhagavad Gita in about 50-60 words, providing deeper insights: {original_response}"
-            
-            logger.info(f"Explain more request for: {original_response[:50]}...")
-            # Call Gemini directly for elaboration
-            response = llm.invoke(explain_prompt)
-            return {"output_text": response.content}
-        
-        # Get relevant documents using similarity search
-        retrieved_chunks = storage.similarity_search(query, k=3)
-        logger.info(f"Retrieved {len(retrieved_chunks)} relevant chunks")
-        
-        if not retrieved_chunks:
-            return {"output_text": "I couldn't find any relevant information in the Bhagavad Gita to answer this question."}
-        
-        # Format retrieved chunks for LLM
-        from langchain_core.documents import Document
-        docs = []
-        for chunk in retrieved_chunks:
-            doc = Document(
-                page_content=chunk["text"],
-                metadata=chunk["metadata"]
-            )
-            docs.append(doc)
-        
-        # Set up QA chain
-        qa_chain = load_qa_with_sources_chain(llm, chain_type="stuff")
-        
-        # Run the chain
+    # Get relevant documents using similarity search
+    docs = to_documents(retrieve_chunks(storage, query, k=3))
+    if not docs:
+        return {"output_text": NO_RESULTS_ANSWER}
+    
+    # Run the prebuilt QA chain. Only the answer is returned: the chain's result
+    # also holds the input documents, which the agent would otherwise paste
+    # into its scratchpad and send to the LLM a second time
+    with span("qa_chain"):
         result = qa_chain({"input_documents": docs, "question": query})
-        return result
+    return {"output_text": result["output_text"]}
+
+async def arun_rag_pipeline(storage, qa_chain, query):
+    """
+    Async version of run_rag_pipeline, used by the agent's ainvoke and the fast path
+    """
+    from llm_ai import get_gemini_llm
+    logger.info(f"RAG Query: {query}")
+    
+    if query.lower().startswith("explain more:"):
+        response = await get_gemini_llm().ainvoke(explain_prompt(query))
+        return {"output_text": response.content}
+    
+    # The vector scan is CPU-bound, so it runs off the event loop
+    docs = to_documents(await asyncio.to_thread(retrieve_chunks, storage, query, 3))
+    if not docs:
+        return {"output_text": NO_RESULTS_ANSWER}
+    
+    with span("qa_chain"):
+        result = await qa_chain.ainvoke({"input_documents": docs, "question": query})
+    return {"output_text": result["output_text"]}
+
+def setup_rag_agent(storage, qa_chain):
+    """Set up the RAG agent with tools"""
+    with startup_step("import agent (langchain.agents)"):
+        from langchain.agents import Tool, initialize_agent
+        from langchain.agents.agent_types import AgentType
+        from langchain_core.callbacks import BaseCallbackHandler
+    from llm_ai import get_gemini_llm
+    
+    # Custom callback handler to log agent steps
+    class LoggingCallbackHandler(BaseCallbackHandler):
+        def on_agent_action(self, action, **kwargs):
+            """Log agent action decision"""
+            logger.info(f"Agent decided to use: {action.tool}")
+            logger.info(f"Tool input: {action.tool_input}")
+            
+        def on_agent_finish(self, finish, **kwargs):
+            """Log agent finish"""
+            logger.debug(f"Agent finished: {finish.return_values}")
+    
+    # The Gemini LLM and the QA chain are created once and reused by every request
+    llm = get_gemini_llm()
     
     # Define tools
     tools = [
@@ -148,55 +425,424 @@ def setup_rag_agent():
         ),
         Tool(
             name="RAG_QA", 
-            func=run_rag_pipeline, 
+            func=functools.partial(run_rag_pipeline, storage, qa_chain), 
+            coroutine=functools.partial(arun_rag_pipeline, storage, qa_chain),
             description="For questions about the Bhagavad Gita. Use this for most questions."
         )
     ]
     
     # Initialize agent with callback handler for logging
     callback_handler = LoggingCallbackHandler()
-    agent = initialize_agent(
-        tools, 
-        llm, 
-        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
-        verbose=True,
-        callbacks=[callback_handler]
-    )
+    with startup_step("build agent"):
+        agent = initialize_agent(
+            tools, 
+            llm, 
+            agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
+            verbose=not PRODUCTION,
+            callbacks=[callback_handler]
+        )
     
     return agent
 
-# Set up Flask app
-app = Flask(__name__)
+# Storage, response cache, QA chain and agent are created on first use (or by
+# the warm-up thread) and then shared by CLI and web requests in this process
+_components = {}
+_components_lock = threading.RLock()
+_warm_up_thread = None
+
+def _get_component(name, factory):
+    """Return a shared component, creating it on first use"""
+    component = _components.get(name)
+    if component is not None:
+        return component
+    with _components_lock:
+        if name not in _components:
+            _components[name] = factory()
+        return _components[name]
 
-@app.route('/')
+def get_storage():
+    """The chunk store with the (cached) embedding model"""
+    return _get_component("storage", initialize_storage)
+
+def use_storage(storage):
+    """Serve queries from a prebuilt store (e.g. a benchmark corpus) instead of data_blocks/"""
+    with _components_lock:
+        _components["storage"] = storage
+
+def get_response_cache():
+    """The /query response cache"""
+    def create():
+        return ResponseCache(
+            max_entries=RESPONSE_CACHE_SIZE,
+            max_bytes=RESPONSE_CACHE_MAX_BYTES,
+            ttl=RESPONSE_CACHE_TTL,
+            semantic_threshold=SEMANTIC_CACHE_THRESHOLD,
+            # Only semantic mode needs the embedding model
+            embedding_model=get_storage().embedding_model if SEMANTIC_CACHE_THRESHOLD is not None else None
+        )
+    return _get_component("response_cache", create)
+
+def get_session_store():
+    """The conversation sessions of this process"""
+    return _get_component("sessions", lambda: SessionStore(
+        max_sessions=SESSION_MAX,
+        ttl=SESSION_TTL,
+        max_turns=SESSION_MAX_TURNS,
+        max_session_bytes=SESSION_MAX_BYTES
+    ))
+
+def start_turn(query, session_id=None, turn_id=None):
+    """
+    Make query the current turn of a session, for retrieve_chunks and
+    explain_prompt. Unknown or expired session ids get a new session.
+    Returns (session_id, turn); turn["previous"] is the session's turn_id
+    turn (its last by default), or None.
+    """
+    sessions = get_session_store()
+    previous = None
+    if isinstance(session_id, str) and sessions.get_turn(session_id) is not None:
+        previous = sessions.get_turn(session_id, turn_id)
+    else:
+        session_id = sessions.new_session_id()
+    turn = {"query": query, "previous": previous}
+    _turn.set(turn)
+    return session_id, turn
+
+def explains_session_turn(query, turn):
+    """Whether query is an "Explain more:" follow-up answered from an earlier turn of its session"""
+    return (
+        query.lower().startswith("explain more:")
+        and turn is not None
+        and turn["previous"] is not None
+        and bool(turn["previous"]["chunk_ids"])
+    )
+
+def cached_answer(query, turn=None):
+    """
+    The cached response to query, or None. Follow-ups explained from their
+    session's previous turn are not looked up: the cached answer to the same
+    text was built without that session's context.
+    """
+    if explains_session_turn(query, turn):
+        return None
+    return get_response_cache().get(query)
+
+def cache_answer(query, result):
+    """
+    Cache a response, unless the current turn was answered from its session's
+    earlier turns (an explanation of, or retrieval reused from, a previous
+    answer), which must not be replayed to other sessions
+    """
+    turn = _turn.get()
+    if turn is not None and turn.get("session_context"):
+        logger.info("Not caching an answer built from session context")
+        return
+    get_response_cache().put(query, result)
+
+def finish_turn(session_id, turn, result):
+    """
+    Record an answered turn in its session; returns its turn number. An
+    "Explain more" turn is recorded as a continuation of the turn it explains.
+    """
+    previous = turn["previous"]
+    record = {
+        "query": turn["query"],
+        "chunk_ids": turn.get("chunk_ids", []),
+        "embedding": turn.get("embedding"),
+        "summary": compact_summary(result["response"])
+    }
+    if previous is not None and turn["query"].lower().startswith("explain more:"):
+        record.update(query=previous["query"], chunk_ids=previous["chunk_ids"], embedding=previous["embedding"])
+    return get_session_store().add_turn(session_id, record)
+
+def get_assets():
+    """The manifest of the assets built by assets.py (empty if they were not built)"""
+    return _get_component("assets", lambda: AssetManifest(os.path.join(os.path.dirname(os.path.abspath(__file__)), BUILD_DIR)))
+
+def get_qa_chain():
+    """The stuff QA-with-sources chain over the shared Gemini LLM"""
+    def create():
+        with startup_step("import LLM client (langchain, google-genai)"):
+            from llm_ai import get_gemini_llm
+        with startup_step("import QA chain"):
+            from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+        with startup_step("build QA chain"):
+            return load_qa_with_sources_chain(get_gemini_llm(), chain_type="stuff")
+    return _get_component("qa_chain", create)
+
+def get_agent():
+    """The ReAct agent with the calculator and RAG tools"""
+    return _get_component("agent", lambda: setup_rag_agent(get_storage(), get_qa_chain()))
+
+def preload_models():
+    """Load the query embedding model before worker processes are forked (see PRELOAD_MODEL)"""
+    if RETRIEVAL_MODE == "lexical":
+        return
+    if EMBEDDING_BACKEND == "onnx":
+        # onnxruntime starts its thread pool with the session, and threads do
+        # not survive fork; each worker loads the (small) ONNX model itself
+        logger.info("Not preloading the ONNX embedding model; workers load it after fork")
+        return
+    with startup_step("preload embedding model"):
+        preload_embedding_model(EMBEDDING_MODEL_NAME)
+
+def is_ready():
+    """Whether everything a query needs has been loaded"""
+    return all(name in _components for name in ("storage", "response_cache", "qa_chain", "agent"))
+
+def warm_up():
+    """Load every component and run one search so the first query is fast"""
+    started = time.perf_counter()
+    try:
+        storage = get_storage()
+        with startup_step("first search (open store, first forward pass)"):
+            storage.similarity_search("What is dharma?", k=1)
+        get_response_cache()
+        get_qa_chain()
+        get_agent()
+        logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.error(f"Warm-up failed, components will load on first use: {e}")
+
+def start_warm_up():
+    """Run warm_up in a background thread (once per process)"""
+    global _warm_up_thread
+    with _components_lock:
+        if _warm_up_thread is None or not _warm_up_thread.is_alive():
+            if is_ready():
+                return
+            _warm_up_thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+            _warm_up_thread.start()
+
+def startup_report():
+    """Format the recorded startup steps as a table"""
+    lines = [f"{'step':<60} {'seconds':>8} {'modules':>8}"]
+    for name, seconds, modules in STARTUP_TIMINGS:
+        lines.append(f"{name:<60} {seconds:>8.3f} {modules:>8}")
+    lines.append(f"{'total':<60} {sum(seconds for _, seconds, _ in STARTUP_TIMINGS):>8.3f} {len(sys.modules):>8}")
+    return "\n".join(lines)
+
+# Routes live on a blueprint so create_app() can build the Flask app cheaply
+bp = Blueprint("gita", __name__)
+
+# Admission control for agent runs: requests beyond the limit wait briefly,
+# then get 429 instead of piling up behind slow LLM calls
+request_slots = threading.BoundedSemaphore(MAX_INFLIGHT_REQUESTS)
+
+def busy_response(status, message):
+    """JSON error telling the client to back off and retry"""
+    return jsonify({'error': message}), status, {'Retry-After': '5'}
+
+@bp.app_template_global()
+def asset_url(name):
+    """URL of a static asset: its fingerprinted build if assets.py was run, else /static/"""
+    return get_assets().url(name) or url_for('static', filename=name)
+
+@bp.route('/assets/<path:filename>')
+def built_asset(filename):
+    """Serve a built asset in the best variant and encoding the browser accepts, cached for a year"""
+    asset = get_assets().resolve(
+        filename,
+        tuple(value for value, quality in request.accept_mimetypes if quality > 0),
+        tuple(value for value, quality in request.accept_encodings if quality > 0)
+    )
+    if asset is None:
+        abort(404)
+    response = send_file(asset["path"], mimetype=asset["type"], etag=asset["etag"], conditional=True)
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    if asset["encoding"]:
+        response.headers["Content-Encoding"] = asset["encoding"]
+    if asset["vary"]:
+        response.vary.add(asset["vary"])
+    return response
+
+@bp.route('/')
 def home():
     """Render the home page"""
     return render_template('index.html')
 
-@app.route('/query', methods=['POST'])
+@bp.route('/health')
+def health():
+    """Liveness check: answers immediately, even while components are loading"""
+    return jsonify({'status': 'ok', 'ready': is_ready()})
+
+@bp.route('/ready')
+def ready():
+    """Readiness check: 503 until the embedding model, store and agent are loaded"""
+    if is_ready():
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': 'warming up'}), 503, {'Retry-After': '5'}
+
+def with_timings(rv, trace, started, include):
+    """
+    Record the request duration and attach its stage timings: always as a
+    Server-Timing header, and in the JSON body when include is true
+    """
+    response = make_response(rv)
+    seconds = time.perf_counter() - started
+    REGISTRY.observe(
+        "gita_request_seconds", seconds, help="Time to answer a /query request",
+        endpoint=request.path, status=response.status_code
+    )
+    timings = summarize_trace(trace, seconds)
+    response.headers['Server-Timing'] = ", ".join(
+        [f"{stage};dur={ms}" for stage, ms in timings["by_stage"].items()] + [f"total;dur={timings['total_ms']}"]
+    )
+    if include and response.is_json:
+        payload = response.get_json()
+        payload['timings'] = timings
+        response.set_data(json.dumps(payload))
+    return response
+
+def with_session(rv, session_id, turn):
+    """Record an answer in its session and tell the client the session id and turn number"""
+    response = make_response(rv)
+    if response.status_code == 200 and response.is_json:
+        payload = response.get_json()
+        payload['session_id'] = session_id
+        payload['turn'] = finish_turn(session_id, turn, payload)
+        response.set_data(json.dumps(payload))
+    return response
+
+@bp.route('/query', methods=['POST'])
 def process_query():
-    """Process a query and return the response"""
+    """
+    Process a query and return the response. The view is synchronous, so
+    waiting for a request slot blocks only this worker thread; the answer is
+    produced on an event loop of its own
+    """
+    started = time.perf_counter()
+    trace = start_trace()
     data = request.get_json()
     query = data.get('query', '')
+    include_timings = QUERY_TIMINGS or bool(data.get('timings')) or request.args.get('timings') == '1'
     
     if not query:
         return jsonify({'error': 'No query provided'}), 400
     
     logger.info(f"Web query: {query}")
+    session_id, turn = start_turn(query, data.get('session_id'), data.get('turn'))
+    
+    # Repeated (or, in semantic mode, near-identical) questions skip the LLM entirely
+    with span("response_cache"):
+        cached_response = cached_answer(query, turn)
+    if cached_response is not None:
+        logger.info("Answered from response cache")
+        return with_timings(with_session(jsonify(dict(cached_response, cached=True)), session_id, turn), trace, started, include_timings)
+    
+    if not request_slots.acquire(timeout=REQUEST_QUEUE_TIMEOUT):
+        logger.warning("Rejecting query: too many requests in flight")
+        return with_timings(busy_response(429, 'Too many requests, please retry shortly'), trace, started, include_timings)
     
     try:
+        return with_timings(with_session(asyncio.run(answer_query(query)), session_id, turn), trace, started, include_timings)
+    finally:
+        request_slots.release()
+
+# Phrases in an answer that mean the RAG pipeline or agent couldn't answer
+UNABLE_PHRASES = [
+    "i am unable to answer",
+    "i don't know",
+    "i cannot answer",
+    "i do not have",
+    "not available in",
+    "not found in the bhagavad gita"
+]
+
+def is_unable_answer(answer):
+    """Whether an answer says the text doesn't cover the question"""
+    return any(phrase in answer.lower() for phrase in UNABLE_PHRASES) or answer == NO_RESULTS_ANSWER
+
+def fallback_prompt(query):
+    """Prompt for answering directly with Gemini when the Gita text doesn't cover a question"""
+    return f"With reference to the Bhagavad Gita, please answer the following question in 60- 70 words: {query}"
+
+def fallback_result(answer):
+    """The response for a direct Gemini answer given in place of one the text didn't cover"""
+    return {
+        'response': answer,
+        'references': [],
+        'tools_used': [{"name": "Direct Gemini", "input": "Fallback mode - using Gemini directly"}],
+        'is_fallback': True
+    }
+
+def answer_without_llm(query, route):
+    """
+    Answer arithmetic and bare verse references with no LLM call.
+    Returns None for other routes, or a verse not in the verse table.
+    """
+    if route == "calculator":
+        return {
+            'response': simple_calculator(query),
+            'references': [],
+            'tools_used': [{"name": "Calculator", "input": query}]
+        }
+    
+    if route == "verse_text":
+        chapter, verse_number = find_verse_reference(query)
+        verse = get_storage().lookup_verse(chapter, verse_number)
+        if verse is not None:
+            return {
+                'response': verse["text"],
+                'references': [f"Bhagavad Gita {chapter}.{verse_number} (page {verse['metadata']['page']})"],
+                'tools_used': [{"name": "Verse lookup", "input": f"{chapter}.{verse_number}"}]
+            }
+        # Not in the verse table: answer it like any other question
+    return None
+
+async def answer_fast_path(query, route):
+    """
+    Answer a query routed away from the agent: arithmetic and bare verse
+    references with no LLM call, Gita questions and "Explain more" follow-ups
+    with a single LLM call.
+    Returns None if the answer says the text doesn't cover the question.
+    """
+    result = answer_without_llm(query, route)
+    if result is not None:
+        return result
+    
+    output = await asyncio.wait_for(arun_rag_pipeline(get_storage(), get_qa_chain(), query), timeout=REQUEST_TIMEOUT)
+    answer = output["output_text"]
+    if is_unable_answer(answer):
+        return None
+    return {
+        'response': answer.split("SOURCES:", 1)[0].strip(),
+        'references': extract_sources(answer),
+        # An "Explain more" follow-up is a single direct call, not a retrieval
+        'tools_used': [] if route == "explain" else [{"name": "RAG_QA", "input": query}]
+    }
+
+async def answer_query(query):
+    """Run the agent (or the direct Gemini fallback) for a query within the request timeout"""
+    from llm_ai import get_gemini_llm, UpstreamBusyError
+    try:
+        # Obvious cases skip the agent's tool-selection and final-answer LLM calls
+        decision = route_query(query)
+        record_decision(query, decision)
+        if decision.route != "agent":
+            with span("fast_path", route=decision.route):
+                result = await answer_fast_path(query, decision.route)
+            if result is not None:
+                result['route'] = decision.route
+                cache_answer(query, result)
+                return jsonify(result)
+            logger.info("Fast path could not answer, falling back to the agent")
+        
         # Use the agent chain with callbacks to capture intermediate steps
-        from langchain.callbacks import get_openai_callback
-        from langchain.callbacks.base import BaseCallbackManager
-        from langchain.callbacks.tracers import LangChainTracer
+        from langchain_core.callbacks import BaseCallbackHandler
+        agent = get_agent()
         
         # Create a custom callback handler to capture tool usage and references
-        class ReferenceCapturingHandler(StdOutCallbackHandler):
+        class ReferenceCapturingHandler(BaseCallbackHandler):
             def __init__(self):
                 super().__init__()
                 self.tool_usage = []
                 self.references = []
                 self.current_tool = None
+                self.iterations = 0
+            
+            def on_agent_action(self, action, **kwargs):
+                self.iterations += 1
             
             def on_tool_start(self, serialized, input_str, **kwargs):
                 self.current_tool = {
@@ -213,9 +859,7 @@ def process_query():
                             self.current_tool["answer"] = output["output_text"]
                             # Extract sources if available
                             if "SOURCES" in output.get("output_text", ""):
-                                sources_section = output["output_text"].split("SOURCES:", 1)
-                                if len(sources_section) > 1:
-                                    self.references = [s.strip() for s in sources_section[1].split("\n") if s.strip()]
+                                self.references = extract_sources(output["output_text"])
                         
                     self.tool_usage.append(self.current_tool)
                     self.current_tool = None
@@ -225,32 +869,39 @@ def process_query():
         
         try:
             # Run the agent with the callback handler
-            response = agent.run(query, callbacks=[reference_handler])
-            
-            # Check if the response indicates the agent couldn't answer
-            unable_phrases = [
-                "i am unable to answer",
-                "i don't know",
-                "i cannot answer",
-                "i do not have",
-                "not available in",
-                "not found in the bhagavad gita"
-            ]
+            with span("agent") as details:
+                try:
+                    output = await asyncio.wait_for(
+                        agent.ainvoke({"input": query}, config={"callbacks": [reference_handler]}),
+                        timeout=REQUEST_TIMEOUT
+                    )
+                finally:
+                    details["iterations"] = reference_handler.iterations
+                    REGISTRY.observe(
+                        "gita_agent_iterations", reference_handler.iterations,
+                        help="Tool calls the ReAct agent made per query", buckets=(0, 1, 2, 3, 4, 5, 8, 15)
+                    )
+            response = output["output"]
             
             # If the response says the agent can't answer, use direct Gemini approach
-            if any(phrase in response.lower() for phrase in unable_phrases):
+            if any(phrase in response.lower() for phrase in UNABLE_PHRASES):
                 raise ValueError("Agent indicated it cannot answer")
             
             # Otherwise, return the normal response
             references = reference_handler.references
             tools_used = [{"name": tool["tool"], "input": tool["input"]} for tool in reference_handler.tool_usage]
             
-            return jsonify({
+            result = {
                 'response': response,
                 'references': references,
                 'tools_used': tools_used
-            })
+            }
+            cache_answer(query, result)
+            return jsonify(result)
             
+        except (UpstreamBusyError, asyncio.TimeoutError):
+            # The fallback would hit the same overloaded upstream
+            raise
         except Exception as agent_error:
             logger.warning(f"Agent could not answer. Falling back to direct Gemini: {agent_error}")
             
@@ -258,25 +909,419 @@ def process_query():
             llm = get_gemini_llm()
             
             # Create direct prompt to Gemini with Bhagavad Gita context
-            direct_prompt = f"With reference to the Bhagavad Gita, please answer the following question in 60- 70 words: {query}"
-            direct_response = llm.invoke(direct_prompt)
+            with span("fallback"):
+                direct_response = await asyncio.wait_for(llm.ainvoke(fallback_prompt(query)), timeout=REQUEST_TIMEOUT)
             
-            return jsonify({
-                'response': direct_response.content,
-                'references': [],
-                'tools_used': [{"name": "Direct Gemini", "input": "Fallback mode - using Gemini directly"}],
-                'is_fallback': True
-            })
+            result = fallback_result(direct_response.content)
+            cache_answer(query, result)
+            return jsonify(result)
             
+    except UpstreamBusyError:
+        logger.warning("Rejecting query: all Gemini API keys are at their concurrency limit")
+        return busy_response(503, 'The language model is busy, please retry shortly')
+    except asyncio.TimeoutError:
+        logger.warning(f"Query timed out after {REQUEST_TIMEOUT}s")
+        return busy_response(503, 'The request took too long, please retry shortly')
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/download-bhagavad-gita')
+class RateLimiter:
+    """Spaces out the calls of one event loop to at most rate per second (0 disables the limit)"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+    
+    async def wait(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+async def answer_batch(queries, k=3, concurrency=BATCH_CONCURRENCY, rate=BATCH_RATE_LIMIT):
+    """
+    Answer many questions with the single-call retrieval + QA path (no agent),
+    yielding (index, result) pairs as the answers finish.
+    
+    Cached answers, arithmetic and bare verse references are yielded first.
+    All questions that need a similarity search are embedded in one batched
+    call and scored together; the QA calls then run concurrently, at most
+    concurrency at a time and rate started per second. Answers that say the
+    text doesn't cover the question are replaced by a direct Gemini answer,
+    as on /query.
+    """
+    from llm_ai import get_gemini_llm
+    storage = get_storage()
+    
+    retrieved = {}
+    explain = []
+    to_search = []
+    for index, query in enumerate(queries):
+        cached_response = cached_answer(query)
+        if cached_response is not None:
+            yield index, dict(cached_response, cached=True)
+            continue
+        route = route_query(query).route
+        if route == "calculator":
+            yield index, dict(await answer_fast_path(query, route), route=route)
+            continue
+        if route == "explain":
+            explain.append(index)
+            continue
+        reference = find_verse_reference(query)
+        verse = storage.lookup_verse(*reference) if reference is not None else None
+        if verse is not None and route == "verse_text":
+            yield index, dict(await answer_fast_path(query, route), route=route)
+        elif verse is not None:
+            retrieved[index] = [verse]
+        else:
+            to_search.append(index)
+    
+    if to_search:
+        with span("similarity_search", mode=storage.search_mode, batch="true"):
+            results = await asyncio.to_thread(
+                storage.similarity_search_batch, [queries[i] for i in to_search], max(k, CONTEXT_CANDIDATES)
+            )
+        for index, candidates in zip(to_search, results):
+            retrieved[index] = build_context(storage, queries[index], candidates, k)
+        logger.info(f"Batch retrieval for {len(to_search)} questions")
+    
+    llm = get_gemini_llm()
+    qa_chain = get_qa_chain()
+    slots = asyncio.Semaphore(max(1, concurrency))
+    limiter = RateLimiter(rate)
+    
+    async def answer(index):
+        query = queries[index]
+        async with slots:
+            await limiter.wait()
+            try:
+                if index in retrieved:
+                    docs = to_documents(retrieved[index])
+                    if not docs:
+                        return index, {'response': NO_RESULTS_ANSWER, 'references': [], 'tools_used': [], 'route': 'rag'}
+                    with span("qa_chain"):
+                        output = await asyncio.wait_for(
+                            qa_chain.ainvoke({"input_documents": docs, "question": query}), timeout=REQUEST_TIMEOUT
+                        )
+                    text = output["output_text"]
+                    route = "verse" if find_verse_reference(query) is not None else "rag"
+                    tools_used = [{"name": "RAG_QA", "input": query}]
+                else:
+                    response = await asyncio.wait_for(llm.ainvoke(explain_prompt(query)), timeout=REQUEST_TIMEOUT)
+                    text = response.content
+                    route = "explain"
+                    tools_used = []
+                answer = text.split("SOURCES:", 1)[0].strip()
+                if is_unable_answer(answer):
+                    logger.warning(f"Batch question {index} is not covered by the text, falling back to direct Gemini")
+                    with span("fallback"):
+                        response = await asyncio.wait_for(llm.ainvoke(fallback_prompt(query)), timeout=REQUEST_TIMEOUT)
+                    result = fallback_result(response.content)
+                else:
+                    result = {'response': answer, 'references': extract_sources(text), 'tools_used': tools_used, 'route': route}
+            except Exception as e:
+                logger.error(f"Batch question {index} failed: {e}")
+                return index, {'error': str(e) or type(e).__name__}
+        cache_answer(query, result)
+        return index, result
+    
+    for finished in asyncio.as_completed([answer(index) for index in list(retrieved) + explain]):
+        yield await finished
+
+def iter_batch(queries, **kwargs):
+    """Run answer_batch on an event loop in a background thread and yield its results here"""
+    results = queue.Queue()
+    done = object()
+    
+    async def produce():
+        async for item in answer_batch(queries, **kwargs):
+            results.put(item)
+    
+    def run():
+        try:
+            asyncio.run(produce())
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+    
+    threading.Thread(target=run, name="batch", daemon=True).start()
+    while True:
+        item = results.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def batch_record(queries, index, result):
+    """One JSONL line of batch output"""
+    return json.dumps(dict({'index': index, 'query': queries[index]}, **result)) + "\n"
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def session_done(result, session):
+    """The "done" event data, with the session id and turn number if the answer is part of a session"""
+    if session is None:
+        return result
+    session_id, turn = session
+    return dict(result, session_id=session_id, turn=finish_turn(session_id, turn, result))
+
+def stream_tokens(llm, prompt, started):
+    """
+    Stream an LLM answer as "token" events; returns the answer, or None after
+    an "error" event if the request ran out of time
+    """
+    answer = ""
+    for chunk in llm.stream(prompt):
+        if time.monotonic() - started > REQUEST_TIMEOUT:
+            logger.warning(f"Streaming query timed out after {REQUEST_TIMEOUT}s")
+            yield sse_event("error", {"error": "The request took too long, please retry shortly"})
+            return None
+        answer += chunk.content
+        yield sse_event("token", {"text": chunk.content})
+    return answer
+
+def stream_agent_answer(query, session=None):
+    """Run the agent, which cannot stream, and send its whole answer as one "token" event"""
+    yield sse_event("references", {"references": []})
+    response = make_response(asyncio.run(answer_query(query)))
+    payload = response.get_json()
+    if response.status_code != 200:
+        yield sse_event("error", {"error": payload.get('error', 'Unknown error')})
+        return
+    yield sse_event("token", {"text": payload['response']})
+    yield sse_event("done", session_done(payload, session))
+
+def stream_answer(query, session=None):
+    """
+    Answer a query as a stream of server-sent events: "references" as soon as
+    retrieval finishes, then "token" events as the LLM produces the answer,
+    and finally "done" with the complete response (or "error").
+    
+    Queries are routed as on /query: arithmetic and bare verse references are
+    answered at once, queries the router leaves to the ReAct agent run the
+    agent, and the rest stream from a single retrieval + QA call. If that
+    answer says the text doesn't cover the question, a "fallback" event
+    discards it and the direct Gemini answer is streamed instead.
+    session is the (session_id, turn) from start_turn, if any.
+    """
+    from langchain_core.prompts import format_document
+    from llm_ai import get_gemini_llm
+    started = time.monotonic()
+    
+    decision = route_query(query)
+    if decision.route == "agent":
+        # answer_query routes (and records) the query itself
+        yield from stream_agent_answer(query, session)
+        return
+    record_decision(query, decision)
+    result = answer_without_llm(query, decision.route)
+    if result is not None:
+        result['route'] = decision.route
+        cache_answer(query, result)
+        yield sse_event("references", {"references": []})
+        yield sse_event("token", {"text": result['response']})
+        yield sse_event("done", session_done(result, session))
+        return
+    
+    llm = get_gemini_llm()
+    storage = get_storage()
+    qa_chain = get_qa_chain()
+    
+    if decision.route == "explain":
+        yield sse_event("references", {"references": []})
+        answer = yield from stream_tokens(llm, explain_prompt(query), started)
+        references = []
+        tools_used = []
+    else:
+        tools_used = [{"name": "RAG_QA", "input": query}]
+        retrieved_chunks = retrieve_chunks(storage, query, k=3)
+        docs = to_documents(retrieved_chunks)
+        yield sse_event("references", {"references": [
+            {
+                "id": chunk["id"],
+                "metadata": chunk["metadata"],
+                "similarity": chunk.get("similarity", 0.0),
+                "text": chunk["text"][:200]
+            }
+            for chunk in retrieved_chunks
+        ]})
+        if docs:
+            # Same prompt the stuff QA chain would send, streamed token by token
+            summaries = qa_chain.document_separator.join(
+                format_document(doc, qa_chain.document_prompt) for doc in docs
+            )
+            prompt = qa_chain.llm_chain.prompt.format(**{
+                qa_chain.document_variable_name: summaries,
+                "question": query
+            })
+            answer = yield from stream_tokens(llm, prompt, started)
+        else:
+            answer = NO_RESULTS_ANSWER
+        references = None
+    if answer is None:
+        return
+    
+    if is_unable_answer(answer.split("SOURCES:", 1)[0].strip()):
+        # Never cached: the direct answer is cached instead, as on /query
+        logger.warning("Streamed answer does not cover the question, falling back to direct Gemini")
+        yield sse_event("fallback", {})
+        with span("fallback"):
+            answer = yield from stream_tokens(llm, fallback_prompt(query), started)
+        if answer is None:
+            return
+        result = fallback_result(answer)
+    else:
+        if references is None:
+            references = extract_sources(answer)
+            answer = answer.split("SOURCES:", 1)[0].strip()
+        result = {'response': answer, 'references': references, 'tools_used': tools_used, 'route': decision.route}
+    cache_answer(query, result)
+    yield sse_event("done", session_done(result, session))
+
+@bp.route('/query/stream', methods=['POST'])
+def process_query_stream():
+    """Process a query and stream the response as server-sent events"""
+    data = request.get_json()
+    query = data.get('query', '')
+    
+    if not query:
+        return jsonify({'error': 'No query provided'}), 400
+    
+    logger.info(f"Web streaming query: {query}")
+    
+    session = start_turn(query, data.get('session_id'), data.get('turn'))
+    cached_response = cached_answer(query, session[1])
+    if cached_response is not None:
+        logger.info("Answered from response cache")
+        def replay():
+            yield sse_event("references", {"references": []})
+            yield sse_event("token", {"text": cached_response["response"]})
+            yield sse_event("done", session_done(dict(cached_response, cached=True), session))
+        return Response(replay(), mimetype='text/event-stream')
+    
+    if not request_slots.acquire(timeout=REQUEST_QUEUE_TIMEOUT):
+        logger.warning("Rejecting streaming query: too many requests in flight")
+        return busy_response(429, 'Too many requests, please retry shortly')
+    
+    from llm_ai import UpstreamBusyError
+    
+    def generate():
+        # The slot is held until the stream has been fully sent. The session
+        # turn is set again here, in the context the stream is generated in
+        _turn.set(session[1])
+        try:
+            yield from stream_answer(query, session)
+        except UpstreamBusyError:
+            yield sse_event("error", {"error": "The language model is busy, please retry shortly"})
+        except Exception as e:
+            logger.error(f"Error streaming query: {e}")
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            request_slots.release()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route('/query/batch', methods=['POST'])
+def process_query_batch():
+    """Answer many questions, streaming one JSON line per question as the answers finish"""
+    data = request.get_json(silent=True) or {}
+    queries = data.get('queries')
+    
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({'error': 'Provide "queries" as a non-empty list of questions'}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({'error': f'At most {BATCH_MAX_QUERIES} questions per batch'}), 413
+    k = data.get('k', 3)
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= BATCH_MAX_K:
+        return jsonify({'error': f'"k" must be an integer from 1 to {BATCH_MAX_K}'}), 400
+    
+    logger.info(f"Web batch of {len(queries)} questions")
+    
+    if not request_slots.acquire(timeout=REQUEST_QUEUE_TIMEOUT):
+        logger.warning("Rejecting batch: too many requests in flight")
+        return busy_response(429, 'Too many requests, please retry shortly')
+    
+    def generate():
+        # The slot is held until the last answer has been sent
+        try:
+            for index, result in iter_batch(queries, k=k):
+                yield batch_record(queries, index, result)
+        except Exception as e:
+            logger.error(f"Error answering batch: {e}")
+            yield json.dumps({'error': str(e)}) + "\n"
+        finally:
+            request_slots.release()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route('/cache/stats')
+def cache_stats():
+    """Report hit/miss counts and memory use of the query caches"""
+    # Components that haven't loaded yet are reported as null rather than loaded here
+    storage = _components.get("storage")
+    response_cache = _components.get("response_cache")
+    sessions = _components.get("sessions")
+    return jsonify({
+        'embeddings': storage.embedding_model.cache.stats() if storage and storage.embedding_model else None,
+        'responses': response_cache.stats() if response_cache else None,
+        'sessions': sessions.stats() if sessions else None,
+        'routing': routing_stats()
+    })
+
+@bp.route('/metrics')
+def metrics():
+    """Stage latency histograms, LLM token counts, routing and cache counters in Prometheus text format"""
+    lines = [REGISTRY.render().rstrip("\n")]
+    routing = routing_stats()
+    lines += format_samples(
+        "gita_routes_total", "counter", "Queries sent down each route",
+        {(("route", name[len("route_"):]),): count for name, count in routing.items() if name.startswith("route_")}
+    )
+    lines += format_samples(
+        "gita_llm_calls_saved_total", "counter", "LLM calls saved by the router", {(): routing.get("llm_calls_saved", 0)}
+    )
+    storage = _components.get("storage")
+    response_cache = _components.get("response_cache")
+    caches = {}
+    if storage is not None and isinstance(storage.embedding_model, CachedEmbeddings):
+        caches["embeddings"] = storage.embedding_model.cache.stats()
+    if response_cache is not None:
+        caches["responses"] = response_cache.stats()
+    for result in ("hits", "misses"):
+        lines += format_samples(
+            f"gita_cache_{result}_total", "counter", f"Cache {result}",
+            {(("cache", name),): stats[result] for name, stats in caches.items()}
+        )
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@bp.route('/download-bhagavad-gita')
 def download_bhagavad_gita():
-    """Route to download the Bhagavad Gita PDF"""
-    logger.info("User downloaded the Bhagavad Gita PDF")
-    return send_file(pdf_path, as_attachment=True)
+    """
+    Route to download the Bhagavad Gita PDF. Answers If-None-Match with 304
+    and Range requests with 206, so browsers revalidate or resume a download
+    instead of fetching the whole file again
+    """
+    path = os.path.join(current_app.root_path, pdf_path)
+    response = send_file(path, as_attachment=True, etag=content_etag(path), conditional=True, max_age=PDF_MAX_AGE)
+    if response.status_code == 200:
+        logger.info("User downloaded the Bhagavad Gita PDF")
+    return response
 
 # CLI demo
 def run_cli_demo():
@@ -289,6 +1334,11 @@ def run_cli_demo():
     print("=" * 60 + "\n")
     
     last_response = ""
+    session_id = None
+    
+    # The prompt is available right away; the first question waits for
+    # whatever the warm-up hasn't finished loading
+    start_warm_up()
     
     while True:
         query = input("\nAsk a question (or type 'exit' to quit): ")
@@ -299,8 +1349,12 @@ def run_cli_demo():
         if query.lower() == 'explain more' and last_response:
             logger.info("User requested elaboration on previous response")
             try:
+                from llm_ai import get_gemini_llm
                 explain_query = f"Explain more: {last_response}"
-                elaborate_response = agent.run(explain_query)
+                # The session's last turn supplies the question, summary and chunks
+                session_id, turn = start_turn(explain_query, session_id)
+                elaborate_response = get_gemini_llm().invoke(explain_prompt(explain_query)).content
+                finish_turn(session_id, turn, {"response": elaborate_response})
                 print("\n" + elaborate_response)
             except Exception as e:
                 logger.error(f"Error during elaboration: {e}")
@@ -309,7 +1363,9 @@ def run_cli_demo():
         
         logger.info(f"User query: {query}")
         try:
-            response = agent.run(query)
+            session_id, turn = start_turn(query, session_id)
+            response = get_agent().run(query)
+            finish_turn(session_id, turn, {"response": response})
             print("\n" + response)
             last_response = response
             print("\nType 'explain more' if you want a more detailed explanation.")
@@ -317,8 +1373,57 @@ def run_cli_demo():
             logger.error(f"Error during agent execution: {e}")
             print(f"\nError: {str(e)}")
 
-# Create agent for both CLI and web use
-agent = setup_rag_agent()
+def run_batch_cli(input_path, output_path=None):
+    """
+    Answer the questions in a file (one per line, or JSONL with a "query"
+    field) and write one JSON line per answer, in completion order
+    """
+    queries = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("{"):
+                line = json.loads(line)["query"]
+            if line:
+                queries.append(line)
+    logger.info(f"Answering {len(queries)} questions from {input_path}")
+    
+    started = time.perf_counter()
+    errors = 0
+    out = open(output_path, "w", encoding="utf-8") if output_path else sys.stdout
+    try:
+        for index, result in iter_batch(queries):
+            errors += 'error' in result
+            out.write(batch_record(queries, index, result))
+            out.flush()
+    finally:
+        if output_path:
+            out.close()
+    elapsed = time.perf_counter() - started
+    logger.info(f"Answered {len(queries)} questions ({errors} failed) in {elapsed:.1f}s, {len(queries) / elapsed:.1f} per second")
+
+def create_app(warm_up=None):
+    """
+    Create the Flask app. This is cheap: the embedding model, store and agent
+    load on first use, or in a background thread started here when warm_up
+    is true (defaults to the WARM_UP setting).
+    
+    Under a pre-forking server, create the app with warm_up=False in the
+    parent and call start_warm_up() in each worker, since threads don't
+    survive fork.
+    """
+    setup_logging()
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(bp)
+    if WARM_UP if warm_up is None else warm_up:
+        start_warm_up()
+    return flask_app
+
+def profile_startup():
+    """Load everything in the foreground and print where the startup time went"""
+    warm_up()
+    print(startup_report())
+    print("\nFor a per-module import breakdown run: python -X importtime app.py --profile-startup")
 
 # Create templates directory and ensure it exists
 def setup_templates():
@@ -330,13 +1435,30 @@ def setup_templates():
 if __name__ == "__main__":
     logger.info("Bhagavad Gita Q&A Assistant starting up")
     
+    setup_logging()
+    
+    # Ensure PDF exists
+    if not os.path.exists(pdf_path):
+        logger.error(f"PDF file not found at {pdf_path}")
+        print(f"Error: PDF file not found at {pdf_path}")
+        sys.exit(1)
+    
     # Create templates if they don't exist (for web mode)
     setup_templates()
     
     # Check command line arguments
     if len(sys.argv) > 1 and sys.argv[1] == "--web":
         logger.info("Starting in web mode")
-        app.run(debug=True, host='0.0.0.0', port=5000)
+        from serve import run_server
+        # Workers warm up after fork; the parent process stays light
+        run_server(create_app(warm_up=False), post_worker_init=start_warm_up if WARM_UP else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--dev":
+        logger.info("Starting Flask development server")
+        create_app().run(debug=True, host='0.0.0.0', port=5000)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--profile-startup":
+        profile_startup()
+    elif len(sys.argv) > 2 and sys.argv[1] == "--batch":
+        run_batch_cli(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
     else:
         run_cli_demo()
 
@@ -0,0 +1,13 @@
+"""
+ASGI entry point for the Bhagavad Gita web app, for ASGI servers such as uvicorn:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+
+The views are synchronous: WsgiToAsgi runs each request in a worker thread,
+so this only adapts the WSGI app to an ASGI server and is not faster than
+serve.py (needs uvicorn and asgiref from requirements-optional.txt).
+"""
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+
+application = WsgiToAsgi(create_app())
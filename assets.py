@@ -0,0 +1,290 @@
+"""
+Module with the static asset pipeline and the helpers that serve its output.
+
+The UI's background images are multi-megabyte PNGs and Flask serves static/
+with "Cache-Control: no-cache", so browsers revalidate every file on every
+visit and download every byte on the first. Running this module builds
+static/dist/:
+
+- images are scaled down to MAX_IMAGE_WIDTH, re-encoded as optimized
+  PNG/JPEG and converted to WebP (and AVIF where Pillow supports it),
+  keeping the variants smaller than the PNG/JPEG;
+- CSS and JS are precompressed with gzip (and brotli if installed), after
+  the /static/ image URLs in the CSS are pointed at the built files;
+- every output is named after a hash of its content (bg.3f2a9c1d7e4b.png),
+  so it can be cached for a year and a deploy changes the URL instead;
+- manifest.json maps each source file to its outputs.
+
+The app serves the built files from /assets/ in the smallest variant the
+browser accepts (Accept for images, Accept-Encoding for text), with immutable
+Cache-Control and an ETag. Without a build it falls back to /static/.
+
+Usage:
+    python assets.py                  # build static/dist/
+    python assets.py --max-width 2560 --quality 85
+"""
+import os
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ASSET_DIR = "static"
+BUILD_DIR = os.path.join(ASSET_DIR, "dist")
+MANIFEST_FILE = "manifest.json"
+
+IMAGE_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+TEXT_TYPES = {".css": "text/css; charset=utf-8", ".js": "text/javascript; charset=utf-8"}
+
+# Backgrounds are shown at most full-screen; wider images only cost bytes
+MAX_IMAGE_WIDTH = 1920
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+HASH_LENGTH = 12
+
+# Built files never change under a given name
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_CSS_STATIC_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+def _fingerprint(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def _encode_image(image: Any, image_format: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+    elif image_format == "JPEG":
+        image.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif image_format == "WEBP":
+        image.save(buffer, "WEBP", quality=quality, method=6)
+    else:
+        image.save(buffer, image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _build_image(path: str, max_width: int, quality: int) -> Dict[str, bytes]:
+    """Re-encoded variants of an image, content type -> bytes (the first is the fallback)."""
+    try:
+        from PIL import Image, features
+    except ImportError:
+        raise ImportError("Building image assets requires Pillow: pip install pillow")
+
+    with Image.open(path) as source:
+        source.load()
+        image = source
+        if image.width > max_width:
+            image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+        mimetype = IMAGE_TYPES[os.path.splitext(path)[1].lower()]
+        fallback = _encode_image(image, "PNG" if mimetype == "image/png" else "JPEG", quality)
+        # Re-encoding an already optimized file at the same size can make it larger
+        if image is source and len(fallback) >= os.path.getsize(path):
+            with open(path, "rb") as f:
+                fallback = f.read()
+        variants = {mimetype: fallback, "image/webp": _encode_image(image, "WEBP", quality)}
+        if features.check("avif"):
+            variants["image/avif"] = _encode_image(image, "AVIF", quality)
+    return variants
+
+
+def _compress(data: bytes) -> Dict[str, bytes]:
+    """Precompressed encodings of a text asset, Content-Encoding -> bytes."""
+    encodings = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        encodings["br"] = brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return encodings
+
+
+def build_assets(
+    source_dir: str = ASSET_DIR,
+    build_dir: str = BUILD_DIR,
+    max_width: int = MAX_IMAGE_WIDTH,
+    quality: int = WEBP_QUALITY
+) -> Dict[str, Any]:
+    """
+    Build fingerprinted, recompressed copies of the images, CSS and JS in
+    source_dir and write them with their manifest to build_dir.
+
+    Args:
+        source_dir: Directory of the source assets (not searched recursively)
+        build_dir: Output directory, replaced as a whole
+        max_width: Images wider than this are scaled down
+        quality: WebP/AVIF quality (0-100)
+
+    Returns:
+        The manifest: source name -> {"file", "type", "variants", "encodings", "bytes"}
+    """
+    staging = build_dir + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    names = sorted(
+        name for name in os.listdir(source_dir)
+        if os.path.isfile(os.path.join(source_dir, name))
+        and os.path.splitext(name)[1].lower() in {**IMAGE_TYPES, **TEXT_TYPES}
+    )
+
+    def write(name: str, data: bytes) -> None:
+        with open(os.path.join(staging, name), "wb") as f:
+            f.write(data)
+
+    manifest: Dict[str, Any] = {}
+    # Images first, so the CSS can refer to their built names
+    for name in (name for name in names if os.path.splitext(name)[1].lower() in IMAGE_TYPES):
+        stem, ext = os.path.splitext(name)
+        variants = _build_image(os.path.join(source_dir, name), max_width, quality)
+        mimetype, fallback = next(iter(variants.items()))
+        digest = _fingerprint(fallback)
+        entry: Dict[str, Any] = {"file": f"{stem}.{digest}{ext.lower()}", "type": mimetype, "variants": {}, "encodings": {}}
+        entry["bytes"] = {"source": os.path.getsize(os.path.join(source_dir, name)), mimetype: len(fallback)}
+        write(entry["file"], fallback)
+        for variant_type, data in list(variants.items())[1:]:
+            if len(data) >= len(fallback):
+                continue
+            variant_file = f"{stem}.{digest}.{variant_type.split('/')[1]}"
+            write(variant_file, data)
+            entry["variants"][variant_type] = variant_file
+            entry["bytes"][variant_type] = len(data)
+        manifest[name] = entry
+
+    for name in (name for name in names if os.path.splitext(name)[1].lower() in TEXT_TYPES):
+        stem, ext = os.path.splitext(name)
+        with open(os.path.join(source_dir, name), "rb") as f:
+            data = f.read()
+        if ext.lower() == ".css":
+            data = _CSS_STATIC_URL.sub(
+                lambda m: f"url({m.group(1)}/assets/{manifest[m.group(2)]['file']}{m.group(1)})" if m.group(2) in manifest else m.group(0),
+                data.decode("utf-8")
+            ).encode("utf-8")
+        entry = {"file": f"{stem}.{_fingerprint(data)}{ext.lower()}", "type": TEXT_TYPES[ext.lower()], "variants": {}, "encodings": {}}
+        entry["bytes"] = {"source": os.path.getsize(os.path.join(source_dir, name)), "identity": len(data)}
+        write(entry["file"], data)
+        for encoding, compressed in _compress(data).items():
+            encoded_file = f"{entry['file']}.{'gz' if encoding == 'gzip' else encoding}"
+            write(encoded_file, compressed)
+            entry["encodings"][encoding] = encoded_file
+            entry["bytes"][encoding] = len(compressed)
+        manifest[name] = entry
+
+    with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.replace(staging, build_dir)
+
+    source_bytes = sum(entry["bytes"]["source"] for entry in manifest.values())
+    smallest_bytes = sum(min(entry["bytes"][key] for key in entry["bytes"] if key != "source") for entry in manifest.values())
+    logger.info(
+        f"Built {len(manifest)} assets into {build_dir}: {source_bytes / 2**20:.1f} MB of sources, "
+        f"{smallest_bytes / 2**20:.1f} MB for a browser taking the smallest variants"
+    )
+    return manifest
+
+
+class AssetManifest:
+    """
+    The built assets of a manifest, with the lookups the /assets/ route and
+    the asset_url template helper need.
+    """
+    def __init__(self, build_dir: str = BUILD_DIR):
+        self.build_dir = build_dir
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        path = os.path.join(build_dir, MANIFEST_FILE)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+            logger.info(f"Serving {len(self.entries)} built assets from {build_dir}")
+        self._by_file = {entry["file"]: entry for entry in self.entries.values()}
+
+    def url(self, name: str) -> Optional[str]:
+        """URL of the built copy of a source asset, or None if it was not built."""
+        entry = self.entries.get(name)
+        return f"/assets/{entry['file']}" if entry else None
+
+    def resolve(self, filename: str, accepted_types: Tuple[str, ...], accepted_encodings: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        """
+        The file to send for a request of a built asset.
+
+        Args:
+            filename: Fingerprinted name from the URL
+            accepted_types: Content types the client explicitly accepts
+            accepted_encodings: Content encodings the client explicitly accepts
+
+        Returns:
+            {"path", "type", "encoding", "etag", "vary"}, or None if the file is not in the manifest
+        """
+        entry = self._by_file.get(filename)
+        if entry is None:
+            return None
+        file, mimetype, encoding, vary = entry["file"], entry["type"], None, None
+        if entry["variants"]:
+            vary = "Accept"
+            # The smallest format the browser accepts (AVIF is not always smaller than WebP)
+            accepted = [variant_type for variant_type in entry["variants"] if variant_type in accepted_types]
+            if accepted:
+                mimetype = min(accepted, key=lambda variant_type: entry["bytes"][variant_type])
+                file = entry["variants"][mimetype]
+        if entry["encodings"]:
+            vary = "Accept-Encoding"
+            for candidate in ("br", "gzip"):
+                if candidate in entry["encodings"] and candidate in accepted_encodings:
+                    file, encoding = entry["encodings"][candidate], candidate
+                    break
+        return {
+            "path": os.path.join(self.build_dir, file),
+            "type": mimetype,
+            "encoding": encoding,
+            # The name holds the content hash, and differs per variant and encoding
+            "etag": file,
+            "vary": vary
+        }
+
+
+_etags: Dict[Tuple[str, int, int], str] = {}
+_etags_lock = threading.Lock()
+
+
+def content_etag(path: str) -> str:
+    """
+    ETag from a hash of the file's contents, computed once per file version.
+    Unlike the default (modification time and size), it is the same on every
+    host and worker serving a copy of the file.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    etag = _etags.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        etag = digest.hexdigest()[:32]
+        with _etags_lock:
+            _etags[key] = etag
+    return etag
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build fingerprinted, compressed static assets")
+    parser.add_argument("--source-dir", default=ASSET_DIR, help="Directory of the source assets")
+    parser.add_argument("--build-dir", default=BUILD_DIR, help="Output directory")
+    parser.add_argument("--max-width", type=int, default=MAX_IMAGE_WIDTH, help="Scale wider images down to this width")
+    parser.add_argument("--quality", type=int, default=WEBP_QUALITY, help="WebP/AVIF quality (0-100)")
+    args = parser.parse_args()
+
+    built = build_assets(args.source_dir, args.build_dir, args.max_width, args.quality)
+    for source_name, built_entry in built.items():
+        sizes = ", ".join(f"{key} {size / 1024:.0f} KB" for key, size in built_entry["bytes"].items())
+        print(f"{source_name} -> {built_entry['file']}: {sizes}")
@@ -0,0 +1,378 @@
+"""
+Offline benchmark suite for the retrieval store and the /query pipeline.
+
+Everything runs without network access: chunks come from a synthetic corpus,
+embeddings from a deterministic hashing embedder (or the real MiniLM model if
+it is cached locally), and the LLM is the local fake (LLM_BACKEND=fake).
+
+Measured:
+- ingestion: add_chunks throughput (embedding, writing, index builds)
+- search:    similarity_search p50/p95/p99 latency and QPS per mode and k
+- memory:    resident memory after loading and searching, store size on disk
+- query:     /query end-to-end latency, QPS and status codes, with N client threads
+
+Results are written as JSON; --compare flags regressions against an earlier run.
+
+Usage:
+    python benchmark.py --chunks 10000 --output bench.json
+    python benchmark.py --chunks 100000 --modes dense,hybrid --k 1,3,10,50
+    python benchmark.py --chunks 10000 --compare bench.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import logging
+import platform
+import datetime
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Words of the synthetic corpus: common English filler plus Gita vocabulary,
+# drawn with a Zipf-like distribution so term frequencies look like real text
+_VOCABULARY = (
+    "the of and to in that is for with as his by on not this be from are one who all which he it was "
+    "action actions mind self soul duty wisdom devotion yoga karma dharma knowledge senses desire "
+    "attachment renunciation sacrifice meditation peace liberation nature lord supreme eternal body "
+    "krishna arjuna kurukshetra pandava kaurava bhishma drona sanjaya dhritarashtra sthitaprajna "
+    "sattva rajas tamas guna brahman atman moksha bhakti jnana sannyasa prakriti purusha"
+).split()
+_QUESTION_TEMPLATES = [
+    "What does Krishna teach about {0} and {1}?",
+    "How should one practice {0}?",
+    "Explain the relation between {0} and {1}",
+    "Why does Arjuna hesitate about {0}?",
+]
+
+
+class HashingEmbeddings:
+    """
+    Deterministic bag-of-words embedder: each token is hashed to a signed
+    bucket of a dim-dimensional vector. Texts sharing words get similar
+    vectors, which is enough to exercise the store without a model download.
+    """
+    model_name = "benchmark-hashing"
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in text.lower().split():
+            h = zlib.crc32(token.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return np.stack([self._embed(text) for text in texts]).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text).tolist()
+
+
+def synthetic_corpus(n: int, seed: int = 0, words_per_chunk: int = 80) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Generate n chunk texts shaped like the ingested Gita: a verse reference
+    followed by words drawn from the corpus vocabulary.
+
+    Yields:
+        (text, metadata) tuples with chunk_index, chapter and verses metadata
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, len(_VOCABULARY) + 1)
+    weights /= weights.sum()
+    words = np.array(_VOCABULARY)
+    block = 10000
+    for start in range(0, n, block):
+        count = min(block, n - start)
+        picks = words[rng.choice(len(words), size=(count, words_per_chunk), p=weights)]
+        for offset, row in enumerate(picks):
+            i = start + offset
+            chapter, verse = i // 78 % 18 + 1, i % 78 + 1
+            text = f"{chapter}.{verse} " + " ".join(row) + f" (passage {i})"
+            yield text, {"source": "Synthetic corpus", "chunk_index": i, "chapter": chapter, "verses": [f"{chapter}.{verse}"]}
+
+
+def synthetic_queries(n: int, seed: int = 1) -> List[str]:
+    """Questions built from the corpus vocabulary (unique, so response caches don't hit)."""
+    rng = np.random.default_rng(seed)
+    topics = _VOCABULARY[35:]
+    return [
+        _QUESTION_TEMPLATES[i % len(_QUESTION_TEMPLATES)].format(*rng.choice(topics, 2, replace=False)) + f" ({i})"
+        for i in range(n)
+    ]
+
+
+def latency_stats(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    """p50/p95/p99/mean latency in milliseconds and throughput of a run."""
+    ms = np.asarray(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+        "qps": len(latencies) / elapsed if elapsed > 0 else 0.0
+    }
+
+
+def _rss_mb() -> Optional[float]:
+    """Current resident memory of this process in MB (Linux), else peak RSS where available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 * 1024 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 * 1024 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _dir_size_mb(path: str) -> float:
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    ) / (1024 * 1024)
+
+
+def create_embedder(name: str) -> Any:
+    """The hashing embedder, or the real model for --embedder minilm (must be cached locally)."""
+    if name == "hashing":
+        return HashingEmbeddings()
+    from chunks import EMBEDDING_MODEL_NAME
+    from embedding_models import get_embedding_model
+    return get_embedding_model(EMBEDDING_MODEL_NAME)
+
+
+def bench_ingestion(storage_dir: str, chunks: int, embedder: Any, batch_size: int, seed: int) -> Dict[str, Any]:
+    """Ingest a synthetic corpus into an empty store and measure throughput."""
+    from chunks import LocalChunkStorage
+    started = time.perf_counter()
+    texts, metadata = [], []
+    for text, chunk_metadata in synthetic_corpus(chunks, seed):
+        texts.append(text)
+        metadata.append(chunk_metadata)
+    generate_seconds = time.perf_counter() - started
+
+    storage = LocalChunkStorage(storage_dir, embedder)
+    stats = storage.add_chunks(texts, metadata, batch_size=batch_size)
+    return {
+        "chunks": stats["chunks"],
+        "generate_seconds": generate_seconds,
+        "seconds": stats["seconds"],
+        "chunks_per_sec": stats["chunks_per_sec"]
+    }
+
+
+def bench_search(storage: Any, queries: List[str], ks: List[int], modes: List[str]) -> List[Dict[str, Any]]:
+    """Measure similarity_search latency per mode and k (one warm-up query each)."""
+    results = []
+    for mode in modes:
+        for k in ks:
+            storage.similarity_search(queries[0], k=k, mode=mode)
+            latencies = []
+            started = time.perf_counter()
+            for query in queries:
+                query_started = time.perf_counter()
+                storage.similarity_search(query, k=k, mode=mode)
+                latencies.append(time.perf_counter() - query_started)
+            entry = {"mode": mode, "k": k, **latency_stats(latencies, time.perf_counter() - started)}
+            logger.info(f"search {mode} k={k}: p50 {entry['p50_ms']:.2f} ms, p99 {entry['p99_ms']:.2f} ms, {entry['qps']:.0f} QPS")
+            results.append(entry)
+    return results
+
+
+def bench_query(storage: Any, queries: List[str], threads: int, llm_latency: float) -> Dict[str, Any]:
+    """
+    Drive /query end-to-end through the Flask app with the fake LLM and the
+    benchmark store, from several client threads.
+    """
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = str(llm_latency)
+    import app as app_module
+    from cache import CachedEmbeddings, LRUCache
+
+    if not isinstance(storage.embedding_model, CachedEmbeddings):
+        storage.embedding_model = CachedEmbeddings(storage.embedding_model, LRUCache(max_entries=app_module.EMBEDDING_CACHE_SIZE))
+    app_module.use_storage(storage)
+    flask_app = app_module.create_app(warm_up=False)
+    app_module.warm_up()
+
+    local = threading.local()
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    routes: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def send(query: str) -> None:
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = flask_app.test_client()
+        started = time.perf_counter()
+        response = client.post("/query", json={"query": query})
+        elapsed = time.perf_counter() - started
+        body = response.get_json(silent=True) or {}
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            route = body.get("route", "agent")
+            routes[route] = routes.get(route, 0) + 1
+
+    # Mix in the fast paths: arithmetic and verse references
+    mixed = [
+        query if i % 10 else ("12 * 7" if i % 20 else "what does BG 2.47 say")
+        for i, query in enumerate(queries)
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(send, mixed))
+    elapsed = time.perf_counter() - started
+
+    # Repeat a few queries to measure response-cache hits
+    cached_latencies = []
+    client = flask_app.test_client()
+    for query in mixed[:min(50, len(mixed))]:
+        query_started = time.perf_counter()
+        client.post("/query", json={"query": query})
+        cached_latencies.append(time.perf_counter() - query_started)
+
+    return {
+        "threads": threads,
+        "llm_latency_s": llm_latency,
+        **latency_stats(latencies, elapsed),
+        "statuses": statuses,
+        "routes": routes,
+        "cached": latency_stats(cached_latencies, sum(cached_latencies))
+    }
+
+
+# Metrics compared by --compare, and whether higher values are better
+_COMPARED = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "qps": True, "chunks_per_sec": True}
+
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    List the metrics that got worse than the baseline by more than tolerance
+    (a fraction, e.g. 0.2 for 20%).
+    """
+    regressions = []
+
+    def check(name: str, now: Dict[str, Any], before: Dict[str, Any]) -> None:
+        for metric, higher_is_better in _COMPARED.items():
+            if metric not in now or metric not in before or not before[metric]:
+                continue
+            change = (now[metric] - before[metric]) / before[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name} {metric}: {before[metric]:.3f} -> {now[metric]:.3f} ({change:+.0%})")
+
+    if "ingestion" in current and "ingestion" in baseline:
+        check("ingestion", current["ingestion"], baseline["ingestion"])
+    baseline_search = {(entry["mode"], entry["k"]): entry for entry in baseline.get("search", [])}
+    for entry in current.get("search", []):
+        if (entry["mode"], entry["k"]) in baseline_search:
+            check(f"search {entry['mode']} k={entry['k']}", entry, baseline_search[(entry["mode"], entry["k"])])
+    if "query" in current and "query" in baseline:
+        check("query", current["query"], baseline["query"])
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Offline retrieval and /query benchmarks")
+    parser.add_argument("--chunks", type=int, default=10000, help="Synthetic corpus size (1k to 1M chunks)")
+    parser.add_argument("--storage-dir", help="Keep the benchmark store here (default: a temporary directory)")
+    parser.add_argument("--reuse", action="store_true", help="Reuse an existing store in --storage-dir instead of ingesting")
+    parser.add_argument("--embedder", default="hashing", choices=["hashing", "minilm"], help="Embedding model")
+    parser.add_argument("--batch-size", type=int, default=256, help="Chunks embedded per model call")
+    parser.add_argument("--modes", default="dense,lexical,hybrid", help="Comma-separated search modes")
+    parser.add_argument("--k", default="1,3,10,50", help="Comma-separated values of k")
+    parser.add_argument("--queries", type=int, default=500, help="Queries per search measurement")
+    parser.add_argument("--query-requests", type=int, default=200, help="/query requests (0 to skip the end-to-end run)")
+    parser.add_argument("--threads", type=int, default=4, help="Client threads for /query")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per fake LLM call")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus random seed")
+    parser.add_argument("--output", help="Write results JSON here (default: stdout)")
+    parser.add_argument("--compare", help="Baseline results JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    from chunks import LocalChunkStorage
+    storage_dir = args.storage_dir or tempfile.mkdtemp(prefix="gita-bench-")
+    embedder = create_embedder(args.embedder)
+    results: Dict[str, Any] = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args)
+        }
+    }
+    try:
+        if not (args.reuse and os.path.exists(os.path.join(storage_dir, "index.json"))):
+            if os.path.exists(storage_dir):
+                shutil.rmtree(storage_dir)
+            results["ingestion"] = bench_ingestion(storage_dir, args.chunks, embedder, args.batch_size, args.seed)
+
+        rss_before = _rss_mb()
+        storage = LocalChunkStorage(storage_dir, embedder)
+        queries = synthetic_queries(args.queries)
+        results["search"] = bench_search(
+            storage, queries, [int(k) for k in args.k.split(",")], args.modes.split(",")
+        )
+        rss_after = _rss_mb()
+        embeddings = storage.get_embeddings()
+        results["memory"] = {
+            "store_mb": _dir_size_mb(storage_dir),
+            "embeddings_mb": embeddings.nbytes / (1024 * 1024),
+            "rss_before_load_mb": rss_before,
+            "rss_after_search_mb": rss_after,
+            "peak_rss_mb": _peak_rss_mb()
+        }
+
+        if args.query_requests:
+            results["query"] = bench_query(
+                storage, synthetic_queries(args.query_requests, seed=args.seed + 2), args.threads, args.llm_latency
+            )
+    finally:
+        if not args.storage_dir:
+            shutil.rmtree(storage_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        logger.info(f"Wrote results to {args.output}")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.compare}", file=sys.stderr)
@@ -0,0 +1,278 @@
+"""
+Module with bounded in-memory caches for the query path: an LRU/TTL cache for
+query embeddings and a response cache keyed on the normalized query, with an
+optional semantic mode that reuses answers for near-identical questions, and
+a store of per-session conversation state for follow-up questions.
+"""
+import re
+import sys
+import time
+import secrets
+import threading
+import logging
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _estimate_size(value: Any) -> int:
+    """Rough estimate of the memory held by a cached value, in bytes."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_size(k) + _estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for exact-match caching: case, punctuation and spacing are ignored."""
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by entry count and total
+    estimated size, with an optional time-to-live per entry.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Args:
+            max_entries: Maximum number of entries
+            max_bytes: Optional maximum total estimated size of the entries
+            ttl: Optional lifetime of an entry in seconds
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[Any, Tuple[Any, float, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss or expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Any, value: Any) -> None:
+        """Store a value, evicting the least recently used entries if over the bounds."""
+        size = _estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic(), size)
+            self.bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def touch(self, key: Any) -> None:
+        """Mark an entry as recently used without counting a lookup."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        """Snapshot of the live (key, value) pairs, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value) for key, (value, stored, _) in self._entries.items()
+                if self.ttl is None or now - stored <= self.ttl
+            ]
+
+    def clear(self) -> None:
+        """Drop all entries (statistics are kept)."""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key: Any) -> None:
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counts and memory use of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+
+class CachedEmbeddings:
+    """
+    Wraps an embedding model so repeated queries skip the forward pass.
+    Everything except embed_query is passed through to the wrapped model.
+    """
+    def __init__(self, model: Any, cache: LRUCache):
+        self.model = model
+        self.cache = cache
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = np.asarray(self.model.embed_query(text), dtype=np.float32)
+            self.cache.put(text, vector)
+        return vector.tolist()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.model, name)
+
+
+class ResponseCache:
+    """
+    Cache of complete /query responses keyed on the normalized query.
+
+    In semantic mode a miss falls back to comparing the query embedding with
+    the embeddings of cached queries, and a cached answer is reused when the
+    cosine similarity is at least the threshold.
+    """
+    def __init__(
+        self,
+        max_entries: int = 512,
+        max_bytes: Optional[int] = 16 * 1024 * 1024,
+        ttl: Optional[float] = 24 * 3600,
+        semantic_threshold: Optional[float] = None,
+        embedding_model: Any = None
+    ):
+        """
+        Args:
+            max_entries: Maximum number of cached responses
+            max_bytes: Maximum total estimated size of cached responses
+            ttl: Lifetime of a cached response in seconds
+            semantic_threshold: Cosine similarity needed for a semantic hit
+                (None disables semantic matching)
+            embedding_model: Model used to embed queries in semantic mode
+        """
+        self.cache = LRUCache(max_entries, max_bytes, ttl)
+        self.semantic_threshold = semantic_threshold
+        self.embedding_model = embedding_model
+        self.semantic_hits = 0
+
+    @property
+    def semantic(self) -> bool:
+        return self.semantic_threshold is not None and self.embedding_model is not None
+
+    def _embed(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embedding_model.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, query: str) -> Optional[Dict[str, Any]]:
+        """Return the cached response for a query, or None."""
+        key = normalize_query(query)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry["response"]
+        if not self.semantic:
+            return None
+
+        cached = [(k, v) for k, v in self.cache.items() if v.get("embedding") is not None]
+        if not cached:
+            return None
+        query_embedding = self._embed(query)
+        scores = np.stack([v["embedding"] for _, v in cached]) @ query_embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.semantic_threshold:
+            return None
+        self.semantic_hits += 1
+        logger.info(f"Semantic cache hit ({scores[best]:.3f}) for '{query}' via '{cached[best][0]}'")
+        self.cache.touch(cached[best][0])
+        return cached[best][1]["response"]
+
+    def put(self, query: str, response: Dict[str, Any]) -> None:
+        """Cache the response for a query."""
+        entry = {"response": response, "embedding": self._embed(query) if self.semantic else None}
+        self.cache.put(normalize_query(query), entry)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        stats["semantic_threshold"] = self.semantic_threshold
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
+
+
+class SessionStore:
+    """
+    Conversation state of each session for follow-up questions: for each of
+    its last turns, the question, the ids of the chunks the answer was based
+    on, the query embedding and a short summary of the answer.
+
+    Sessions expire ttl seconds after their last turn, and the least recently
+    used are evicted beyond max_sessions. A session keeps at most max_turns
+    turns and drops its oldest turns beyond max_session_bytes.
+    """
+    def __init__(
+        self,
+        max_sessions: int = 1024,
+        ttl: Optional[float] = 1800,
+        max_turns: int = 5,
+        max_session_bytes: int = 16 * 1024
+    ):
+        """
+        Args:
+            max_sessions: Maximum number of sessions kept
+            ttl: Seconds a session is kept after its last turn
+            max_turns: Turns kept per session
+            max_session_bytes: Maximum estimated size of a session's turns
+        """
+        self.sessions = LRUCache(max_entries=max_sessions, ttl=ttl)
+        self.max_turns = max_turns
+        self.max_session_bytes = max_session_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id() -> str:
+        return secrets.token_urlsafe(16)
+
+    def get_turn(self, session_id: str, turn_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """A turn of a session (the last one by default), or None if it has expired."""
+        turns = self.sessions.get(session_id) or []
+        if turn_id is None:
+            return turns[-1] if turns else None
+        return next((turn for turn in turns if turn["turn"] == turn_id), None)
+
+    def add_turn(self, session_id: str, turn: Dict[str, Any]) -> int:
+        """Append a turn to a session (starting it if needed); returns the turn's number."""
+        with self._lock:
+            turns = list(self.sessions.get(session_id) or [])
+            turn_id = turns[-1]["turn"] + 1 if turns else 1
+            turns.append(dict(turn, turn=turn_id))
+            turns = turns[-self.max_turns:]
+            while len(turns) > 1 and _estimate_size(turns) > self.max_session_bytes:
+                turns.pop(0)
+            self.sessions.put(session_id, turns)
+        return turn_id
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.sessions.stats()
+        stats["max_turns"] = self.max_turns
+        stats["max_session_bytes"] = self.max_session_bytes
+        return stats
@@ -2,194 +2,1472 @@
 Module for processing the Bhagavad Gita PDF and saving chunks to local storage.
 """
 import os
+import re
 import json
 import hashlib
-from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
+import queue
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from ann_index import INDEX_BACKENDS, VectorIndex, create_index, load_index
+from lexical_index import BM25Index, load_lexical_index, reciprocal_rank_fusion
+from metrics import span
+from embedding_models import get_embedding_model
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# On-disk layout of a storage directory (format version 2):
+#   index.json        - format version, per-row chunk id + metadata, store metadata
+#   embeddings.npy    - (N, dim) float32 matrix of L2-normalized embeddings
+#   texts.bin         - UTF-8 chunk texts packed back to back
+#   text_offsets.npy  - (N + 1,) int64 byte offsets of each text in texts.bin
+#   lexical_bm25.npz  - BM25 inverted index over the chunk texts (see lexical_index.py)
+#   verses.json       - verse table: "chapter.verse" -> verse text, pages and ids
+#                       of the chunks covering it, for direct verse lookups
+# Row i of every file describes the same chunk. The .npy/.bin files are opened
+# with memory mapping, so worker processes on one host share them via the page cache.
+# Version 1 stored one chunks/<md5>.json file per chunk with a JSON float list.
+STORAGE_FORMAT_VERSION = 2
+EMBEDDINGS_FILE = "embeddings.npy"
+TEXTS_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+VERSES_FILE = "verses.json"
+
+# Retrieval modes of similarity_search: "dense" embedding search, "lexical"
+# BM25 keyword search (no embedding model needed), or "hybrid" reciprocal rank
+# fusion of both over the top HYBRID_CANDIDATES rows of each
+SEARCH_MODES = ("dense", "lexical", "hybrid")
+HYBRID_CANDIDATES = 50
+
+# Ingestion settings. Together with a hash of the source PDF they form the
+# ingestion fingerprint stored in index.json; a change to any of them means
+# the stored chunks are out of date.
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+# Version of the page-aware splitting in split_pages; bumping it re-syncs
+# stored chunks (unchanged texts keep their embeddings)
+SPLITTER_VERSION = 3
+# "fixed": CHUNK_SIZE character chunks; "verse": one chunk per verse section,
+# with sections longer than VERSE_CHUNK_MAX_SIZE split into CHUNK_SIZE pieces
+CHUNKING = "fixed"
+CHUNKING_MODES = ("fixed", "verse")
+VERSE_CHUNK_MAX_SIZE = 2 * CHUNK_SIZE
+
+# Chapter and verse markers in the extracted text: "Chapter 2" / "CHAPTER II"
+# headings, "2.47" style references, and "Text 47" / "Verse 47" within a chapter
+_CHAPTER_PATTERN = re.compile(r"^\s*chapter\s+(\d{1,2}|[ivxl]+)\b", re.IGNORECASE | re.MULTILINE)
+_CHAPTER_VERSE_PATTERN = re.compile(r"(?<![\d.])(1[0-8]|[1-9])\.([1-9]\d?)(?![\d.])")
+_VERSE_PATTERN = re.compile(r"\b(?:text|verse)s?\s+(\d{1,2})\b", re.IGNORECASE)
+_ROMAN_VALUES = {"i": 1, "v": 5, "x": 10, "l": 50}
+_MAX_VERSE_GAP = 10
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize vectors along the last axis (zero vectors stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+class _StoreWriter:
+    """
+    Incrementally writes the embeddings, text blob and offsets files of a
+    storage directory. Rows are appended in order; files are written to
+    temporary names and only swapped in by commit(), so readers never see a
+    half-written store.
+    """
+    def __init__(self, storage_dir: str, total_rows: int):
+        self.storage_dir = storage_dir
+        self.total_rows = total_rows
+        self.rows_written = 0
+        self.dim = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._offsets = np.zeros(total_rows + 1, dtype=np.int64)
+        self._embeddings_tmp = os.path.join(storage_dir, EMBEDDINGS_FILE + ".tmp")
+        self._texts_tmp = os.path.join(storage_dir, TEXTS_FILE + ".tmp")
+        self._offsets_tmp = os.path.join(storage_dir, TEXT_OFFSETS_FILE + ".tmp")
+        self._texts = open(self._texts_tmp, "wb")
+
+    def append(self, vectors: np.ndarray, texts: List[bytes]) -> None:
+        """Append a block of normalized embeddings and their encoded texts."""
+        if len(vectors) == 0:
+            return
+        if self._matrix is None:
+            # The embedding dimension is only known once the first block arrives
+            self.dim = int(vectors.shape[1])
+            self._matrix = np.lib.format.open_memmap(
+                self._embeddings_tmp, mode="w+", dtype=np.float32, shape=(self.total_rows, self.dim)
+            )
+        start = self.rows_written
+        self._matrix[start:start + len(vectors)] = vectors
+        for i, data in enumerate(texts):
+            self._texts.write(data)
+            self._offsets[start + i + 1] = self._offsets[start + i] + len(data)
+        self.rows_written += len(vectors)
+
+    def commit(self) -> None:
+        """Flush all files and swap them in place of the current store."""
+        if self.rows_written != self.total_rows:
+            raise ValueError(f"Expected {self.total_rows} rows but {self.rows_written} were written")
+        self._texts.close()
+        if self._matrix is None:
+            np.save(self._embeddings_tmp, np.zeros((0, 0), dtype=np.float32))
+        else:
+            self._matrix.flush()
+            self._matrix = None
+        with open(self._offsets_tmp, "wb") as f:
+            np.save(f, self._offsets)
+        
+        os.replace(self._embeddings_tmp, os.path.join(self.storage_dir, EMBEDDINGS_FILE))
+        os.replace(self._texts_tmp, os.path.join(self.storage_dir, TEXTS_FILE))
+        os.replace(self._offsets_tmp, os.path.join(self.storage_dir, TEXT_OFFSETS_FILE))
+
+    def abort(self) -> None:
+        """Discard the temporary files."""
+        self._texts.close()
+        self._matrix = None
+        for path in (self._embeddings_tmp, self._texts_tmp, self._offsets_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# Embedding model of an ingestion worker process, created by _init_embedding_worker
+_worker_model: Any = None
+
+
+def _init_embedding_worker(model_name: str, threads: int) -> None:
+    """Load the embedding model once in a process pool worker."""
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    # A worker forked from a process that already loaded the model reuses it
+    _worker_model = get_embedding_model(model_name)
+
+
+def _embed_in_worker(texts: List[str]) -> np.ndarray:
+    """Embed one batch of texts in a process pool worker."""
+    return np.asarray(_worker_model.embed_documents(texts), dtype=np.float32)
+
+
+def _embed_batch(model: Any, texts: List[str]) -> np.ndarray:
+    """Embed a batch of texts, using the model's batched API when it has one."""
+    if hasattr(model, "embed_documents"):
+        return np.asarray(model.embed_documents(texts), dtype=np.float32)
+    return np.asarray([model.embed_query(text) for text in texts], dtype=np.float32)
+
+
+def migrate_storage(
+    storage_dir: str,
+    remove_legacy: bool = False,
+    embedding_model: str = EMBEDDING_MODEL_NAME
+) -> int:
+    """
+    Convert a version 1 storage directory (one JSON file per chunk) to the
+    current binary format. Chunk files that are missing are dropped from the index.
+    
+    Args:
+        storage_dir: Directory containing index.json and chunks/
+        remove_legacy: Delete the chunks/ directory after a successful migration
+        embedding_model: Model the stored embeddings were made with, recorded
+            so that the next sync_chunks keeps them (version 1 stores did not
+            record it; they were all embedded with EMBEDDING_MODEL_NAME)
+        
+    Returns:
+        Number of chunks migrated
+    """
+    index_file = os.path.join(storage_dir, "index.json")
+    chunks_dir = os.path.join(storage_dir, "chunks")
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    
+    if index.get("format_version", 1) >= STORAGE_FORMAT_VERSION:
+        logger.info(f"{storage_dir} is already in storage format {index['format_version']}")
+        return len(index["chunks"])
+    
+    logger.info(f"Migrating {storage_dir} to storage format {STORAGE_FORMAT_VERSION}")
+    entries = []
+    vectors = []
+    texts = []
+    for chunk_info in index["chunks"]:
+        chunk_file = os.path.join(chunks_dir, f"{chunk_info['id']}.json")
+        if not os.path.exists(chunk_file):
+            logger.warning(f"Skipping missing chunk file {chunk_file}")
+            continue
+        with open(chunk_file, 'r', encoding='utf-8') as f:
+            chunk_data = json.load(f)
+        entries.append({"id": chunk_data["id"], "metadata": chunk_data["metadata"]})
+        vectors.append(chunk_data["embedding"])
+        texts.append(chunk_data["text"].encode('utf-8'))
+    
+    writer = _StoreWriter(storage_dir, len(entries))
+    if vectors:
+        writer.append(_normalize(np.asarray(vectors, dtype=np.float32)), texts)
+    writer.commit()
+    
+    index["format_version"] = STORAGE_FORMAT_VERSION
+    index["chunks"] = entries
+    index["metadata"]["chunk_count"] = len(entries)
+    index["metadata"]["embedding_dim"] = writer.dim
+    index["metadata"].setdefault("embedding_model", embedding_model)
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    
+    if remove_legacy and os.path.isdir(chunks_dir):
+        shutil.rmtree(chunks_dir)
+        logger.info(f"Removed legacy chunk files in {chunks_dir}")
+    
+    logger.info(f"Migrated {len(entries)} chunks to storage format {STORAGE_FORMAT_VERSION}")
+    return len(entries)
+
+
+def _log_embedding_progress(done: int, batches: int, batch_size: int, total: int, started: float) -> None:
+    """Log chunks embedded so far and the rate, every 10 batches and after the last one."""
+    if done % 10 == 0 or done == batches:
+        embedded = min(done * batch_size, total)
+        rate = embedded / (time.perf_counter() - started)
+        logger.info(f"Embedded {embedded}/{total} chunks ({rate:.1f} chunks/sec)")
+
+
 class LocalChunkStorage:
     """
     Class to handle storage and retrieval of text chunks and their embeddings
     in local file system instead of using a vector database like Pinecone.
     """
-    def __init__(self, storage_dir: str, embedding_model: Any):
+    def __init__(
+        self,
+        storage_dir: str,
+        embedding_model: Any,
+        search_params: Optional[Dict[str, Any]] = None,
+        search_mode: str = "dense"
+    ):
         """
         Initialize with storage directory and embedding model.
         
         Args:
             storage_dir: Directory to store chunks and embeddings
-            embedding_model: Model to generate embeddings
+            embedding_model: Model to generate embeddings (may be None for
+                lexical search only)
+            search_params: Optional query-time knobs of the nearest-neighbour
+                index (for example {"nprobe": 16} or {"ef_search": 128})
+            search_mode: Default retrieval mode of similarity_search, see SEARCH_MODES
         """
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{search_mode}', expected one of {SEARCH_MODES}")
         self.storage_dir = storage_dir
+        self.search_mode = search_mode
         self.embedding_model = embedding_model
+        self.search_params = search_params or {}
         self.index_file = os.path.join(storage_dir, "index.json")
-        self.chunks_dir = os.path.join(storage_dir, "chunks")
+        self.embeddings_file = os.path.join(storage_dir, EMBEDDINGS_FILE)
+        self.texts_file = os.path.join(storage_dir, TEXTS_FILE)
+        self.offsets_file = os.path.join(storage_dir, TEXT_OFFSETS_FILE)
         
         # Create directories if they don't exist
         os.makedirs(self.storage_dir, exist_ok=True)
-        os.makedirs(self.chunks_dir, exist_ok=True)
         
-        # Load or create index
+        # Load or create index, upgrading stores written in the old per-chunk JSON format
         self.index = self._load_index()
+        if self.index.get("format_version", 1) < STORAGE_FORMAT_VERSION:
+            migrate_storage(self.storage_dir)
+            self.index = self._load_index()
+        
+        # Memory-mapped search table, opened lazily on first search: one
+        # pre-normalized float32 row per chunk plus the packed chunk texts.
+        self._embeddings: Optional[np.ndarray] = None
+        self._texts: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+        self._ann: Optional[VectorIndex] = None
+        # BM25 index, loaded (or built) on the first lexical or hybrid search
+        self._lexical: Optional[BM25Index] = None
+        # Verse table, loaded on the first verse lookup
+        self._verses: Optional[Dict[str, Dict[str, Any]]] = None
+        # Chunk id -> row, built on the first lookup by id
+        self._rows_by_id: Optional[Dict[str, int]] = None
 
     def _load_index(self) -> Dict[str, Any]:
         """Load the index file or create a new one if it doesn't exist."""
         if os.path.exists(self.index_file):
             with open(self.index_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        return {"chunks": [], "metadata": {"chunk_count": 0, "source": "The Bhagavad Gita"}}
+        return {
+            "format_version": STORAGE_FORMAT_VERSION,
+            "chunks": [],
+            "metadata": {"chunk_count": 0, "source": "The Bhagavad Gita"}
+        }
 
     def _save_index(self) -> None:
         """Save the index file."""
         with open(self.index_file, 'w', encoding='utf-8') as f:
             json.dump(self.index, f, indent=2)
 
+    def _open_store(self) -> None:
+        """Memory-map the embeddings matrix and text blob of the store."""
+        if not self.index["chunks"] or not os.path.exists(self.embeddings_file):
+            self._embeddings = np.zeros((0, 0), dtype=np.float32)
+            self._texts = np.zeros(0, dtype=np.uint8)
+            self._offsets = np.zeros(1, dtype=np.int64)
+            self._ann = None
+            return
+        
+        self._embeddings = np.load(self.embeddings_file, mmap_mode='r')
+        self._offsets = np.load(self.offsets_file)
+        if os.path.getsize(self.texts_file) > 0:
+            self._texts = np.memmap(self.texts_file, dtype=np.uint8, mode='r')
+        else:
+            self._texts = np.zeros(0, dtype=np.uint8)
+        
+        if len(self._embeddings) != len(self.index["chunks"]):
+            raise ValueError(
+                f"Storage in {self.storage_dir} is inconsistent: "
+                f"{len(self._embeddings)} embeddings for {len(self.index['chunks'])} index entries"
+            )
+        logger.info(f"Opened {len(self._embeddings)} chunk embeddings from {self.embeddings_file}")
+        
+        if self.search_mode == "lexical":
+            # Keyword-only stores never touch the vector index
+            self._ann = None
+            return
+        self._ann = load_index(self.storage_dir, self.index["metadata"].get("ann_index"), self._embeddings)
+        self._apply_search_params()
+
+    def _close_store(self) -> None:
+        """Drop the memory maps so the underlying files can be replaced."""
+        self._embeddings = None
+        self._texts = None
+        self._offsets = None
+        self._ann = None
+        self._lexical = None
+        self._rows_by_id = None
+
+    def _apply_search_params(self) -> None:
+        """Apply the configured query-time knobs that the loaded index understands."""
+        params = {name: value for name, value in self.search_params.items() if name in self._ann.params}
+        ignored = set(self.search_params) - set(params)
+        if ignored:
+            logger.warning(f"Ignoring search parameters not used by the {self._ann.backend} index: {sorted(ignored)}")
+        self._ann.set_search_params(**params)
+
+    def get_embeddings(self) -> np.ndarray:
+        """Return the (memory-mapped) matrix of normalized chunk embeddings."""
+        if self._embeddings is None:
+            self._open_store()
+        return self._embeddings
+
+    def build_ann_index(self, backend: str = "exact", **params: Any) -> None:
+        """
+        Build the nearest-neighbour index used by similarity_search and persist
+        it next to index.json. The index is rebuilt automatically with the same
+        settings whenever chunks are added or synced.
+        
+        Args:
+            backend: Index backend, see ann_index.INDEX_BACKENDS
+            **params: Build and search parameters of the backend
+        """
+        embeddings = self.get_embeddings()
+        index = create_index(backend, **params)
+        if len(embeddings):
+            started = time.perf_counter()
+            index.build(embeddings)
+            index.save(self.storage_dir)
+            logger.info(f"Built {backend} index in {time.perf_counter() - started:.2f}s")
+        self.index["metadata"]["ann_index"] = {
+            "backend": backend,
+            "params": index.params,
+            "rows": len(embeddings)
+        }
+        self._save_index()
+        self._ann = index
+        self._apply_search_params()
+
+    def _refresh_ann_index(self) -> None:
+        """Rebuild the configured nearest-neighbour index after the rows changed."""
+        config = self.index["metadata"].pop("ann_index", None)
+        if config and config["backend"] != "exact":
+            self.build_ann_index(config["backend"], **config.get("params", {}))
+        elif config:
+            self.index["metadata"]["ann_index"] = config
+            self._save_index()
+
+    def build_lexical_index(self, k1: Optional[float] = None, b: Optional[float] = None) -> None:
+        """
+        Build the BM25 inverted index over the stored chunk texts and persist
+        it next to index.json. It is rebuilt automatically whenever chunks are
+        added or synced.
+        
+        Args:
+            k1: BM25 term-frequency saturation (defaults to the stored setting or 1.2)
+            b: BM25 length normalization (defaults to the stored setting or 0.75)
+        """
+        params = (self.index["metadata"].get("lexical_index") or {}).get("params", {})
+        index = BM25Index(k1=params.get("k1", 1.2) if k1 is None else k1, b=params.get("b", 0.75) if b is None else b)
+        if self._texts is None:
+            self._open_store()
+        rows = len(self.index["chunks"])
+        index.build(self._get_text(row) for row in range(rows))
+        index.save(self.storage_dir)
+        self.index["metadata"]["lexical_index"] = {
+            "backend": "bm25",
+            "params": {"k1": index.k1, "b": index.b},
+            "rows": rows
+        }
+        self._save_index()
+        self._lexical = index
+
+    def _get_lexical_index(self) -> BM25Index:
+        """The BM25 index, loaded from disk or built if missing or out of date."""
+        if self._lexical is None:
+            self._lexical = load_lexical_index(
+                self.storage_dir, self.index["metadata"].get("lexical_index"), len(self.index["chunks"])
+            )
+            if self._lexical is None:
+                self.build_lexical_index()
+        return self._lexical
+
+    def _get_text(self, row: int) -> str:
+        """Decode the text of one row from the packed text blob."""
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return bytes(self._texts[start:end]).decode('utf-8')
+
+    def _get_row(self, row: int) -> Dict[str, Any]:
+        """Return id, text and metadata of one row."""
+        entry = self.index["chunks"][row]
+        return {"id": entry["id"], "text": self._get_text(row), "metadata": entry["metadata"]}
+
     def _generate_chunk_id(self, text: str) -> str:
         """Generate a unique ID for a chunk based on its content."""
         return hashlib.md5(text.encode('utf-8')).hexdigest()
 
-    def add_chunks(self, chunks: List[str], metadata: Optional[List[Dict[str, Any]]] = None) -> None:
+    def add_chunks(
+        self,
+        chunks: List[str],
+        metadata: Optional[List[Dict[str, Any]]] = None,
+        batch_size: int = 64,
+        workers: int = 0
+    ) -> Dict[str, float]:
         """
         Add chunks to storage with their embeddings.
         
+        Chunks are embedded in batches. While one batch is being embedded, the
+        previous one is written to disk by a background thread.
+        
         Args:
             chunks: List of text chunks
             metadata: Optional list of metadata dicts for each chunk
+            batch_size: Number of chunks embedded per model call
+            workers: Number of worker processes to embed batches in parallel
+                (0 embeds in this process with the storage's model)
+            
+        Returns:
+            Ingestion stats: chunk count, elapsed seconds and chunks per second
         """
         if metadata is None:
             metadata = [{"source": "The Bhagavad Gita"} for _ in chunks]
+        metadata = [
+            metadata[i] if i < len(metadata) else {"source": "The Bhagavad Gita"}
+            for i in range(len(chunks))
+        ]
         
-        for i, chunk in enumerate(chunks):
-            # Generate chunk ID and embeddings
+        # Skip chunks that are already stored (or repeated in this call)
+        seen = {entry["id"] for entry in self.index["chunks"]}
+        new_chunks = []
+        new_metadata = []
+        for chunk, chunk_metadata in zip(chunks, metadata):
             chunk_id = self._generate_chunk_id(chunk)
-            embedding = self.embedding_model.embed_query(chunk)
-            
-            # Save chunk data
-            chunk_file = os.path.join(self.chunks_dir, f"{chunk_id}.json")
-            chunk_data = {
-                "id": chunk_id,
-                "text": chunk,
-                "embedding": embedding,
-                "metadata": metadata[i] if i < len(metadata) else {"source": "The Bhagavad Gita"}
-            }
-            
-            with open(chunk_file, 'w', encoding='utf-8') as f:
-                json.dump(chunk_data, f)
+            if chunk_id not in seen:
+                seen.add(chunk_id)
+                new_chunks.append(chunk)
+                new_metadata.append(chunk_metadata)
+        if len(new_chunks) < len(chunks):
+            logger.info(f"Skipping {len(chunks) - len(new_chunks)} chunks that are already stored")
+        chunks, metadata = new_chunks, new_metadata
+        if not chunks:
+            return {"chunks": 0, "seconds": 0.0, "chunks_per_sec": 0.0}
+        
+        started = time.perf_counter()
+        if self._embeddings is None:
+            self._open_store()
+        existing_rows = len(self.index["chunks"])
+        batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+        
+        def blocks() -> Iterator[Tuple[np.ndarray, List[bytes]]]:
+            # Existing rows are copied first so row order is preserved
+            if existing_rows:
+                yield (
+                    np.asarray(self._embeddings),
+                    [bytes(self._texts[self._offsets[i]:self._offsets[i + 1]]) for i in range(existing_rows)]
+                )
+            for done, vectors in enumerate(self._embed_batches(batches, workers), start=1):
+                batch = batches[done - 1]
+                yield _normalize(vectors), [chunk.encode('utf-8') for chunk in batch]
+                _log_embedding_progress(done, len(batches), batch_size, len(chunks), started)
+        
+        writer = self._write_blocks(existing_rows + len(chunks), blocks())
+        
+        # Swap in the new files
+        self._close_store()
+        writer.commit()
+        
+        # Update index
+        for chunk, chunk_metadata in zip(chunks, metadata):
+            self.index["chunks"].append({"id": self._generate_chunk_id(chunk), "metadata": chunk_metadata})
+        self._update_store_metadata(writer.dim)
+        self._save_index()
+        self._refresh_ann_index()
+        self.build_lexical_index()
+        
+        elapsed = time.perf_counter() - started
+        rate = len(chunks) / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Added {len(chunks)} chunks to local storage in {elapsed:.2f}s ({rate:.1f} chunks/sec)")
+        return {"chunks": len(chunks), "seconds": elapsed, "chunks_per_sec": rate}
+
+    def sync_chunks(
+        self,
+        chunks: List[str],
+        metadata: Optional[List[Dict[str, Any]]] = None,
+        batch_size: int = 64,
+        workers: int = 0
+    ) -> Dict[str, float]:
+        """
+        Make the store contain exactly the given chunks, in the given order.
+        
+        Chunks are addressed by the md5 of their text: chunks already stored
+        with the current embedding model keep their embeddings, only new chunks
+        are embedded, and stored chunks that are no longer present are dropped.
+        Metadata of kept chunks is replaced by the new metadata.
+        
+        Args:
+            chunks: List of text chunks
+            metadata: Optional list of metadata dicts for each chunk
+            batch_size: Number of chunks embedded per model call
+            workers: Number of worker processes to embed batches in parallel
             
-            # Update index
-            self.index["chunks"].append({
+        New rows are written by a background thread as their batches finish
+        embedding, as in add_chunks.
+        
+        Returns:
+            Sync stats: chunks added, reused and removed, elapsed seconds and
+            chunks embedded per second
+        """
+        if metadata is None:
+            metadata = [{"source": "The Bhagavad Gita"} for _ in chunks]
+        started = time.perf_counter()
+        if self._embeddings is None:
+            self._open_store()
+        
+        # Target rows, deduplicated by chunk id
+        entries = []
+        texts = []
+        seen = set()
+        for i, chunk in enumerate(chunks):
+            chunk_id = self._generate_chunk_id(chunk)
+            if chunk_id in seen:
+                continue
+            seen.add(chunk_id)
+            entries.append({
                 "id": chunk_id,
                 "metadata": metadata[i] if i < len(metadata) else {"source": "The Bhagavad Gita"}
             })
+            texts.append(chunk)
+        
+        # Stored embeddings can only be reused if they came from the same model
+        existing_rows: Dict[str, int] = {}
+        if self.index["metadata"].get("embedding_model") == self._model_name():
+            for row, entry in enumerate(self.index["chunks"]):
+                existing_rows.setdefault(entry["id"], row)
+        removed = len({entry["id"] for entry in self.index["chunks"]} - seen)
+        
+        # Embed only the chunks that are not stored yet
+        missing = [i for i, entry in enumerate(entries) if entry["id"] not in existing_rows]
+        missing_texts = [texts[i] for i in missing]
+        batches = [missing_texts[i:i + batch_size] for i in range(0, len(missing_texts), batch_size)]
+        
+        def blocks() -> Iterator[Tuple[np.ndarray, List[bytes]]]:
+            # Rows in target order: stored rows are copied, new rows are taken
+            # from the embedded batches as they finish. Rows collected so far
+            # go to the writer before waiting on the model for the next batch
+            embedded = self._embed_batches(batches, workers)
+            pending: "deque[np.ndarray]" = deque()
+            done = 0
+            vectors: List[np.ndarray] = []
+            encoded: List[bytes] = []
+            try:
+                for i, entry in enumerate(entries):
+                    if entry["id"] in existing_rows:
+                        vectors.append(self._embeddings[existing_rows[entry["id"]]])
+                    else:
+                        if not pending:
+                            if vectors:
+                                yield np.stack(vectors), encoded
+                                vectors, encoded = [], []
+                            pending.extend(_normalize(next(embedded)))
+                            done += 1
+                            _log_embedding_progress(done, len(batches), batch_size, len(missing), started)
+                        vectors.append(pending.popleft())
+                    encoded.append(texts[i].encode('utf-8'))
+                    if len(vectors) >= 1024:
+                        yield np.stack(vectors), encoded
+                        vectors, encoded = [], []
+                if vectors:
+                    yield np.stack(vectors), encoded
+            finally:
+                embedded.close()
         
-        # Update metadata
+        if not missing and removed == 0 and [e["id"] for e in entries] == [e["id"] for e in self.index["chunks"]]:
+            # Same rows in the same order: only the metadata may have changed
+            self.index["chunks"] = entries
+            self._save_index()
+        else:
+            writer = self._write_blocks(len(entries), blocks())
+            self._close_store()
+            writer.commit()
+            self.index["chunks"] = entries
+            self._update_store_metadata(writer.dim)
+            self._save_index()
+            self._refresh_ann_index()
+            self.build_lexical_index()
+        
+        elapsed = time.perf_counter() - started
+        stats = {
+            "added": len(missing),
+            "reused": len(entries) - len(missing),
+            "removed": removed,
+            "seconds": elapsed,
+            "chunks_per_sec": len(missing) / elapsed if elapsed > 0 else 0.0
+        }
+        logger.info(
+            f"Synced storage: {stats['added']} chunks embedded, {stats['reused']} reused, "
+            f"{stats['removed']} removed in {stats['seconds']:.2f}s ({stats['chunks_per_sec']:.1f} chunks/sec)"
+        )
+        return stats
+
+    def _write_blocks(self, total_rows: int, blocks: Iterator[Tuple[np.ndarray, List[bytes]]]) -> "_StoreWriter":
+        """
+        Write blocks of rows (normalized embeddings and encoded texts) to new
+        store files from a background thread, so each block is copied to disk
+        while the next one is produced (embedded). Returns the writer, ready to
+        commit; its files are discarded if anything fails.
+        """
+        writer = _StoreWriter(self.storage_dir, total_rows)
+        write_queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=4)
+        write_errors: List[BaseException] = []
+        
+        def write_batches() -> None:
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+                if write_errors:
+                    continue
+                try:
+                    writer.append(*item)
+                except BaseException as e:
+                    write_errors.append(e)
+        
+        write_thread = threading.Thread(target=write_batches, name="chunk-writer", daemon=True)
+        write_thread.start()
+        try:
+            try:
+                for block in blocks:
+                    write_queue.put(block)
+            finally:
+                write_queue.put(None)
+                write_thread.join()
+            if write_errors:
+                raise write_errors[0]
+        except BaseException:
+            writer.abort()
+            raise
+        return writer
+
+    def _model_name(self) -> Optional[str]:
+        """Name of the embedding model, used to tell whether stored embeddings are reusable."""
+        return getattr(self.embedding_model, "model_name", None)
+
+    def _update_store_metadata(self, embedding_dim: int) -> None:
+        """Refresh the store-level metadata after the rows have changed."""
+        self.index["format_version"] = STORAGE_FORMAT_VERSION
         self.index["metadata"]["chunk_count"] = len(self.index["chunks"])
+        self.index["metadata"]["embedding_dim"] = embedding_dim
+        self.index["metadata"]["embedding_model"] = self._model_name()
+
+    def set_fingerprint(self, fingerprint: Dict[str, Any]) -> None:
+        """Record the ingestion fingerprint the stored chunks were built from."""
+        self.index["metadata"]["fingerprint"] = fingerprint
         self._save_index()
-        logger.info(f"Added {len(chunks)} chunks to local storage")
 
-    def similarity_search(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
+    def _embed_batches(self, batches: List[List[str]], workers: int) -> Iterator[np.ndarray]:
+        """
+        Embed batches of texts in order, either in this process or across a
+        process pool. Each pool worker loads its own copy of the model, which
+        pays off on CPU-only hosts with large corpora.
+        """
+        model_name = getattr(self.embedding_model, "model_name", None)
+        if workers <= 1 or len(batches) <= 1 or not model_name:
+            for batch in batches:
+                yield _embed_batch(self.embedding_model, batch)
+            return
+        
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        logger.info(f"Embedding {len(batches)} batches with {workers} worker processes")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_embedding_worker,
+            initargs=(model_name, threads)
+        ) as pool:
+            yield from pool.map(_embed_in_worker, batches)
+
+    def set_verse_table(self, verses: Dict[str, Dict[str, Any]]) -> None:
+        """Store the verse table (see build_verse_table) next to index.json."""
+        path = os.path.join(self.storage_dir, VERSES_FILE)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({"format_version": 1, "verses": verses}, f)
+        os.replace(path + ".tmp", path)
+        self._verses = verses
+        logger.info(f"Stored verse table with {len(verses)} verses")
+
+    def lookup_verse(self, chapter: int, verse: int) -> Optional[Dict[str, Any]]:
+        """
+        Look up a verse by chapter and number in the verse table, without
+        embedding anything or scanning the store.
+        
+        Args:
+            chapter: Chapter number
+            verse: Verse number within the chapter
+            
+        Returns:
+            Dictionary shaped like a similarity_search result (id, text,
+            metadata, similarity 1.0), or None if the verse is not in the table
+        """
+        if self._verses is None:
+            path = os.path.join(self.storage_dir, VERSES_FILE)
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._verses = json.load(f)["verses"]
+            else:
+                logger.warning(f"No verse table in {self.storage_dir}; re-run ingestion to build it")
+                self._verses = {}
+        
+        entry = self._verses.get(f"{chapter}.{verse}")
+        if entry is None:
+            return None
+        return {
+            "id": f"verse-{chapter}.{verse}",
+            "text": entry["text"],
+            "metadata": {
+                "source": self.index["metadata"].get("source", "The Bhagavad Gita"),
+                "chapter": chapter,
+                "verses": [f"{chapter}.{verse}"],
+                "page": entry["page"],
+                "page_end": entry["page_end"],
+                "chunk_ids": entry["chunk_ids"]
+            },
+            "similarity": 1.0
+        }
+
+    def similarity_search(self, query: str, k: int = 3, mode: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         Search for chunks similar to the query.
         
         Args:
             query: The search query
             k: Number of results to return
+            mode: "dense", "lexical" or "hybrid" (defaults to the store's search_mode)
             
         Returns:
-            List of dictionaries containing chunk data and similarity score
+            List of dictionaries containing chunk data (id, text, metadata, row)
+            and similarity score (cosine for dense, BM25 for lexical, fused RRF
+            score for hybrid)
         """
+        mode = mode or self.search_mode
         if not self.index["chunks"]:
             logger.warning("No chunks in storage to search")
             return []
         
-        # Generate query embedding
-        query_embedding = self.embedding_model.embed_query(query)
+        if self._embeddings is None:
+            self._open_store()
         
-        # Calculate similarity for all chunks
-        results = []
-        for chunk_info in self.index["chunks"]:
-            chunk_id = chunk_info["id"]
-            chunk_file = os.path.join(self.chunks_dir, f"{chunk_id}.json")
+        if mode == "lexical":
+            # Keyword lookup: no embedding forward pass
+            with span("vector_search", mode=mode, batch="false"):
+                rows, scores = self._get_lexical_index().search(query, k)
+        else:
+            # Generate and normalize query embedding
+            with span("embed_query", batch="false"):
+                query_embedding = _normalize(self.embedding_model.embed_query(query))
+            if self._ann is None:
+                self._ann = load_index(self.storage_dir, self.index["metadata"].get("ann_index"), self._embeddings)
+                self._apply_search_params()
+            
+            with span("vector_search", mode=mode, batch="false"):
+                if mode == "hybrid":
+                    # Reciprocal rank fusion of the dense and BM25 candidate lists
+                    candidates = max(k, HYBRID_CANDIDATES)
+                    dense_rows, _ = self._ann.search(query_embedding, candidates)
+                    lexical_rows, _ = self._get_lexical_index().search(query, candidates)
+                    rows, scores = reciprocal_rank_fusion([dense_rows, lexical_rows], k)
+                else:
+                    # Cosine similarity via the configured index (a single matrix-vector
+                    # product over all rows for the default exact backend)
+                    rows, scores = self._ann.search(query_embedding, k)
+        
+        return self._results(rows, scores)
+    
+    def similarity_search_batch(self, queries: List[str], k: int = 3, mode: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Search for many queries at once: the queries are embedded in one
+        batched call and scored with one matrix-matrix product (exact backend).
+        
+        Args:
+            queries: The search queries
+            k: Number of results per query
+            mode: "dense", "lexical" or "hybrid" (defaults to the store's search_mode)
+            
+        Returns:
+            One result list per query, as returned by similarity_search
+        """
+        mode = mode or self.search_mode
+        if not self.index["chunks"] or not queries:
+            return [[] for _ in queries]
+        
+        if self._embeddings is None:
+            self._open_store()
+        
+        if mode == "lexical":
+            with span("vector_search", mode=mode, batch="true"):
+                lexical = self._get_lexical_index()
+                ranked = [lexical.search(query, k) for query in queries]
+        else:
+            with span("embed_query", batch="true"):
+                query_embeddings = _normalize(self.embedding_model.embed_documents(list(queries)))
+            if self._ann is None:
+                self._ann = load_index(self.storage_dir, self.index["metadata"].get("ann_index"), self._embeddings)
+                self._apply_search_params()
             
-            if os.path.exists(chunk_file):
-                with open(chunk_file, 'r', encoding='utf-8') as f:
-                    chunk_data = json.load(f)
-                
-                # Calculate cosine similarity
-                similarity = self._cosine_similarity(query_embedding, chunk_data["embedding"])
-                results.append({
-                    "id": chunk_id,
-                    "text": chunk_data["text"],
-                    "metadata": chunk_data["metadata"],
-                    "similarity": similarity
-                })
-        
-        # Sort by similarity and take top k
-        results.sort(key=lambda x: x["similarity"], reverse=True)
-        return results[:k]
-
-    def _cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-        """Calculate cosine similarity between two vectors."""
-        import numpy as np
-        v1 = np.array(vec1)
-        v2 = np.array(vec2)
-        return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-
-
-def extract_text_from_pdf(pdf_path: str) -> str:
+            with span("vector_search", mode=mode, batch="true"):
+                if mode == "hybrid":
+                    candidates = max(k, HYBRID_CANDIDATES)
+                    lexical = self._get_lexical_index()
+                    ranked = [
+                        reciprocal_rank_fusion([dense_rows, lexical.search(query, candidates)[0]], k)
+                        for query, (dense_rows, _) in zip(queries, self._ann.search_batch(query_embeddings, candidates))
+                    ]
+                else:
+                    ranked = self._ann.search_batch(query_embeddings, k)
+        
+        return [self._results(rows, scores) for rows, scores in ranked]
+    
+    def _results(self, rows: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
+        results = []
+        for row, score in zip(rows, scores):
+            result = self._get_row(int(row))
+            result["similarity"] = float(score)
+            result["row"] = int(row)
+            results.append(result)
+        return results
+    
+    def get_chunks(self, chunk_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Chunks by id, shaped like similarity_search results without a score
+        (e.g. to reuse an earlier retrieval). Ids no longer in the store are
+        skipped; "verse-<chapter>.<verse>" ids are looked up in the verse table.
+        """
+        if self._embeddings is None:
+            self._open_store()
+        if self._rows_by_id is None:
+            self._rows_by_id = {entry["id"]: row for row, entry in enumerate(self.index["chunks"])}
+        chunks = []
+        for chunk_id in chunk_ids:
+            if chunk_id.startswith("verse-"):
+                chapter, verse = chunk_id[len("verse-"):].split(".")
+                chunk = self.lookup_verse(int(chapter), int(verse))
+            elif chunk_id in self._rows_by_id:
+                row = self._rows_by_id[chunk_id]
+                chunk = dict(self._get_row(row), row=row)
+            else:
+                chunk = None
+            if chunk is not None:
+                chunks.append(chunk)
+        return chunks
+    
+    def row_embeddings(self, rows: List[int]) -> Optional[np.ndarray]:
+        """
+        Stored embeddings of the given rows (the "row" of a similarity_search
+        result), or None if the store has no embeddings.
+        """
+        if self._embeddings is None:
+            self._open_store()
+        if not len(self._embeddings):
+            return None
+        return np.asarray(self._embeddings[np.asarray(rows, dtype=np.int64)], dtype=np.float32)
+
+
+# PDF reader of an extraction worker process, opened on its first page range
+_worker_pdf: Dict[str, Any] = {}
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """Extract the text of pages [start, end) of a PDF (in a worker process or in-process)."""
+    reader = _worker_pdf.get(pdf_path)
+    if reader is None:
+        from PyPDF2 import PdfReader
+        reader = _worker_pdf[pdf_path] = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def _page_count(pdf_path: str) -> int:
+    from PyPDF2 import PdfReader
+    return len(PdfReader(pdf_path).pages)
+
+
+def _peak_memory_mb() -> Optional[Dict[str, float]]:
+    """Peak resident memory of this process and of its finished child processes, in MB."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if os.uname().sysname == "Darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    }
+
+
+def iter_pdf_pages(pdf_path: str, workers: int = 0, pages_per_task: int = 16) -> Iterator[Tuple[int, str]]:
     """
-    Extract text from a PDF file.
+    Extract the text of a PDF page by page, in page order.
+    
+    With workers > 0, ranges of pages_per_task pages are extracted in a process
+    pool. At most 2 * workers ranges are in flight, so memory stays bounded
+    by a few ranges of text however large the PDF is.
     
     Args:
         pdf_path: Path to the PDF file
+        workers: Number of worker processes (0 to extract in-process)
+        pages_per_task: Pages extracted per worker task
         
-    Returns:
-        Extracted text as string
+    Yields:
+        (page number starting at 1, page text) tuples
     """
-    logger.info(f"Extracting text from {pdf_path}")
-    reader = PdfReader(pdf_path)
-    text = ""
+    total_pages = _page_count(pdf_path)
+    ranges = [(start, min(start + pages_per_task, total_pages)) for start in range(0, total_pages, pages_per_task)]
+    logger.info(f"Extracting text from {pdf_path} ({total_pages} pages, {max(workers, 1)} processes)")
+    
+    if workers <= 0:
+        try:
+            for start, end in ranges:
+                for offset, text in enumerate(_extract_page_range(pdf_path, start, end)):
+                    yield start + offset + 1, text
+        finally:
+            _worker_pdf.pop(pdf_path, None)
+        return
     
-    for page in reader.pages:
-        text += page.extract_text() + "\n"
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: "queue.Queue" = queue.Queue()
+        submitted = 0
+        for start, end in ranges:
+            pending.put((start, executor.submit(_extract_page_range, pdf_path, start, end)))
+            submitted += 1
+            if submitted < 2 * workers:
+                continue
+            first, future = pending.get()
+            for offset, text in enumerate(future.result()):
+                yield first + offset + 1, text
+        while not pending.empty():
+            first, future = pending.get()
+            for offset, text in enumerate(future.result()):
+                yield first + offset + 1, text
+
+
+def extract_text_from_pdf(pdf_path: str, workers: int = 0) -> str:
+    """
+    Extract text from a PDF file.
     
+    Args:
+        pdf_path: Path to the PDF file
+        workers: Number of worker processes (0 to extract in-process)
+        
+    Returns:
+        Extracted text as string, one line break after each page
+    """
+    text = "".join(page_text + "\n" for _, page_text in iter_pdf_pages(pdf_path, workers))
     logger.info(f"Extracted {len(text)} characters from PDF")
     return text
 
 
-def process_pdf_to_chunks(pdf_path: str, storage_dir: str) -> None:
+def _roman_to_int(numeral: str) -> int:
+    values = [_ROMAN_VALUES[c] for c in numeral.lower()]
+    return sum(-v if i + 1 < len(values) and v < values[i + 1] else v for i, v in enumerate(values))
+
+
+def _verse_markers(text: str) -> List[Tuple[int, Optional[int], Optional[int]]]:
     """
-    Process PDF file, split into chunks, and store locally.
+    Find chapter and verse markers in text.
+    
+    Returns:
+        Sorted (offset, chapter, verse) tuples. A chapter heading has verse
+        None; a bare "Text 47" marker has chapter None (the current chapter).
+    """
+    markers = []
+    for match in _CHAPTER_PATTERN.finditer(text):
+        number = match.group(1)
+        chapter = int(number) if number.isdigit() else _roman_to_int(number)
+        if 1 <= chapter <= 18:
+            markers.append((match.start(), chapter, None))
+    for match in _CHAPTER_VERSE_PATTERN.finditer(text):
+        markers.append((match.start(), int(match.group(1)), int(match.group(2))))
+    for match in _VERSE_PATTERN.finditer(text):
+        markers.append((match.start(), None, int(match.group(1))))
+    markers.sort(key=lambda marker: marker[0])
+    return markers
+
+
+def _next_section(state: Tuple[Optional[int], Optional[int]], marker: Tuple[int, Optional[int], Optional[int]]):
+    """
+    Chapter and verse of the section a marker starts, or None if the marker
+    doesn't continue the sequence (e.g. a cross-reference in a commentary).
+    """
+    _, chapter, verse = marker
+    current_chapter, current_verse = state
+    
+    def follows(previous: Optional[int]) -> bool:
+        return 0 < verse - (previous or 0) <= _MAX_VERSE_GAP
+    
+    if verse is None:
+        return (chapter, None) if current_chapter is None or chapter > current_chapter else None
+    if chapter is None:
+        return (current_chapter, verse) if current_chapter is not None and follows(current_verse) else None
+    if chapter == current_chapter:
+        return (chapter, verse) if follows(current_verse) else None
+    # A reference to another chapter only starts a section at the next chapter's first verse
+    if (current_chapter is None or chapter == current_chapter + 1) and verse == 1:
+        return chapter, verse
+    return None
+
+
+def _apply_marker(state: Tuple[Optional[int], Optional[int]], marker: Tuple[int, Optional[int], Optional[int]]):
+    """Chapter and verse in effect after a marker (unchanged by markers that don't continue the sequence)."""
+    return _next_section(state, marker) or state
+
+
+def split_pages(
+    pages: Iterator[Tuple[int, str]],
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Split a stream of pages into chunks without joining the whole text.
+    
+    The splitter runs on the unfinished last chunk plus the next page; every
+    chunk but the last is final and is yielded, and the last one is carried
+    over, so only about one page of text is held at a time.
     
     Args:
-        pdf_path: Path to the PDF file
-        storage_dir: Directory to store chunks
+        pages: (page number, page text) tuples in order, e.g. from iter_pdf_pages
+        chunk_size: Splitter chunk size
+        chunk_overlap: Splitter chunk overlap
+        
+    Yields:
+        (chunk text, metadata) tuples; metadata holds the first and last page
+        of the chunk and, where markers were found, the chapter and the range
+        of verses it covers
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len
+    )
+    
+    buffer = ""
+    # (offset in buffer, page number) of each page in the buffer
+    page_starts: List[Tuple[int, int]] = []
+    # Chapter and verse in effect at the start of the buffer
+    state: Tuple[Optional[int], Optional[int]] = (None, None)
+    
+    def describe(start: int, end: int, markers) -> Dict[str, Any]:
+        first_page = max((page for offset, page in page_starts if offset <= start), default=page_starts[0][1])
+        last_page = max((page for offset, page in page_starts if offset < end), default=first_page)
+        metadata: Dict[str, Any] = {"page": first_page, "page_end": last_page}
+        
+        # Verse in effect where the chunk starts, then every verse marked inside it
+        chapter, verse = state
+        for marker in markers:
+            if marker[0] >= start:
+                break
+            chapter, verse = _apply_marker((chapter, verse), marker)
+        first_chapter = chapter
+        refs = []
+        # The verse carried in counts unless the chunk starts right at a new marker
+        starts_at_marker = any(marker[0] == start for marker in markers)
+        if chapter is not None and verse is not None and not starts_at_marker:
+            refs.append((chapter, verse))
+        for marker in markers:
+            if marker[0] < start:
+                continue
+            if marker[0] >= end:
+                break
+            chapter, verse = _apply_marker((chapter, verse), marker)
+            if first_chapter is None:
+                first_chapter = chapter
+            if chapter is None or verse is None or (chapter, verse) in refs:
+                continue
+            # Fill in verses between two markers of the same chapter (small gaps only,
+            # so a stray cross-reference doesn't claim a whole chapter)
+            if refs and refs[-1][0] == chapter and 0 < verse - refs[-1][1] <= _MAX_VERSE_GAP:
+                refs.extend((chapter, v) for v in range(refs[-1][1] + 1, verse + 1))
+            else:
+                refs.append((chapter, verse))
+        if first_chapter is not None:
+            metadata["chapter"] = first_chapter
+        if refs:
+            metadata["verses"] = [f"{c}.{v}" for c, v in refs]
+        return metadata
+    
+    def split_buffer():
+        markers = _verse_markers(buffer)
+        spans = []
+        cursor = 0
+        for chunk in splitter.split_text(buffer):
+            start = buffer.find(chunk, cursor)
+            if start < 0:
+                start = cursor
+            spans.append((chunk, start, start + len(chunk)))
+            cursor = start + 1
+        return spans, markers
+    
+    for page_number, page_text in pages:
+        if page_starts:
+            buffer += "\n"
+        page_starts.append((len(buffer), page_number))
+        buffer += page_text
+        
+        spans, markers = split_buffer()
+        if len(spans) < 2:
+            continue
+        for chunk, start, end in spans[:-1]:
+            yield chunk, describe(start, end, markers)
+        
+        # Carry the unfinished last chunk over to the next page
+        _, carry_start, _ = spans[-1]
+        for marker in markers:
+            if marker[0] >= carry_start:
+                break
+            state = _apply_marker(state, marker)
+        kept = [(offset, page) for offset, page in page_starts if offset > carry_start]
+        first_page = max(page for offset, page in page_starts if offset <= carry_start)
+        page_starts = [(0, first_page)] + [(offset - carry_start, page) for offset, page in kept]
+        buffer = buffer[carry_start:]
+    
+    if buffer.strip():
+        spans, markers = split_buffer()
+        for chunk, start, end in spans:
+            yield chunk, describe(start, end, markers)
+
+
+class VerseSectionBuilder:
+    """
+    Cuts a stream of pages into verse sections: the text from one verse
+    marker to the next. Text before a chapter's first verse (and before the
+    first chapter) becomes a section with verse None.
+    
+    Pages are pushed with feed(); finished sections are returned as soon as
+    the next marker is seen, so only the open section is buffered.
+    """
+    def __init__(self):
+        self._buffer = ""
+        self._page_starts: List[Tuple[int, int]] = []
+        self._state: Tuple[Optional[int], Optional[int]] = (None, None)
+
+    def feed(self, page_number: int, text: str) -> List[Dict[str, Any]]:
+        """Add the next page; returns the sections it completed."""
+        # Earlier text has been scanned already; rescan from the start of a line
+        # shortly before the page break in case a marker straddles it
+        scan_start = self._buffer.rfind("\n", 0, max(0, len(self._buffer) - 32)) + 1
+        if self._page_starts:
+            self._buffer += "\n"
+        self._page_starts.append((len(self._buffer), page_number))
+        self._buffer += text
+        return self._cut(scan_start, final=False)
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """Close the open section at the end of the text."""
+        return self._cut(len(self._buffer), final=True) if self._page_starts else []
+
+    def _section(self, start: int, end: int) -> Optional[Dict[str, Any]]:
+        text = self._buffer[start:end].strip()
+        if not text:
+            return None
+        return {
+            "chapter": self._state[0],
+            "verse": self._state[1],
+            "page": max(page for offset, page in self._page_starts if offset <= start),
+            "page_end": max(page for offset, page in self._page_starts if offset < end),
+            "text": text
+        }
+
+    def _cut(self, scan_start: int, final: bool) -> List[Dict[str, Any]]:
+        sections = []
+        cut = 0
+        # Markers seen before were either accepted (and are now at offset 0,
+        # where they no longer follow the state) or rejected for the same state
+        for offset, chapter, verse in _verse_markers(self._buffer[scan_start:]):
+            offset += scan_start
+            new_state = _next_section(self._state, (offset, chapter, verse))
+            if new_state is None:
+                continue
+            section = self._section(cut, offset)
+            if section:
+                sections.append(section)
+            cut = offset
+            self._state = new_state
+        
+        if final:
+            section = self._section(cut, len(self._buffer))
+            if section:
+                sections.append(section)
+            return sections
+        
+        # Keep only the open section
+        if cut > 0:
+            first_page = max(page for offset, page in self._page_starts if offset <= cut)
+            self._page_starts = [(0, first_page)] + [
+                (offset - cut, page) for offset, page in self._page_starts if offset > cut
+            ]
+            self._buffer = self._buffer[cut:]
+        return sections
+
+
+def split_sections(
+    sections: List[Dict[str, Any]],
+    max_size: int = VERSE_CHUNK_MAX_SIZE,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
     """
-    # Extract text from PDF
-    text = extract_text_from_pdf(pdf_path)
+    Verse-aligned chunking: one chunk per verse section, with sections longer
+    than max_size split into chunk_size pieces that all keep the verse.
     
-    # Split text into chunks
+    Yields:
+        (chunk text, metadata) tuples, with the same metadata keys as split_pages
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
     splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
         length_function=len
     )
-    chunks = splitter.split_text(text)
-    logger.info(f"Split PDF into {len(chunks)} chunks")
+    for section in sections:
+        metadata: Dict[str, Any] = {"page": section["page"], "page_end": section["page_end"]}
+        if section["chapter"] is not None:
+            metadata["chapter"] = section["chapter"]
+        if section["verse"] is not None:
+            metadata["verses"] = [f"{section['chapter']}.{section['verse']}"]
+        pieces = [section["text"]] if len(section["text"]) <= max_size else splitter.split_text(section["text"])
+        for piece in pieces:
+            yield piece, dict(metadata)
+
+
+def build_verse_table(
+    sections: List[Dict[str, Any]],
+    chunks: List[str],
+    metadata: List[Dict[str, Any]]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Build the verse table stored in verses.json.
+    
+    Args:
+        sections: Verse sections from VerseSectionBuilder
+        chunks: Stored chunk texts
+        metadata: Metadata of the chunks ("verses" lists the verses each covers)
+        
+    Returns:
+        Mapping of "chapter.verse" to chapter, verse, pages, text and the ids
+        of the chunks covering the verse
+    """
+    verses: Dict[str, Dict[str, Any]] = {}
+    for section in sections:
+        if section["verse"] is None:
+            continue
+        ref = f"{section['chapter']}.{section['verse']}"
+        if ref in verses:
+            continue
+        verses[ref] = {
+            "chapter": section["chapter"],
+            "verse": section["verse"],
+            "page": section["page"],
+            "page_end": section["page_end"],
+            "text": section["text"],
+            "chunk_ids": []
+        }
+    for chunk, chunk_metadata in zip(chunks, metadata):
+        chunk_id = hashlib.md5(chunk.encode('utf-8')).hexdigest()
+        for ref in chunk_metadata.get("verses", []):
+            if ref in verses and chunk_id not in verses[ref]["chunk_ids"]:
+                verses[ref]["chunk_ids"].append(chunk_id)
+    return verses
+
+
+def compute_fingerprint(
+    pdf_path: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    model_name: str = EMBEDDING_MODEL_NAME,
+    chunking: str = CHUNKING
+) -> Dict[str, Any]:
+    """
+    Fingerprint the inputs of an ingestion run: the source file contents,
+    the splitter settings and the embedding model.
     
-    # Initialize embedding model
+    Args:
+        pdf_path: Path to the PDF file
+        chunk_size: Splitter chunk size
+        chunk_overlap: Splitter chunk overlap
+        model_name: Embedding model name
+        chunking: Chunking mode ("fixed" or "verse")
+        
+    Returns:
+        Fingerprint dict, stored in index.json metadata
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {
+        "source_sha256": digest.hexdigest(),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "splitter_version": SPLITTER_VERSION,
+        "chunking": chunking,
+        "embedding_model": model_name
+    }
+
+
+def extract_chunks(
+    pdf_path: str,
+    workers: int = 0,
+    source: str = "The Bhagavad Gita",
+    chunking: str = CHUNKING
+) -> Tuple[List[str], List[Dict[str, Any]], Dict[str, Dict[str, Any]], Dict[str, Any]]:
+    """
+    Stream a PDF through page extraction, the splitter and the verse parser.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        workers: Number of worker processes for page extraction (0 for in-process)
+        source: Source name stored in each chunk's metadata
+        chunking: "fixed" for fixed-size chunks, "verse" for verse-aligned chunks
+        
+    Returns:
+        Chunk texts, their metadata (source, chunk_index, pages, chapter/verses),
+        the verse table, and extraction stats: pages, chunks, verses,
+        characters, seconds, peak memory
+    """
+    if chunking not in CHUNKING_MODES:
+        raise ValueError(f"Unknown chunking mode '{chunking}', expected one of {CHUNKING_MODES}")
+    started = time.perf_counter()
+    stats: Dict[str, Any] = {"pages": 0, "characters": 0}
+    builder = VerseSectionBuilder()
+    sections: List[Dict[str, Any]] = []
+    
+    def counted_pages():
+        for page_number, text in iter_pdf_pages(pdf_path, workers):
+            stats["pages"] += 1
+            stats["characters"] += len(text)
+            sections.extend(builder.feed(page_number, text))
+            yield page_number, text
+        sections.extend(builder.finish())
+    
+    if chunking == "verse":
+        for _ in counted_pages():
+            pass
+        pieces = split_sections(sections)
+    else:
+        pieces = split_pages(counted_pages())
+    
+    chunks = []
+    metadata = []
+    for chunk, chunk_metadata in pieces:
+        metadata.append(dict({"source": source, "chunk_index": len(chunks)}, **chunk_metadata))
+        chunks.append(chunk)
+    verses = build_verse_table(sections, chunks, metadata)
+    
+    stats["chunks"] = len(chunks)
+    stats["verses"] = len(verses)
+    stats["seconds"] = time.perf_counter() - started
+    stats["peak_memory_mb"] = _peak_memory_mb()
+    memory = stats["peak_memory_mb"]
+    logger.info(
+        f"Extracted {stats['pages']} pages ({stats['characters']} characters) into {len(chunks)} chunks "
+        f"and {len(verses)} verses "
+        f"in {stats['seconds']:.2f}s ({stats['pages'] / max(stats['seconds'], 1e-9):.1f} pages/s)"
+        + (f", peak memory {memory['self']:.0f} MB (workers {memory['children']:.0f} MB)" if memory else "")
+    )
+    return chunks, metadata, verses, stats
+
+
+def is_storage_current(storage_dir: str, fingerprint: Dict[str, Any]) -> bool:
+    """Check whether a storage directory was built from the given fingerprint."""
+    index_file = os.path.join(storage_dir, "index.json")
+    if not os.path.exists(index_file):
+        return False
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    return index.get("metadata", {}).get("fingerprint") == fingerprint
+
+
+def process_pdf_to_chunks(
+    pdf_path: str,
+    storage_dir: str,
+    batch_size: int = 64,
+    workers: int = 0,
+    force: bool = False,
+    index_backend: Optional[str] = None,
+    index_params: Optional[Dict[str, Any]] = None,
+    extract_workers: int = 0,
+    chunking: str = CHUNKING
+) -> None:
+    """
+    Process PDF file, split into chunks, and store locally.
+    
+    Ingestion is incremental: if the PDF, splitter settings and embedding model
+    match the stored fingerprint nothing is done, and otherwise only chunks
+    that are not stored yet are embedded.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        storage_dir: Directory to store chunks
+        batch_size: Number of chunks embedded per model call
+        workers: Number of worker processes for embedding (0 to embed in-process)
+        force: Re-split and sync the store even if the fingerprint matches
+        index_backend: Nearest-neighbour index to build (see ann_index.INDEX_BACKENDS);
+            by default the store keeps the backend it was built with
+        index_params: Build and search parameters of the index backend
+        extract_workers: Number of worker processes for page extraction (0 for in-process)
+        chunking: "fixed" for fixed-size chunks, "verse" for verse-aligned chunks
+    """
+    fingerprint = compute_fingerprint(pdf_path, chunking=chunking)
+    if not force and is_storage_current(storage_dir, fingerprint):
+        logger.info("Stored chunks are up to date with the PDF, splitter settings and embedding model")
+        return
+    
+    # Extract pages and split them into chunks with page and chapter/verse metadata
+    chunks, metadata, verses, _ = extract_chunks(pdf_path, workers=extract_workers, chunking=chunking)
+    
+    # Initialize embedding model (shared with the query path when called from app.py)
     try:
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"  # This is a small but effective model
-        )
-        logger.info("Using sentence-transformers/all-MiniLM-L6-v2 embedding model")
+        embeddings = get_embedding_model(EMBEDDING_MODEL_NAME)
+        logger.info(f"Using {EMBEDDING_MODEL_NAME} embedding model")
     except Exception as e:
         logger.error(f"Failed to load embedding model: {e}")
         raise
@@ -197,16 +1475,51 @@ def process_pdf_to_chunks(pdf_path: str, storage_dir: str) -> None:
     # Create storage and save chunks
     storage = LocalChunkStorage(storage_dir, embeddings)
     
-    # Generate basic metadata (adding page numbers would be ideal but requires more work)
-    metadata = [{"source": "The Bhagavad Gita", "chunk_index": i} for i in range(len(chunks))]
+    # Store chunks with embeddings, re-embedding only chunks that changed
+    stats = storage.sync_chunks(chunks, metadata, batch_size=batch_size, workers=workers)
+    storage.set_verse_table(verses)
+    storage.set_fingerprint(fingerprint)
     
-    # Store chunks with embeddings
-    storage.add_chunks(chunks, metadata)
-    logger.info("Successfully processed and stored PDF chunks")
+    # The BM25 index is rebuilt whenever rows change; stores synced without
+    # changes may predate it
+    if "lexical_index" not in storage.index["metadata"]:
+        storage.build_lexical_index()
+    
+    # Build the nearest-neighbour index over the stored embeddings
+    if index_backend:
+        storage.build_ann_index(index_backend, **(index_params or {}))
+    logger.info(f"Successfully processed and stored PDF chunks ({stats['chunks_per_sec']:.1f} chunks/sec)")
 
 
 if __name__ == "__main__":
     # This enables running the module directly to process the PDF
-    pdf_path = "Data/The_Bhagavad_Gita.pdf"
-    storage_dir = "data_blocks"
-    process_pdf_to_chunks(pdf_path, storage_dir)
\ No newline at end of file
+    # or to convert an existing storage directory to the current format
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Process the Bhagavad Gita PDF into local chunk storage")
+    parser.add_argument("--pdf", default="Data/The_Bhagavad_Gita.pdf", help="Path to the PDF file")
+    parser.add_argument("--storage-dir", default="data_blocks", help="Directory to store chunks")
+    parser.add_argument("--batch-size", type=int, default=64, help="Number of chunks embedded per model call")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes for embedding (0 to embed in-process)")
+    parser.add_argument("--extract-workers", type=int, default=0, help="Worker processes for PDF page extraction (0 for in-process)")
+    parser.add_argument("--extract-only", action="store_true", help="Only extract and split the PDF, and report time and peak memory")
+    parser.add_argument("--chunking", default=CHUNKING, choices=CHUNKING_MODES, help="Fixed-size or verse-aligned chunks")
+    parser.add_argument("--force", action="store_true", help="Re-split and sync even if the stored fingerprint matches")
+    parser.add_argument("--index-backend", choices=sorted(INDEX_BACKENDS), help="Nearest-neighbour index to build")
+    parser.add_argument("--index-params", default="{}", help='Index parameters as JSON, e.g. \'{"nlist": 128, "nprobe": 8}\'')
+    parser.add_argument("--migrate", action="store_true", help="Convert an existing storage directory to the current format")
+    parser.add_argument("--remove-legacy", action="store_true", help="Delete the old chunks/ directory after migrating")
+    parser.add_argument("--migrate-model", default=EMBEDDING_MODEL_NAME, help="Embedding model the store being migrated was built with")
+    args = parser.parse_args()
+    
+    if args.migrate:
+        migrate_storage(args.storage_dir, remove_legacy=args.remove_legacy, embedding_model=args.migrate_model)
+    elif args.extract_only:
+        _, _, _, stats = extract_chunks(args.pdf, workers=args.extract_workers, chunking=args.chunking)
+        print(json.dumps(stats, indent=2))
+    else:
+        process_pdf_to_chunks(
+            args.pdf, args.storage_dir, batch_size=args.batch_size, workers=args.workers, force=args.force,
+            index_backend=args.index_backend, index_params=json.loads(args.index_params),
+            extract_workers=args.extract_workers, chunking=args.chunking
+        )
\ No newline at end of file
@@ -0,0 +1,300 @@
+"""
+Module that assembles the retrieved chunks into the context sent to the LLM.
+
+Retrieval returns overlapping material: neighbouring chunks share up to
+CHUNK_OVERLAP characters, hybrid search can return a chunk and its neighbour,
+and the top hits are often near-duplicates of each other. Every repeated
+sentence costs input tokens, which drive the QA call's latency and quota.
+assemble_context therefore:
+
+1. picks k of the candidates by maximal marginal relevance (MMR), trading
+   relevance against similarity to the chunks already picked;
+2. merges picked chunks that are adjacent in the source (consecutive
+   chunk_index) into one passage, dropping the overlap between them;
+3. removes sentences already present in a passage ranked higher;
+4. keeps passages in rank order until the token budget is spent, cutting
+   the last one at a sentence boundary.
+
+Token counts are estimated from the text length, which is close enough for
+budgeting (Gemini averages about four characters per token on English).
+"""
+import re
+import logging
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+from chunks import CHUNK_OVERLAP
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+
+# Overlaps shorter than this between adjacent chunks are treated as chance
+MIN_OVERLAP = 8
+
+# Sentences shorter than this are never treated as duplicates
+MIN_DUPLICATE_LENGTH = 20
+
+# A cut passage is only kept if at least this many tokens of it fit
+MIN_PASSAGE_TOKENS = 32
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate number of LLM tokens in a text."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def count_tokens(chunks: List[Dict[str, Any]]) -> int:
+    """Approximate number of tokens in the texts of a list of chunks."""
+    return sum(estimate_tokens(chunk["text"]) for chunk in chunks)
+
+
+def mmr_select(relevance: np.ndarray, embeddings: np.ndarray, k: int, lambda_mult: float = 0.7) -> List[int]:
+    """
+    Maximal marginal relevance: repeatedly pick the candidate maximizing
+    lambda * relevance - (1 - lambda) * (max cosine similarity to the picked ones).
+
+    Args:
+        relevance: (n,) relevance of each candidate, higher is better
+        embeddings: (n, dim) L2-normalized candidate embeddings
+        k: Number of candidates to pick
+        lambda_mult: 1 for relevance only, 0 for diversity only
+
+    Returns:
+        Positions of the picked candidates, in the order they were picked
+    """
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    similarity = embeddings @ embeddings.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, n):
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+def _overlap(first: str, second: str, max_overlap: int) -> int:
+    """Length of the longest suffix of first that is also a prefix of second."""
+    for length in range(min(max_overlap, len(first), len(second)), MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def _join(first: str, second: str, max_overlap: int) -> str:
+    overlap = _overlap(first, second, max_overlap)
+    if overlap:
+        return first + second[overlap:]
+    return first.rstrip() + "\n" + second.lstrip()
+
+
+def _merge_metadata(group: List[Dict[str, Any]]) -> Dict[str, Any]:
+    metadata = dict(group[0]["metadata"])
+    pages = [chunk["metadata"][key] for chunk in group for key in ("page", "page_end") if key in chunk["metadata"]]
+    if pages:
+        metadata["page"], metadata["page_end"] = min(pages), max(pages)
+    verses = [verse for chunk in group for verse in chunk["metadata"].get("verses", [])]
+    if verses:
+        metadata["verses"] = list(dict.fromkeys(verses))
+    metadata["chunk_indexes"] = [chunk["metadata"]["chunk_index"] for chunk in group]
+    return metadata
+
+
+def _merge_run(run: List[Tuple[int, Dict[str, Any]]], max_overlap: int) -> Tuple[int, Dict[str, Any]]:
+    """Merge (rank, chunk) pairs of consecutive chunks into one (rank, passage) pair."""
+    if len(run) == 1:
+        return run[0]
+    chunks = [chunk for _, chunk in run]
+    text = chunks[0]["text"]
+    for chunk in chunks[1:]:
+        text = _join(text, chunk["text"], max_overlap)
+    return min(rank for rank, _ in run), {
+        "id": chunks[0]["id"],
+        "chunk_ids": [chunk["id"] for chunk in chunks],
+        "text": text,
+        "metadata": _merge_metadata(chunks),
+        "similarity": max(chunk.get("similarity", 0.0) for chunk in chunks)
+    }
+
+
+def merge_adjacent(chunks: List[Dict[str, Any]], max_overlap: int = 2 * CHUNK_OVERLAP) -> List[Dict[str, Any]]:
+    """
+    Merge chunks from consecutive positions of the same source into single
+    passages, without repeating the text the chunks overlap on. Each passage
+    takes the rank of its best-ranked chunk; chunks without a chunk_index
+    (e.g. verse lookups) are kept as they are.
+
+    Args:
+        chunks: Chunks as returned by similarity_search, best first
+        max_overlap: Longest overlap looked for between adjacent chunks, in characters
+
+    Returns:
+        Passages shaped like the chunks, best first; merged ones list the
+        ids of their chunks under "chunk_ids"
+    """
+    by_position: Dict[Tuple[str, int], Tuple[int, Dict[str, Any]]] = {}
+    passages: List[Tuple[int, Dict[str, Any]]] = []
+    for rank, chunk in enumerate(chunks):
+        index = chunk["metadata"].get("chunk_index")
+        if index is None:
+            passages.append((rank, chunk))
+        else:
+            # A chunk retrieved twice (e.g. by both halves of hybrid search) counts once
+            by_position.setdefault((chunk["metadata"].get("source", ""), index), (rank, chunk))
+
+    # Runs of consecutive chunk indexes of one source become one passage
+    keys = sorted(by_position)
+    start = 0
+    for end in range(1, len(keys) + 1):
+        if end < len(keys) and keys[end][0] == keys[end - 1][0] and keys[end][1] == keys[end - 1][1] + 1:
+            continue
+        passages.append(_merge_run([by_position[key] for key in keys[start:end]], max_overlap))
+        start = end
+    return [passage for _, passage in sorted(passages, key=lambda item: item[0])]
+
+
+def _sentences(text: str) -> List[str]:
+    return [sentence for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+def _sentence_spans(text: str) -> List[Tuple[int, int, int]]:
+    """
+    (start, stop, end) of each sentence of text: text[start:stop] is the
+    sentence as _sentences returns it, text[start:end] includes the separator
+    after it (a space, or the newlines that end a verse line).
+    """
+    spans = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        spans.append((start, match.start(), match.end()))
+        start = match.end()
+    spans.append((start, len(text), len(text)))
+    return [(start, stop, end) for start, stop, end in spans if text[start:stop].strip()]
+
+
+def _normalize_sentence(sentence: str) -> str:
+    return " ".join(sentence.lower().split())
+
+
+def remove_duplicate_spans(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Drop sentences that already appear in a chunk ranked higher, and chunks
+    left with nothing new. The remaining sentences keep the separators they
+    had, so verse lines stay on their own lines.
+    """
+    seen = set()
+    result = []
+    for chunk in chunks:
+        text = chunk["text"]
+        kept, pieces, removed = [], [], False
+        for start, stop, end in _sentence_spans(text):
+            sentence = text[start:stop]
+            key = _normalize_sentence(sentence)
+            if len(key) >= MIN_DUPLICATE_LENGTH and key in seen:
+                removed = True
+                continue
+            seen.add(key)
+            kept.append(sentence)
+            pieces.append(text[start:end])
+        # Nothing left but fragments (e.g. the cut-off sentence at a chunk boundary)
+        if not kept or (removed and all(len(_normalize_sentence(sentence)) < MIN_DUPLICATE_LENGTH for sentence in kept)):
+            continue
+        result.append(dict(chunk, text="".join(pieces).rstrip()) if removed else chunk)
+    return result
+
+
+def fit_budget(chunks: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+    """
+    Keep chunks in rank order until the token budget is spent; the first one
+    that does not fit is cut at a sentence boundary if enough of it fits.
+    The best chunk is always kept, cut if necessary.
+    """
+    if max_tokens <= 0:
+        return chunks
+    result = []
+    remaining = max_tokens
+    for chunk in chunks:
+        tokens = estimate_tokens(chunk["text"])
+        if tokens <= remaining:
+            result.append(chunk)
+            remaining -= tokens
+            continue
+        if remaining >= MIN_PASSAGE_TOKENS or not result:
+            # Cut after the last whole sentence that fits, keeping the line breaks before it
+            text = ""
+            for _, stop, _ in _sentence_spans(chunk["text"]):
+                candidate = chunk["text"][:stop].strip()
+                if estimate_tokens(candidate) > remaining:
+                    break
+                text = candidate
+            # A first sentence longer than the budget is cut at a word boundary
+            if not text and not result:
+                text = chunk["text"][:remaining * CHARS_PER_TOKEN].rsplit(" ", 1)[0]
+            if text:
+                result.append(dict(chunk, text=text))
+        break
+    return result
+
+
+def assemble_context(
+    candidates: List[Dict[str, Any]],
+    k: int,
+    max_tokens: int = 0,
+    lambda_mult: float = 1.0,
+    embeddings: Optional[np.ndarray] = None
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Build the LLM context from the retrieved candidates.
+
+    Args:
+        candidates: Chunks as returned by similarity_search, best first
+        k: Number of chunks to pick from the candidates
+        max_tokens: Token budget of the context (0 for no limit)
+        lambda_mult: MMR trade-off; 1 picks the top k by relevance
+        embeddings: (n, dim) embeddings of the candidates, needed for MMR
+
+    Returns:
+        Tuple of (passages, stats): stats has the chunks and tokens of the
+        plain top k ("chunks_before", "tokens_before") and of the passages
+        ("chunks_after", "tokens_after")
+    """
+    top = candidates[:k]
+    if lambda_mult < 1.0 and embeddings is not None and len(candidates) > k:
+        scores = np.array([candidate.get("similarity", 0.0) for candidate in candidates], dtype=np.float32)
+        spread = scores.max() - scores.min()
+        relevance = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+        picked = mmr_select(relevance, np.asarray(embeddings, dtype=np.float32), k, lambda_mult)
+        # Back in retrieval order, so merged passages keep the best rank
+        selected = [candidates[i] for i in sorted(picked)]
+    else:
+        selected = top
+
+    passages = fit_budget(remove_duplicate_spans(merge_adjacent(selected)), max_tokens)
+    stats = {
+        "chunks_before": len(top),
+        "tokens_before": count_tokens(top),
+        "chunks_after": len(passages),
+        "tokens_after": count_tokens(passages)
+    }
+    return passages, stats
+
+
+def compact_summary(answer: str, max_chars: int = 300) -> str:
+    """
+    Short extractive summary of an answer for follow-up prompts: its leading
+    sentences up to max_chars, without the SOURCES section.
+    """
+    text = answer.split("SOURCES:", 1)[0].strip()
+    summary = ""
+    for sentence in _sentences(text):
+        candidate = f"{summary} {sentence.strip()}" if summary else sentence.strip()
+        if len(candidate) > max_chars:
+            break
+        summary = candidate
+    return summary or text[:max_chars].rsplit(" ", 1)[0]
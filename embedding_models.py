@@ -0,0 +1,110 @@
+"""
+Module with the process-wide registry of embedding models.
+
+Ingestion (process_pdf_to_chunks), the query path (initialize_storage) and
+the benchmarks all get their model from get_embedding_model, so each model is
+loaded at most once per process however many callers ask for it, including
+concurrent first requests on several threads.
+
+A server can call preload_embedding_model in the parent process before it
+forks workers: the workers then inherit the loaded weights and share their
+memory pages copy-on-write instead of each loading a copy. Preloading only
+loads the weights; it runs no forward pass, since thread pools started by
+inference in the parent do not survive fork.
+"""
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+ModelKey = Tuple[str, str, Tuple[Tuple[str, Any], ...]]
+
+
+def _load_torch(model_name: str) -> Any:
+    # Deferred so that importing this module does not pay for torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _load_onnx(model_name: str, **options: Any) -> Any:
+    from onnx_embeddings import ONNXEmbeddings
+    model = ONNXEmbeddings(**options)
+    if model.model_name != model_name:
+        raise ValueError(f"{model.model_file} holds {model.model_name or 'an unknown model'}, not {model_name}")
+    return model
+
+
+# Backend name -> function(model_name, **options) that loads the model
+EMBEDDING_BACKENDS: Dict[str, Callable[..., Any]] = {
+    "torch": _load_torch,
+    "onnx": _load_onnx,
+}
+
+_models: Dict[ModelKey, Any] = {}
+_load_locks: Dict[ModelKey, threading.Lock] = {}
+_registry_lock = threading.Lock()
+
+
+def _key(model_name: str, backend: str, options: Dict[str, Any]) -> ModelKey:
+    return backend, model_name, tuple(sorted(options.items()))
+
+
+def get_embedding_model(model_name: str, backend: str = "torch", **options: Any) -> Any:
+    """
+    The shared instance of an embedding model, loaded on first use.
+
+    Callers asking for a model that is still loading wait for that load
+    instead of starting another one; different models load in parallel.
+
+    Args:
+        model_name: Hugging Face name of the model
+        backend: "torch" (sentence-transformers) or "onnx" (see onnx_embeddings.py)
+        **options: Backend options (for onnx: model_dir, quantized, threads);
+            each combination is a separate instance
+
+    Returns:
+        The model, with embed_query and embed_documents
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {sorted(EMBEDDING_BACKENDS)}")
+    key = _key(model_name, backend, options)
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _registry_lock:
+        lock = _load_locks.setdefault(key, threading.Lock())
+    with lock:
+        model = _models.get(key)
+        if model is None:
+            started = time.perf_counter()
+            model = EMBEDDING_BACKENDS[backend](model_name, **options)
+            _models[key] = model
+            logger.info(f"Loaded {model_name} ({backend}) in {time.perf_counter() - started:.2f}s")
+    return model
+
+
+def preload_embedding_model(model_name: str, backend: str = "torch", **options: Any) -> Any:
+    """
+    Load a model in this process ahead of time, e.g. in a server's parent
+    process before it forks workers, so they share the weights.
+    """
+    model = get_embedding_model(model_name, backend, **options)
+    logger.info(f"Preloaded {model_name} ({backend}) for worker processes")
+    return model
+
+
+def loaded_models() -> List[Dict[str, Any]]:
+    """Models loaded in this process, as {backend, model_name, options} entries."""
+    return [
+        {"backend": backend, "model_name": model_name, "options": dict(options)}
+        for backend, model_name, options in list(_models)
+    ]
+
+
+def clear_embedding_models() -> None:
+    """Drop all loaded models (they are freed once no store references them)."""
+    with _registry_lock:
+        _models.clear()
+        _load_locks.clear()
@@ -0,0 +1,245 @@
+"""
+Module with a BM25 inverted index over the chunk texts.
+
+Dense MiniLM search misses exact terms such as Sanskrit names ("Arjuna",
+"Kurukshetra", "sthitaprajna") and needs an embedding forward pass per query.
+The inverted index scores those terms directly and needs no model at all.
+
+Postings are stored in CSR layout as flat NumPy arrays:
+- terms:          (V,) sorted vocabulary
+- offsets:        (V + 1,) start of each term's postings
+- rows:           (P,) int32 chunk rows, grouped by term and ascending within a term
+- term_freqs:     (P,) uint16 occurrences of the term in the chunk
+- doc_lengths:    (N,) int32 number of tokens in each chunk
+
+The index is built at ingestion time and persisted next to index.json. Run this
+module directly to build the index for a store or to try queries against it.
+"""
+import os
+import re
+import time
+import logging
+import unicodedata
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from ann_index import top_k
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_FILE = "lexical_bm25.npz"
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in into is it its me my no not of on or "
+    "our she so than that the their them then there these they this to was we were what when where which "
+    "who whom why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase, strip diacritics (so "sthitaprajña" matches "sthitaprajna") and
+    split into alphanumeric tokens, dropping common English stopwords.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [token for token in _TOKEN_PATTERN.findall(text) if token not in _STOPWORDS]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index. k1 controls term-frequency saturation
+    and b the document-length normalization.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int32)
+        self.term_freqs = np.zeros(0, dtype=np.uint16)
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+        self.idf = np.zeros(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def build(self, texts: Iterable[str]) -> None:
+        """Build the index over the chunk texts, in row order."""
+        started = time.perf_counter()
+        term_ids: Dict[str, int] = {}
+        posting_terms: List[np.ndarray] = []
+        posting_rows: List[np.ndarray] = []
+        posting_freqs: List[np.ndarray] = []
+        doc_lengths = []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            if not tokens:
+                continue
+            ids, freqs = np.unique(
+                np.fromiter((term_ids.setdefault(token, len(term_ids)) for token in tokens), dtype=np.int64),
+                return_counts=True
+            )
+            posting_terms.append(ids)
+            posting_rows.append(np.full(len(ids), row, dtype=np.int32))
+            posting_freqs.append(freqs)
+
+        # Renumber terms in sorted order and group postings by term (rows stay ascending)
+        terms = sorted(term_ids)
+        renumber = np.empty(len(terms), dtype=np.int64)
+        for new_id, term in enumerate(terms):
+            renumber[term_ids[term]] = new_id
+        if posting_terms:
+            all_terms = renumber[np.concatenate(posting_terms)]
+            order = np.argsort(all_terms, kind="stable")
+            self.rows = np.concatenate(posting_rows)[order]
+            self.term_freqs = np.minimum(np.concatenate(posting_freqs)[order], np.iinfo(np.uint16).max).astype(np.uint16)
+            counts = np.bincount(all_terms, minlength=len(terms))
+        else:
+            counts = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.int32)
+        self._compute_idf()
+        logger.info(
+            f"Built BM25 index with {len(terms)} terms and {len(self.rows)} postings over "
+            f"{len(self.doc_lengths)} chunks in {time.perf_counter() - started:.2f}s"
+        )
+
+    def _compute_idf(self) -> None:
+        doc_freqs = np.diff(self.offsets).astype(np.float64)
+        n = len(self.doc_lengths)
+        self.idf = np.log(1.0 + (n - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        self._avg_length = float(self.doc_lengths.mean()) if n else 0.0
+
+    def scores(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        BM25 scores of the chunks that contain at least one query term.
+
+        Returns:
+            Tuple of (rows, scores), rows ascending
+        """
+        term_ids = sorted({self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary})
+        if not term_ids or not self._avg_length:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        totals = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows = self.rows[start:end]
+            tf = self.term_freqs[start:end].astype(np.float32)
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[rows] / self._avg_length)
+            # Each row appears once per term, so fancy-index addition is safe
+            totals[rows] += self.idf[term_id] * tf * (self.k1 + 1.0) / (tf + norm)
+        rows = np.flatnonzero(totals)
+        return rows, totals[rows]
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k chunks with the highest BM25 score for the query.
+
+        Returns:
+            Tuple of (rows, scores), best match first; empty if no term matches
+        """
+        rows, scores = self.scores(query)
+        return top_k(scores, k, rows)
+
+    def save(self, storage_dir: str) -> None:
+        """Persist the index next to index.json."""
+        path = os.path.join(storage_dir, LEXICAL_INDEX_FILE)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                terms=np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str),
+                offsets=self.offsets,
+                rows=self.rows,
+                term_freqs=self.term_freqs,
+                doc_lengths=self.doc_lengths,
+                params=np.array([self.k1, self.b], dtype=np.float64)
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, storage_dir: str) -> "BM25Index":
+        """Load a persisted index."""
+        with np.load(os.path.join(storage_dir, LEXICAL_INDEX_FILE)) as data:
+            k1, b = data["params"]
+            index = cls(k1=float(k1), b=float(b))
+            index.vocabulary = {str(term): i for i, term in enumerate(data["terms"])}
+            index.offsets = data["offsets"]
+            index.rows = data["rows"]
+            index.term_freqs = data["term_freqs"]
+            index.doc_lengths = data["doc_lengths"]
+        index._compute_idf()
+        return index
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int, constant: int = 60) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fuse ranked row lists: each row scores sum(1 / (constant + rank)) over the
+    lists it appears in (rank starting at 1).
+
+    Args:
+        rankings: Row arrays, best first
+        k: Number of results to return
+        constant: RRF smoothing constant (60 in the original paper)
+
+    Returns:
+        Tuple of (rows, fused scores), best first
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (constant + rank)
+    if not fused:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    rows = np.fromiter(fused.keys(), dtype=np.int64, count=len(fused))
+    scores = np.fromiter(fused.values(), dtype=np.float32, count=len(fused))
+    return top_k(scores, k, rows)
+
+
+def load_lexical_index(storage_dir: str, config: Optional[Dict[str, Any]], rows: int) -> Optional[BM25Index]:
+    """
+    Load the index described by the "lexical_index" entry of index.json metadata.
+
+    Args:
+        storage_dir: Directory of the store
+        config: The stored {"backend", "params", "rows"} entry, or None
+        rows: Number of rows in the store
+
+    Returns:
+        The index, or None if it was never built or is out of date
+    """
+    if not config:
+        return None
+    if config.get("rows") != rows or not os.path.exists(os.path.join(storage_dir, LEXICAL_INDEX_FILE)):
+        logger.warning(f"BM25 index covers {config.get('rows')} rows but the store has {rows}; it will be rebuilt")
+        return None
+    return BM25Index.load(storage_dir)
+
+
+if __name__ == "__main__":
+    # Build the BM25 index for a store and/or run keyword queries against it
+    import argparse
+    from chunks import LocalChunkStorage
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build and query the BM25 index of a chunk store")
+    parser.add_argument("--storage-dir", default="data_blocks", help="Directory of the chunk store")
+    parser.add_argument("--build", action="store_true", help="Build and persist the index for the store")
+    parser.add_argument("--k1", type=float, default=1.2, help="BM25 term-frequency saturation")
+    parser.add_argument("--b", type=float, default=0.75, help="BM25 length normalization")
+    parser.add_argument("--k", type=int, default=3, help="Number of results per query")
+    parser.add_argument("queries", nargs="*", help="Queries to run")
+    args = parser.parse_args()
+
+    storage = LocalChunkStorage(args.storage_dir, embedding_model=None, search_mode="lexical")
+    if args.build:
+        storage.build_lexical_index(k1=args.k1, b=args.b)
+    for query in args.queries:
+        started = time.perf_counter()
+        results = storage.similarity_search(query, k=args.k)
+        print(f"{query!r}: {(time.perf_counter() - started) * 1000:.2f} ms")
+        for result in results:
+            print(f"  {result['similarity']:.3f} {result['metadata']} {result['text'][:80]!r}")
@@ -1,58 +1,409 @@
 import os
+import re
 import time
+import threading
 import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables.config import run_in_executor
+from metrics import REGISTRY, span
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Models to try, in order of preference
+RETRY_MODELS = [
+    "gemini-2.0-flash", # Try this model first (higher quota)
+    "gemini-2.5-flash"         # Fall back to this older model if needed
+]
+
+# Errors that mean "try another key/model" rather than "this request is bad"
+_ROTATE_ERROR_MARKERS = (
+    "429", "quota", "resource exhausted", "resourceexhausted", "rate limit",
+    "401", "403", "api key not valid", "permission denied", "unavailable", "deadline exceeded"
+)
+
+
+class UpstreamBusyError(RuntimeError):
+    """Raised when every API key is at its concurrency limit for longer than the queue timeout."""
+
+
+def _record_usage(details: Dict[str, Any], messages: List[BaseMessage]) -> None:
+    """Add the token counts reported with LLM output messages to a span and the token counters."""
+    for direction in ("input", "output"):
+        tokens = sum((getattr(message, "usage_metadata", None) or {}).get(f"{direction}_tokens", 0) for message in messages)
+        if tokens:
+            details[f"{direction}_tokens"] = tokens
+            REGISTRY.inc("gita_llm_tokens_total", tokens, help="Tokens sent to and received from the LLM", direction=direction)
+
+
+def _timed_stream(chunks: Iterator[ChatGenerationChunk], backend: str) -> Iterator[ChatGenerationChunk]:
+    """Time a streamed LLM call from the request to the last chunk, noting the time to first token."""
+    with span("llm_call", backend=backend) as details:
+        started = time.perf_counter()
+        messages = []
+        for chunk in chunks:
+            if not messages:
+                details["first_token_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            messages.append(chunk.message)
+            yield chunk
+        _record_usage(details, messages)
+
+
+def _should_rotate(error: Exception) -> bool:
+    """Check whether an LLM error is a quota, auth or availability problem of the client."""
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in _ROTATE_ERROR_MARKERS)
+
+
+class GeminiClientPool:
+    """
+    Long-lived pool of Gemini clients, one per (API key, model) pair.
+
+    Clients are created once and handed out without a live probe. A client
+    that fails with a quota or auth error is put on cooldown and the next one
+    is used. A background thread probes cooled-down clients and returns them
+    to service once they answer again.
+    
+    Each API key has a semaphore bounding its in-flight calls. A call that
+    cannot get a slot on any key within queue_timeout raises UpstreamBusyError
+    instead of queueing indefinitely.
+    """
+    def __init__(
+        self,
+        api_keys: List[str],
+        models: List[str],
+        quota_cooldown: float = 60.0,
+        health_check_interval: float = 30.0,
+        max_concurrency_per_key: int = 4,
+        queue_timeout: float = 5.0
+    ):
+        """
+        Args:
+            api_keys: Gemini API keys, in order of preference
+            models: Model names, in order of preference
+            quota_cooldown: Seconds a failing client is kept out of rotation
+            health_check_interval: Seconds between background health checks
+            max_concurrency_per_key: Maximum in-flight calls per API key
+            queue_timeout: Seconds to wait for a free slot before giving up
+        """
+        self.quota_cooldown = quota_cooldown
+        self.health_check_interval = health_check_interval
+        self.queue_timeout = queue_timeout
+        self._key_slots = [threading.BoundedSemaphore(max_concurrency_per_key) for _ in api_keys]
+        self.clients: List[Dict[str, Any]] = []
+        for key_index, api_key in enumerate(api_keys):
+            for model in models:
+                self.clients.append({
+                    "name": f"{model} (key {key_index + 1})",
+                    "key_index": key_index,
+                    "llm": ChatGoogleGenerativeAI(
+                        model=model,
+                        temperature=0.2,  # Slightly higher temperature for more varied responses
+                        google_api_key=api_key,
+                        convert_system_message_to_human=True,  # Better compatibility across models
+                        max_retries=1  # Only retry once per request to avoid quota issues
+                    ),
+                    "cooldown_until": 0.0,
+                    "failures": 0,
+                    "requests": 0
+                })
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+        self._health_pid = 0
+        self._ensure_health_thread()
+        logger.info(f"Created Gemini client pool with {len(self.clients)} clients")
+
+    def _candidates(self) -> List[Dict[str, Any]]:
+        """Clients in order of preference: those not on cooldown first, then by recovery time."""
+        now = time.monotonic()
+        with self._lock:
+            ready = [client for client in self.clients if client["cooldown_until"] <= now]
+            cooling = sorted(
+                (client for client in self.clients if client["cooldown_until"] > now),
+                key=lambda c: c["cooldown_until"]
+            )
+        return ready + cooling
+
+    def _reserve(self, exclude: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Pick a client and take a concurrency slot on its API key. Prefers the
+        first candidate whose key has a free slot, otherwise waits up to
+        queue_timeout for the preferred one.
+        """
+        self._ensure_health_thread()
+        candidates = [client for client in self._candidates() if client not in exclude] or self._candidates()
+        for client in candidates:
+            if self._key_slots[client["key_index"]].acquire(blocking=False):
+                break
+        else:
+            client = candidates[0]
+            if not self._key_slots[client["key_index"]].acquire(timeout=self.queue_timeout):
+                raise UpstreamBusyError("All Gemini API keys are at their concurrency limit")
+        with self._lock:
+            client["requests"] += 1
+        return client
+
+    def _release(self, client: Dict[str, Any]) -> None:
+        self._key_slots[client["key_index"]].release()
+
+    def report_failure(self, client: Dict[str, Any], error: Exception) -> None:
+        """Take a client out of rotation after a quota/auth/availability error."""
+        with self._lock:
+            client["failures"] += 1
+            client["cooldown_until"] = time.monotonic() + self.quota_cooldown
+        logger.warning(f"Gemini client {client['name']} failed, rotating to the next one: {error}")
+
+    def _ensure_health_thread(self) -> None:
+        """Start the health-check thread, again in a worker forked after the pool was created."""
+        if self._health_pid == os.getpid() and self._health_thread.is_alive():
+            return
+        self._health_pid = os.getpid()
+        self._health_thread = threading.Thread(target=self._health_loop, name="gemini-health", daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self) -> None:
+        """Probe clients on cooldown in the background and restore the ones that answer."""
+        while not self._stop.wait(self.health_check_interval):
+            now = time.monotonic()
+            for client in self.clients:
+                if client["cooldown_until"] <= now:
+                    continue
+                try:
+                    client["llm"].invoke("Hello")
+                except Exception as e:
+                    logger.debug(f"Health check of {client['name']} failed: {e}")
+                    continue
+                with self._lock:
+                    client["cooldown_until"] = 0.0
+                logger.info(f"Gemini client {client['name']} is healthy again")
+
+    def call(self, fn: Callable[[Any], Any]) -> Any:
+        """Run fn(llm) with the current client, rotating through the pool on quota/auth errors."""
+        last_error: Optional[Exception] = None
+        tried: List[Dict[str, Any]] = []
+        for _ in range(len(self.clients)):
+            client = self._reserve(tried)
+            tried.append(client)
+            try:
+                return fn(client["llm"])
+            except Exception as e:
+                if not _should_rotate(e):
+                    raise
+                self.report_failure(client, e)
+                last_error = e
+            finally:
+                self._release(client)
+        logger.error("All Gemini models and API keys failed")
+        raise last_error
+
+    def stream(self, fn: Callable[[Any], Iterator[Any]]) -> Iterator[Any]:
+        """
+        Stream from fn(llm), holding the key's slot until the stream ends.
+        Rotation can only happen before the first chunk has been produced.
+        """
+        last_error: Optional[Exception] = None
+        tried: List[Dict[str, Any]] = []
+        for _ in range(len(self.clients)):
+            client = self._reserve(tried)
+            tried.append(client)
+            try:
+                stream = fn(client["llm"])
+                first = next(stream, None)
+            except Exception as e:
+                self._release(client)
+                if not _should_rotate(e):
+                    raise
+                self.report_failure(client, e)
+                last_error = e
+                continue
+            try:
+                if first is not None:
+                    yield first
+                yield from stream
+            finally:
+                self._release(client)
+            return
+        logger.error("All Gemini models and API keys failed")
+        raise last_error
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Per-client request/failure counts and cooldown state."""
+        now = time.monotonic()
+        return [
+            {
+                "name": client["name"],
+                "requests": client["requests"],
+                "failures": client["failures"],
+                "cooldown_remaining": max(0.0, client["cooldown_until"] - now)
+            }
+            for client in self.clients
+        ]
+
+    def close(self) -> None:
+        """Stop the background health checks."""
+        self._stop.set()
+
+
+class PooledChatModel(BaseChatModel):
+    """Chat model that sends each call to the current client of a GeminiClientPool."""
+    pool: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "gemini-pool"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        with span("llm_call", backend="gemini") as details:
+            result = self.pool.call(lambda llm: llm._generate(messages, stop=stop, run_manager=run_manager, **kwargs))
+            _record_usage(details, [generation.message for generation in result.generations])
+            return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        # The pooled clients live for the whole process, but a Gemini client
+        # caches its grpc-asyncio channel on the event loop that first used it,
+        # and each request and batch runs on a new loop. Async calls therefore
+        # go through the sync client in a worker thread (with the caller's
+        # context, so the span lands in the request's trace)
+        return await run_in_executor(
+            None, self._generate, messages, stop, run_manager.get_sync() if run_manager else None, **kwargs
+        )
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        yield from _timed_stream(
+            self.pool.stream(lambda llm: llm._stream(messages, stop=stop, run_manager=run_manager, **kwargs)), "gemini"
+        )
+
+
+class FakeGeminiLLM(BaseChatModel):
+    """
+    Local stand-in for Gemini, used when LLM_BACKEND=fake. It follows the
+    ReAct format well enough to drive the agent through the RAG_QA tool, so
+    the whole pipeline can be run and timed offline.
+    """
+    latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def _respond(self, messages: List[BaseMessage]) -> str:
+        prompt = str(messages[-1].content)
+        if "Action Input:" in prompt and "\nQuestion: " in prompt:
+            # ReAct prompt: the scratchpad follows the last "Question:" line
+            question, _, scratchpad = prompt.rsplit("\nQuestion: ", 1)[1].partition("\n")
+            if "Observation:" in scratchpad:
+                observation = scratchpad.rsplit("Observation:", 1)[1].split("\nThought:", 1)[0].strip()
+                # Tool results are dicts; answer with the QA chain's text
+                if "'output_text': " in observation:
+                    observation = observation.split("'output_text': ", 1)[1].strip("'\"} ")
+                return f"Thought: I now know the final answer\nFinal Answer: {observation[:300]}"
+            return f"Thought: This is a question about the Bhagavad Gita.\nAction: RAG_QA\nAction Input: {question.strip()}"
+        return (
+            "According to the Bhagavad Gita, one should perform one's duty without "
+            "attachment to the fruits of action.\nSOURCES: The Bhagavad Gita"
+        )
+
+    @staticmethod
+    def _usage(messages: List[BaseMessage], text: str) -> Dict[str, int]:
+        """Word counts standing in for the token usage Gemini reports."""
+        input_tokens = sum(len(str(message.content).split()) for message in messages)
+        output_tokens = len(text.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        with span("llm_call", backend="fake") as details:
+            self.calls += 1
+            time.sleep(self.latency)
+            text = self._respond(messages)
+            message = AIMessage(content=text, usage_metadata=self._usage(messages, text))
+            _record_usage(details, [message])
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        yield from _timed_stream(self._stream_tokens(messages, run_manager), "fake")
+
+    def _stream_tokens(self, messages: List[BaseMessage], run_manager: Any) -> Iterator[ChatGenerationChunk]:
+        self.calls += 1
+        time.sleep(self.latency)
+        text = self._respond(messages)
+        for i, token in enumerate(re.findall(r"\S+\s*", text)):
+            # Usage is reported once, with the first chunk
+            usage = self._usage(messages, text) if i == 0 else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+# Process-wide LLM shared by the agent, the QA chain and the fallback path
+_shared_llm: Optional[BaseChatModel] = None
+_shared_llm_lock = threading.Lock()
+
+
 def get_gemini_llm():
     """
-    Initialize and return a Gemini language model.
-    First tries Gemini 2.0 Flash, then falls back to Gemini 1.5 Pro if rate limited.
+    Return the process-wide Gemini language model.
+    First tries Gemini 2.0 Flash, then falls back to Gemini 2.5 Flash if rate limited.
     API key is loaded from environment variables.
     Will try with alternate API key if primary key fails.
+
+    The model is backed by a long-lived client pool: no test request is made
+    here, and quota errors rotate to the next key/model at call time.
+    LLM_MAX_CONCURRENCY_PER_KEY bounds in-flight calls per API key and
+    LLM_QUEUE_TIMEOUT is how long a call waits for a free slot.
+    Set LLM_BACKEND=fake to use a local fake model instead (FAKE_LLM_LATENCY
+    adds a simulated delay in seconds per call).
     """
-    # Load environment variables
-    load_dotenv()
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
-    alternate_key = os.getenv("ALTERNATE_GEMINI_API_KEY")
-    
-    if not gemini_api_key:
-        error_msg = "GEMINI_API_KEY not found in environment variables"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-    
-    # Configure retry settings - these can help with rate limits
-    retry_models = [
-        "gemini-2.0-flash", # Try this model first (higher quota)
-        "gemini-2.5-flash"         # Fall back to this older model if needed
-    ]
-    
-    # Try each available key with each model until one works
-    for api_key in [gemini_api_key, alternate_key]:
-        if not api_key:
-            continue
-            
-        for model in retry_models:
-            try:
-                logger.info(f"Trying to initialize {model} with API key")
-                llm = ChatGoogleGenerativeAI(
-                    model=model,
-                    temperature=0.2,  # Slightly higher temperature for more varied responses
-                    google_api_key=api_key,
-                    convert_system_message_to_human=True,  # Better compatibility across models
-                    max_retries=1  # Only retry once per request to avoid quota issues
-                )
-                # Test the model with a simple query to make sure it works
-                llm.invoke("Hello")
-                logger.info(f"Successfully initialized {model}")
-                return llm
-            except Exception as e:
-                logger.warning(f"Error with {model}: {e}")
-                time.sleep(1)  # Add a small delay before trying the next option
-    
-    # If we get here, all options failed
-    logger.error("All Gemini models and API keys failed")
-    raise ValueError("Unable to initialize any Gemini model with available API keys")
\ No newline at end of file
+    global _shared_llm
+    with _shared_llm_lock:
+        if _shared_llm is not None:
+            return _shared_llm
+
+        # Load environment variables
+        load_dotenv()
+        if os.getenv("LLM_BACKEND", "gemini").lower() == "fake":
+            logger.info("Using local fake LLM")
+            _shared_llm = FakeGeminiLLM(latency=float(os.getenv("FAKE_LLM_LATENCY", "0")))
+            return _shared_llm
+
+        gemini_api_key = os.getenv("GEMINI_API_KEY")
+        alternate_key = os.getenv("ALTERNATE_GEMINI_API_KEY")
+
+        if not gemini_api_key:
+            error_msg = "GEMINI_API_KEY not found in environment variables"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+
+        api_keys = [key for key in [gemini_api_key, alternate_key] if key]
+        _shared_llm = PooledChatModel(pool=GeminiClientPool(
+            api_keys,
+            RETRY_MODELS,
+            max_concurrency_per_key=int(os.getenv("LLM_MAX_CONCURRENCY_PER_KEY", "4")),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))
+        ))
+        return _shared_llm
+
+
+if __name__ == "__main__":
+    # Time LLM setup and calls, e.g. offline with LLM_BACKEND=fake
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Time LLM setup and per-call overhead")
+    parser.add_argument("--calls", type=int, default=20, help="Number of calls to time")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    llm = get_gemini_llm()
+    setup = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(args.calls):
+        get_gemini_llm().invoke("What is karma yoga?")
+    per_call = (time.perf_counter() - started) / args.calls
+    print(f"setup: {setup * 1000:.1f} ms, per call (including get_gemini_llm): {per_call * 1000:.2f} ms")
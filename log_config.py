@@ -0,0 +1,156 @@
+"""
+Module that sets up non-blocking logging for the app.
+
+Request threads only put log records on an in-memory queue (QueueHandler);
+a background QueueListener thread formats them and writes them to the
+console and to a size-rotated file in agent_logs/. Slow disks or a slow
+terminal therefore never add to request latency.
+
+Records are written as one JSON object per line (LOG_FORMAT=json, the
+default in production) or as plain text. Processes forked after setup
+(gunicorn workers) restart the listener and write to their own file,
+bhagavad_gita.<pid>.log, since rotation is not safe across processes.
+"""
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import datetime
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR = "agent_logs"
+LOG_FILE = "bhagavad_gita.log"
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed with extra={...}
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, including any extra={...} fields."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _RecordQueueHandler(QueueHandler):
+    """
+    Queues records with their message merged but otherwise unformatted, so the
+    traceback stays a separate field for the JSON formatter
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_setup_lock = threading.Lock()
+_queue_handler: Optional[_RecordQueueHandler] = None
+_listener: Optional[QueueListener] = None
+_settings: Dict[str, Any] = {}
+
+
+def _create_handlers(log_file: str) -> List[logging.Handler]:
+    formatter = JsonFormatter() if _settings["json_format"] else logging.Formatter(TEXT_FORMAT)
+    os.makedirs(_settings["log_dir"], exist_ok=True)
+    file_handler = RotatingFileHandler(
+        os.path.join(_settings["log_dir"], log_file),
+        maxBytes=_settings["max_bytes"],
+        backupCount=_settings["backup_count"],
+        encoding="utf-8",
+        delay=True  # Processes that never log (e.g. embedding workers) create no file
+    )
+    console_handler = logging.StreamHandler(sys.stderr)
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+    return [file_handler, console_handler]
+
+
+def _start_listener(log_file: str) -> None:
+    global _listener
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, *_create_handlers(log_file), respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork() -> None:
+    """The listener thread doesn't survive fork: start a new one, on a new queue and file"""
+    if _listener is not None:
+        root, ext = os.path.splitext(LOG_FILE)
+        _start_listener(f"{root}.{os.getpid()}{ext}")
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the listener thread (registered to run at exit)."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+def setup_logging(
+    level: Optional[str] = None,
+    json_format: Optional[bool] = None,
+    log_dir: str = LOG_DIR,
+    max_bytes: Optional[int] = None,
+    backup_count: Optional[int] = None
+) -> None:
+    """
+    Route all logging through a queue to a background writer (once per process).
+
+    Args:
+        level: Root log level (defaults to LOG_LEVEL or INFO)
+        json_format: JSON lines instead of plain text (defaults to LOG_FORMAT == "json")
+        log_dir: Directory of the log files
+        max_bytes: Size at which the log file is rotated (defaults to LOG_MAX_BYTES or 10 MB)
+        backup_count: Rotated files kept (defaults to LOG_BACKUP_COUNT or 5)
+    """
+    global _queue_handler
+    with _setup_lock:
+        if _queue_handler is not None:
+            return
+        _settings.update(
+            json_format=os.getenv("LOG_FORMAT", "text").lower() == "json" if json_format is None else json_format,
+            log_dir=log_dir,
+            max_bytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))) if max_bytes is None else max_bytes,
+            backup_count=int(os.getenv("LOG_BACKUP_COUNT", "5")) if backup_count is None else backup_count
+        )
+        _queue_handler = _RecordQueueHandler(queue.SimpleQueue())
+        _start_listener(LOG_FILE)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        root.addHandler(_queue_handler)
+        root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+
+        atexit.register(stop_logging)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_restart_after_fork)
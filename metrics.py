@@ -0,0 +1,193 @@
+"""
+Module with low-overhead timing spans and Prometheus-style metrics.
+
+Code wraps each stage of answering a query in span("stage"): query embedding,
+the vector scan, every LLM call, the agent and the fallback path. A span
+records its duration into a latency histogram and, when a request trace is
+active (see start_trace), into that request's timing breakdown.
+
+All metrics live in process memory; REGISTRY.render() formats them in the
+Prometheus text exposition format for the /metrics endpoint. Under a
+multi-worker server each worker reports its own numbers.
+"""
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets, from a cached
+# embedding lookup (sub-millisecond) to a slow agent run
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_LABEL_ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n"}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return "".join(_LABEL_ESCAPES.get(c, c) for c in value)
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observed values, thread-safe."""
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """Cumulative bucket counts (the last one is +Inf), sum and count."""
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class MetricsRegistry:
+    """
+    Named histograms and counters, each split by a set of label values.
+    Metric names are registered on first use together with their help text.
+    """
+    def __init__(self):
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, help: str = "", buckets: Iterable[float] = LATENCY_BUCKETS, **labels: Any) -> None:
+        """Add a value to the histogram with the given labels."""
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        series = self._histograms.get(name)
+        histogram = series.get(key) if series is not None else None
+        if histogram is None:
+            with self._lock:
+                self._help.setdefault(name, ("histogram", help))
+                histogram = self._histograms.setdefault(name, {}).setdefault(key, Histogram(buckets))
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1.0, help: str = "", **labels: Any) -> None:
+        """Increase the counter with the given labels."""
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            self._help.setdefault(name, ("counter", help))
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = {name: dict(series) for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            help_texts = dict(self._help)
+        for name in sorted(histograms):
+            lines.extend(format_header(name, *help_texts[name]))
+            for labels, histogram in sorted(histograms[name].items()):
+                cumulative, total, count = histogram.snapshot()
+                for bound, c in zip(histogram.buckets + (float("inf"),), cumulative):
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', le))} {c}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for name in sorted(counters):
+            lines.extend(format_header(name, *help_texts[name]))
+            for labels, value in sorted(counters[name].items()):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._help.clear()
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def format_header(name: str, metric_type: str, help: str) -> List[str]:
+    """The # HELP and # TYPE lines of a metric."""
+    return [f"# HELP {name} {help}", f"# TYPE {name} {metric_type}"]
+
+
+def format_samples(name: str, metric_type: str, help: str, samples: Dict[Labels, float]) -> List[str]:
+    """Lines of a metric computed on demand (e.g. cache hit counts), labels -> value."""
+    lines = format_header(name, metric_type, help)
+    for labels, value in sorted(samples.items()):
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return lines
+
+
+# Process-wide registry behind span() and /metrics
+REGISTRY = MetricsRegistry()
+
+# Timing breakdown of the request being handled: a list of spans shared with
+# the threads and tasks the request starts (they copy the context)
+_trace: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace() -> List[Dict[str, Any]]:
+    """Start collecting the spans of the current request; returns the (live) list."""
+    trace: List[Dict[str, Any]] = []
+    _trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(stage: str, **labels: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time a stage of the query path into the gita_stage_seconds histogram and
+    the current request's trace.
+
+    Yields a dict the caller may add details to (e.g. token counts), which
+    end up in the trace entry.
+    """
+    details: Dict[str, Any] = {}
+    started = time.perf_counter()
+    try:
+        yield details
+    finally:
+        seconds = time.perf_counter() - started
+        REGISTRY.observe("gita_stage_seconds", seconds, help="Time spent in each stage of answering a query", stage=stage, **labels)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append({"stage": stage, **labels, **details, "ms": round(seconds * 1000, 3)})
+
+
+def summarize_trace(trace: List[Dict[str, Any]], total_seconds: float) -> Dict[str, Any]:
+    """
+    Per-request timing breakdown: every span in the order it finished, plus
+    the total time per stage (spans can nest, so the totals may overlap).
+    """
+    by_stage: Dict[str, float] = {}
+    for entry in trace:
+        by_stage[entry["stage"]] = round(by_stage.get(entry["stage"], 0.0) + entry["ms"], 3)
+    return {"total_ms": round(total_seconds * 1000, 3), "by_stage": by_stage, "spans": list(trace)}
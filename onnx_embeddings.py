@@ -0,0 +1,282 @@
+"""
+Module with an ONNX Runtime backend for the MiniLM query encoder.
+
+HuggingFaceEmbeddings runs the model through PyTorch, which dominates the
+app's cold start and resident memory, and encoding the query is the biggest
+CPU cost of a request. This backend runs the same model exported to ONNX
+(optionally with int8 dynamically quantized weights) under onnxruntime, with
+the fast tokenizer from the tokenizers package; neither needs torch.
+
+Exporting needs torch and transformers once, on any machine:
+    python onnx_embeddings.py --export                  # writes models/all-MiniLM-L6-v2-onnx/
+    python onnx_embeddings.py --parity                  # cosine similarity against the torch model
+    python onnx_embeddings.py --benchmark --threads 1   # per-query encode latency
+
+Set EMBEDDING_BACKEND=onnx to encode queries with it. Stored chunk embeddings
+are still computed by the torch model at ingestion time.
+"""
+import os
+import time
+import json
+import logging
+import numpy as np
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_DIR = os.path.join("models", "all-MiniLM-L6-v2-onnx")
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_FILE = "model.int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+
+# all-MiniLM-L6-v2 truncates inputs to 256 word pieces
+MAX_SEQ_LENGTH = 256
+
+# Sample texts for the parity check and benchmark when no store is given
+_SAMPLE_TEXTS = [
+    "What does Krishna teach about karma yoga?",
+    "You have a right to perform your prescribed duties, but you are not entitled to the fruits of your actions.",
+    "Who is Arjuna and why does he refuse to fight at Kurukshetra?",
+    "The soul is neither born, nor does it ever die.",
+    "Explain the three gunas: sattva, rajas and tamas.",
+    "How can one attain peace through detachment from desire?",
+    "sthitaprajna",
+    "What is dharma?",
+]
+
+
+def _onnxruntime() -> Any:
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnx embedding backend requires onnxruntime and tokenizers: pip install onnxruntime tokenizers")
+    return onnxruntime
+
+
+class ONNXEmbeddings:
+    """
+    Sentence embeddings from an ONNX export of a sentence-transformers model:
+    token embeddings mean-pooled over the attention mask, then L2-normalized,
+    as sentence-transformers does for all-MiniLM-L6-v2.
+    """
+    def __init__(
+        self,
+        model_dir: str = ONNX_MODEL_DIR,
+        quantized: bool = True,
+        threads: int = 0,
+        model_name: Optional[str] = None
+    ):
+        """
+        Args:
+            model_dir: Directory written by export_onnx
+            quantized: Use the int8 model if it was exported
+            threads: Intra-op threads of the runtime (0 lets onnxruntime decide)
+            model_name: Name of the exported model (read from the export by default)
+        """
+        onnxruntime = _onnxruntime()
+        from tokenizers import Tokenizer
+
+        model_file = os.path.join(model_dir, ONNX_QUANTIZED_FILE if quantized else ONNX_MODEL_FILE)
+        if quantized and not os.path.exists(model_file):
+            logger.warning(f"No quantized model in {model_dir}, using the float model")
+            model_file = os.path.join(model_dir, ONNX_MODEL_FILE)
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"No ONNX model in {model_dir}; export one with: python onnx_embeddings.py --export")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+        export_info = _read_export_info(model_dir)
+        self.model_name = model_name or export_info.get("model_name", "")
+        self.model_file = model_file
+        logger.info(f"Loaded ONNX encoder {model_file} ({threads or 'default'} threads)")
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        token_embeddings = self.session.run(None, feeds)[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (pooled / norms).astype(np.float32)
+
+    def embed_documents(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
+        if not texts:
+            return []
+        return np.concatenate([
+            self._encode(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)
+        ]).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+def _read_export_info(model_dir: str) -> Dict[str, Any]:
+    path = os.path.join(model_dir, "export.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def export_onnx(model_name: str, model_dir: str = ONNX_MODEL_DIR, quantize: bool = True) -> Dict[str, Any]:
+    """
+    Export a sentence-transformers model to ONNX, and optionally an int8
+    dynamically quantized copy (requires torch, transformers and onnxruntime).
+
+    Args:
+        model_name: Hugging Face model to export
+        model_dir: Output directory
+        quantize: Also write the int8 model
+
+    Returns:
+        Sizes of the exported files in MB
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(model_dir)
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    model_path = os.path.join(model_dir, ONNX_MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+            opset_version=14
+        )
+    # Recent torch versions write the weights next to the graph (model.onnx.data)
+    model_files = [path for path in (model_path, model_path + ".data") if os.path.exists(path)]
+    sizes = {"model_mb": sum(os.path.getsize(path) for path in model_files) / 2**20}
+
+    if quantize:
+        _onnxruntime()
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantized_path = os.path.join(model_dir, ONNX_QUANTIZED_FILE)
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        sizes["quantized_mb"] = os.path.getsize(quantized_path) / 2**20
+
+    with open(os.path.join(model_dir, "export.json"), "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "max_seq_length": MAX_SEQ_LENGTH, **sizes}, f, indent=2)
+    logger.info(f"Exported {model_name} to {model_dir}: {sizes}")
+    return sizes
+
+
+def parity_report(reference: Any, candidate: Any, texts: List[str]) -> Dict[str, float]:
+    """
+    Compare two embedding models on the same texts.
+
+    Returns:
+        Minimum and mean cosine similarity between their embeddings of each
+        text, and how often both rank the same text first among the others
+    """
+    a = np.asarray(reference.embed_documents(texts), dtype=np.float32)
+    b = np.asarray(candidate.embed_documents(texts), dtype=np.float32)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    cosine = (a * b).sum(axis=1)
+
+    # Nearest other text under each model
+    sim_a, sim_b = a @ a.T, b @ b.T
+    np.fill_diagonal(sim_a, -np.inf)
+    np.fill_diagonal(sim_b, -np.inf)
+    return {
+        "texts": len(texts),
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "nearest_neighbour_agreement": float(np.mean(sim_a.argmax(axis=1) == sim_b.argmax(axis=1)))
+    }
+
+
+def encode_latency(model: Any, queries: List[str], repeats: int = 3) -> Dict[str, float]:
+    """Per-query embed_query latency in ms (after one warm-up call)."""
+    model.embed_query(queries[0])
+    latencies = []
+    for _ in range(repeats):
+        for query in queries:
+            started = time.perf_counter()
+            model.embed_query(query)
+            latencies.append((time.perf_counter() - started) * 1000)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(np.mean(latencies))
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Export, check and time the ONNX query encoder")
+    parser.add_argument("--model-name", default="sentence-transformers/all-MiniLM-L6-v2", help="Model to export")
+    parser.add_argument("--model-dir", default=ONNX_MODEL_DIR, help="Directory of the ONNX export")
+    parser.add_argument("--export", action="store_true", help="Export the model (needs torch and transformers)")
+    parser.add_argument("--no-quantize", action="store_true", help="Skip the int8 quantized model")
+    parser.add_argument("--parity", action="store_true", help="Compare the ONNX models with the torch model")
+    parser.add_argument("--benchmark", action="store_true", help="Time per-query encoding of each backend")
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads of onnxruntime and torch (0 for the default)")
+    parser.add_argument("--storage-dir", help="Take sample texts from this chunk store instead of built-in examples")
+    parser.add_argument("--samples", type=int, default=200, help="Number of chunk texts to sample from the store")
+    args = parser.parse_args()
+
+    if args.export:
+        print(json.dumps(export_onnx(args.model_name, args.model_dir, quantize=not args.no_quantize), indent=2))
+
+    texts = list(_SAMPLE_TEXTS)
+    if args.storage_dir:
+        from chunks import LocalChunkStorage
+        storage = LocalChunkStorage(args.storage_dir, embedding_model=None)
+        count = len(storage.index["chunks"])
+        rows = np.random.default_rng(0).choice(count, min(args.samples, count), replace=False)
+        chunk_ids = [storage.index["chunks"][int(row)]["id"] for row in rows]
+        texts += [chunk["text"] for chunk in storage.get_chunks(chunk_ids)]
+
+    if args.parity or args.benchmark:
+        backends = {}
+        for quantized in (False, True):
+            path = os.path.join(args.model_dir, ONNX_QUANTIZED_FILE if quantized else ONNX_MODEL_FILE)
+            if os.path.exists(path):
+                backends["onnx-int8" if quantized else "onnx"] = ONNXEmbeddings(args.model_dir, quantized=quantized, threads=args.threads)
+        try:
+            from langchain_huggingface import HuggingFaceEmbeddings
+            torch_model = HuggingFaceEmbeddings(model_name=args.model_name)
+            if args.threads:
+                import torch
+                torch.set_num_threads(args.threads)
+        except ImportError:
+            torch_model = None
+            logger.warning("torch / langchain_huggingface not installed; skipping the torch comparison")
+
+        results: Dict[str, Any] = {}
+        for name, model in backends.items():
+            entry: Dict[str, Any] = {}
+            if args.parity and torch_model is not None:
+                entry["parity"] = parity_report(torch_model, model, texts)
+            if args.benchmark:
+                entry["latency"] = encode_latency(model, _SAMPLE_TEXTS)
+            results[name] = entry
+        if args.benchmark and torch_model is not None:
+            results["torch"] = {"latency": encode_latency(torch_model, _SAMPLE_TEXTS)}
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,222 @@
+"""
+Module with a local, zero-LLM query router.
+
+The ReAct agent spends an LLM call deciding which tool to use and another one
+formatting the final answer. For most inputs the choice is obvious, so the
+router sends them straight to a tool:
+- "calculator": a bare arithmetic expression, answered with no LLM call by
+                evaluate_arithmetic (never eval)
+- "verse_text": a bare verse reference ("BG 2.47", "what does Gita 2.47 say"),
+                answered from the verse table with no LLM call
+- "verse":      a question about a referenced verse, answered from the verse
+                table (no embedding or vector scan) + QA in one LLM call
+- "explain":    an "Explain more:" follow-up, answered with one LLM call
+- "rag":        a question about the Gita, answered by retrieval + QA in one LLM call
+- "agent":      anything ambiguous (mixes arithmetic with words, or looks like
+                neither a question nor a scripture topic), which keeps the agent
+"""
+import re
+import ast
+import logging
+import operator
+import threading
+from collections import Counter
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# LLM round-trips of each path: the agent needs one call to pick a tool and
+# one to write the final answer, plus whatever the tool itself makes
+AGENT_LLM_CALLS = {"calculator": 2, "explain": 3, "verse_text": 3, "verse": 3, "rag": 3, "agent": 3}
+ROUTE_LLM_CALLS = {"calculator": 0, "explain": 1, "verse_text": 0, "verse": 1, "rag": 1, "agent": 3}
+
+# Limits of the calculator: input length, exponent, and bits of an integer result
+MAX_EXPRESSION_LENGTH = 200
+MAX_EXPONENT = 100
+MAX_RESULT_BITS = 1024
+
+# Number of verses in each of the 18 chapters, to validate references
+GITA_VERSE_COUNTS = [47, 72, 43, 42, 29, 47, 30, 28, 34, 42, 55, 20, 35, 27, 20, 24, 28, 78]
+
+_ARITHMETIC = re.compile(r"^[\d\s.+\-*/%()]+$")
+_HAS_OPERATOR = re.compile(r"\d\s*[+\-*/%]\s*\d")
+_QUESTION_START = re.compile(
+    r"^(what|who|whom|whose|why|how|when|where|which|is|are|does|do|did|can|should|could|would|"
+    r"explain|describe|tell|define|summari[sz]e|list|compare|give|meaning)\b"
+)
+# (pattern, verse first, needs a cue before it)
+_VERSE_REFERENCES = [
+    # "BG 2.47", "Gita 2:47", "verse 2.47" (chapter first); a bare "10.30" is
+    # more often a time, price or percentage than a verse
+    (re.compile(r"(?<![\d.])(\d{1,2})\s*[.:]\s*(\d{1,2})(?![\d.]*\d)"), False, True),
+    # "chapter 2 verse 47", "ch. 2, text 47"
+    (re.compile(r"\b(?:chapter|ch\.?)\s*(\d{1,2})\s*,?\s*(?:verse|text|shloka|sloka|v\.?)\s*(\d{1,2})\b"), False, False),
+    # "verse 47 of chapter 2"
+    (re.compile(r"\b(?:verse|text|shloka|sloka)\s*(\d{1,2})\s*(?:of|in|from)\s*(?:chapter|ch\.?)\s*(\d{1,2})\b"), True, False),
+]
+# Words that make a following "N.M" a chapter/verse reference
+_VERSE_CUE = re.compile(r"\b(?:bg|bhagavad|gita|geeta|chapter|ch|verses?|shlokas?|slokas?)(?![a-z])")
+# Words that may surround a verse reference in a request for just the verse text
+_VERSE_FILLER = {
+    "bg", "bhagavad", "gita", "the", "chapter", "ch", "verse", "text", "shloka", "sloka", "of", "in", "from",
+    "what", "does", "do", "say", "says", "show", "me", "read", "quote", "give", "is", "please"
+}
+_SCRIPTURE_TERMS = {
+    "gita", "bhagavad", "krishna", "arjuna", "kurukshetra", "pandava", "pandavas", "kaurava", "kauravas",
+    "dhritarashtra", "sanjaya", "bhishma", "drona", "karma", "dharma", "yoga", "moksha", "atman", "brahman",
+    "soul", "self", "duty", "devotion", "bhakti", "jnana", "sattva", "rajas", "tamas", "guna", "gunas",
+    "sthitaprajna", "sannyasa", "renunciation", "detachment", "attachment", "meditation", "verse", "verses",
+    "chapter", "chapters", "shloka", "sloka", "lord", "god", "divine", "liberation", "rebirth", "death",
+    "desire", "mind", "wisdom", "action", "actions", "sacrifice", "surrender", "vishvarupa", "avatar"
+}
+
+
+class RouteDecision(NamedTuple):
+    route: str
+    reason: str
+
+    @property
+    def llm_calls_saved(self) -> int:
+        """LLM round-trips saved compared to running the agent."""
+        return AGENT_LLM_CALLS[self.route] - ROUTE_LLM_CALLS[self.route]
+
+
+def find_verse_reference(query: str) -> Optional[Tuple[int, int]]:
+    """
+    Find a chapter/verse reference such as "BG 2.47" or "chapter 2 verse 47".
+    A bare "N.M" only counts after a cue such as "BG", "Gita" or "verse".
+
+    Args:
+        query: The user's query
+
+    Returns:
+        (chapter, verse) of the first valid reference, or None
+    """
+    lowered = query.lower()
+    for pattern, verse_first, needs_cue in _VERSE_REFERENCES:
+        for match in pattern.finditer(lowered):
+            if needs_cue and not _VERSE_CUE.search(lowered, 0, match.start()):
+                continue
+            first, second = int(match.group(1)), int(match.group(2))
+            chapter, verse = (second, first) if verse_first else (first, second)
+            if 1 <= chapter <= len(GITA_VERSE_COUNTS) and 1 <= verse <= GITA_VERSE_COUNTS[chapter - 1]:
+                return chapter, verse
+    return None
+
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+
+def _evaluate(node: ast.AST) -> Union[int, float]:
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_evaluate(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left, right = _evaluate(node.left), _evaluate(node.right)
+        if isinstance(node.op, ast.Pow):
+            # Checked before computing: 9**9**9 would take minutes and gigabytes
+            if abs(right) > MAX_EXPONENT:
+                raise ValueError(f"Exponent {right} is larger than {MAX_EXPONENT}")
+            if isinstance(left, int) and isinstance(right, int) and left.bit_length() * right > MAX_RESULT_BITS:
+                raise ValueError("Result is too large")
+        result = _BINARY_OPERATORS[type(node.op)](left, right)
+        if isinstance(result, complex):
+            raise ValueError("Result is not a real number")
+        if isinstance(result, int) and result.bit_length() > MAX_RESULT_BITS:
+            raise ValueError("Result is too large")
+        return result
+    raise ValueError(f"Unsupported syntax: {type(node).__name__}")
+
+
+def evaluate_arithmetic(expression: str) -> Union[int, float]:
+    """
+    Evaluate an arithmetic expression without eval: numbers, + - * / % **
+    and parentheses only, with bounded length, exponents and result size.
+
+    Args:
+        expression: The expression, e.g. "(12 + 3) * 7"
+
+    Returns:
+        The value of the expression
+
+    Raises:
+        ValueError: If the expression has other syntax or exceeds the limits
+        ZeroDivisionError: On division by zero
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"Expression is longer than {MAX_EXPRESSION_LENGTH} characters")
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Not an arithmetic expression: {e.msg}")
+    return _evaluate(tree.body)
+
+
+def _is_bare_reference(query: str) -> bool:
+    """Whether a query asks for nothing but the referenced verse."""
+    words = re.findall(r"[a-z]+", re.sub(r"\d+\s*[.:]\s*\d+|\d+", " ", query.lower()))
+    return all(word in _VERSE_FILLER for word in words)
+
+
+def route_query(query: str) -> RouteDecision:
+    """
+    Decide how to answer a query without calling an LLM.
+
+    Args:
+        query: The user's query
+
+    Returns:
+        The chosen route and the rule that chose it
+    """
+    text = query.strip()
+    lowered = text.lower()
+
+    if lowered.startswith("explain more:"):
+        return RouteDecision("explain", "explain-more follow-up")
+    if _ARITHMETIC.match(text) and _HAS_OPERATOR.search(text):
+        return RouteDecision("calculator", "bare arithmetic expression")
+    if _HAS_OPERATOR.search(text):
+        return RouteDecision("agent", "arithmetic mixed with words")
+    reference = find_verse_reference(text)
+    if reference is not None:
+        route = "verse_text" if _is_bare_reference(text) else "verse"
+        return RouteDecision(route, f"verse reference {reference[0]}.{reference[1]}")
+
+    words = set(re.findall(r"[a-z]+", lowered))
+    terms = words & _SCRIPTURE_TERMS
+    if terms:
+        return RouteDecision("rag", f"scripture terms: {', '.join(sorted(terms))}")
+    if text.endswith("?") or _QUESTION_START.match(lowered):
+        return RouteDecision("rag", "general question")
+    return RouteDecision("agent", "no rule matched")
+
+
+# Counts of routing decisions and LLM calls saved, for this process
+_stats: Counter = Counter()
+_stats_lock = threading.Lock()
+
+
+def record_decision(query: str, decision: RouteDecision) -> None:
+    """Log a routing decision and add it to the process-wide counters."""
+    with _stats_lock:
+        _stats[f"route_{decision.route}"] += 1
+        _stats["llm_calls_saved"] += decision.llm_calls_saved
+    logger.info(
+        f"Routed query to {decision.route} ({decision.reason}); "
+        f"LLM calls saved: {decision.llm_calls_saved}"
+    )
+
+
+def routing_stats() -> Dict[str, int]:
+    """Routing decision counts and total LLM calls saved."""
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,100 @@
+"""
+Production launcher for the Bhagavad Gita web app.
+
+Runs the Flask app under gunicorn with threaded workers where gunicorn is
+available (Linux/macOS), and under waitress otherwise (Windows). The app is
+created (cheaply) once before workers are started; each worker then loads the
+embedding model and agent in a background warm-up thread, so it accepts
+connections and answers /health right away. With --preload the embedding
+model is loaded once before the workers are forked and shared between them.
+
+Usage:
+    python serve.py --workers 2 --threads 8 --port 5000
+    python serve.py --workers 4 --preload
+    uvicorn asgi:application --workers 2    (ASGI servers; requests still run in threads)
+"""
+import os
+import logging
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def run_server(
+    app: Any,
+    host: str = "0.0.0.0",
+    port: int = 5000,
+    workers: Optional[int] = None,
+    threads: int = 8,
+    timeout: Optional[float] = None,
+    server: str = "auto",
+    post_worker_init: Optional[Callable[[], None]] = None
+) -> None:
+    """
+    Serve the app with a production WSGI server.
+
+    Args:
+        app: The Flask app
+        host: Interface to bind
+        port: Port to bind
+        workers: Worker processes (gunicorn only; defaults to WEB_WORKERS or 2)
+        threads: Threads per worker
+        timeout: Seconds before a stuck worker is restarted (defaults to REQUEST_TIMEOUT + 30)
+        server: "gunicorn", "waitress" or "auto" to pick what is installed
+        post_worker_init: Optional function run in each worker process once it
+            has started (in the serving process itself for waitress)
+    """
+    workers = workers or int(os.getenv("WEB_WORKERS", "2"))
+    timeout = timeout or float(os.getenv("REQUEST_TIMEOUT", "60")) + 30
+
+    if server in ("auto", "gunicorn"):
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            if server == "gunicorn":
+                raise
+            server = "waitress"
+        else:
+            class GunicornApplication(BaseApplication):
+                def load_config(self):
+                    self.cfg.set("bind", f"{host}:{port}")
+                    self.cfg.set("workers", workers)
+                    self.cfg.set("threads", threads)
+                    self.cfg.set("worker_class", "gthread")
+                    self.cfg.set("timeout", int(timeout))
+                    if post_worker_init is not None:
+                        self.cfg.set("post_worker_init", lambda worker: post_worker_init())
+
+                def load(self):
+                    return app
+
+            logger.info(f"Serving with gunicorn on {host}:{port} ({workers} workers x {threads} threads)")
+            GunicornApplication().run()
+            return
+
+    from waitress import serve
+    if post_worker_init is not None:
+        post_worker_init()
+    logger.info(f"Serving with waitress on {host}:{port} ({threads} threads)")
+    serve(app, host=host, port=port, threads=threads, channel_timeout=int(timeout))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the Bhagavad Gita web app with a production server")
+    parser.add_argument("--host", default="0.0.0.0", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "5000")), help="Port to bind")
+    parser.add_argument("--workers", type=int, help="Worker processes (gunicorn only)")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", "8")), help="Threads per worker")
+    parser.add_argument("--timeout", type=float, help="Seconds before a stuck worker is restarted")
+    parser.add_argument("--preload", action="store_true", help="Load the embedding model before forking workers (PRELOAD_MODEL=1)")
+    parser.add_argument("--server", default="auto", choices=["auto", "gunicorn", "waitress"], help="WSGI server to use")
+    args = parser.parse_args()
+
+    from app import PRELOAD_MODEL, WARM_UP, create_app, preload_models, start_warm_up
+    if args.preload or PRELOAD_MODEL:
+        preload_models()
+    run_server(
+        create_app(warm_up=False), args.host, args.port, args.workers, args.threads, args.timeout, args.server,
+        post_worker_init=start_warm_up if WARM_UP else None
+    )
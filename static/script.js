@@ -4,6 +4,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const sendBtn = document.getElementById('send-btn');
     const loading = document.getElementById('loading');
     
+    // Server-side conversation session, set from the first answer
+    let sessionId = null;
+    
     // Download button enhancement
     const downloadButton = document.querySelector('.download-button');
     if (downloadButton) {
@@ -42,7 +45,7 @@ document.addEventListener('DOMContentLoaded', function() {
     window.addEventListener('orientationchange', setViewportHeight);
     
     // Function to add a message to the chat
-    function addMessage(message, isUser = false, references = [], toolsUsed = [], isFallback = false) {
+    function addMessage(message, isUser = false, references = [], toolsUsed = [], isFallback = false, turn = null) {
         // Check if this is first message (after welcome) and remove empty class if it exists
         if (chatBox.classList.contains('empty-chat')) {
             chatBox.classList.remove('empty-chat');
@@ -76,8 +79,10 @@ document.addEventListener('DOMContentLoaded', function() {
             explainBtn.className = 'action-btn explain-more-btn';
             explainBtn.textContent = 'Explain more';
             explainBtn.onclick = function() {
+                // The server explains from this turn's retrieval; the quoted
+                // message is only used if the session has expired
                 const explainQuery = `Explain more: ${message}`;
-                sendQuery(explainQuery);
+                sendQuery(explainQuery, turn);
             };
             buttonContainer.appendChild(explainBtn);
             
@@ -146,8 +151,156 @@ document.addEventListener('DOMContentLoaded', function() {
         }, 100);
     }
     
-    // Function to send query to backend
-    async function sendQuery(query) {
+    // Parse one server-sent event block into {event, data}
+    function parseEvent(block) {
+        let event = 'message';
+        let data = '';
+        block.split('\n').forEach(line => {
+            if (line.startsWith('event: ')) event = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
+        });
+        return { event: event, data: data ? JSON.parse(data) : {} };
+    }
+    
+    // Request body of a query, with the session and the turn it follows up on
+    function queryBody(query, turn) {
+        return JSON.stringify({ query: query, session_id: sessionId, turn: turn });
+    }
+    
+    // Remember the session of an answer and render it
+    function addAnswer(data) {
+        if (data.session_id) sessionId = data.session_id;
+        addMessage(data.response, false, data.references || [], data.tools_used || [], data.is_fallback || false, data.turn || null);
+    }
+    
+    // One line for a retrieved passage: where it is in the Gita and how it starts
+    function formatPassage(passage) {
+        const meta = passage.metadata || {};
+        let where = meta.source || 'Bhagavad Gita';
+        if (meta.verses && meta.verses.length) where = `Bhagavad Gita ${meta.verses.join(', ')}`;
+        else if (meta.page !== undefined) where = `Page ${meta.page}`;
+        return `${where}: ${passage.text}…`;
+    }
+    
+    // Function to send query to backend, rendering the answer as it streams in
+    async function sendQuery(query, turn = null) {
+        loading.style.display = 'block';
+        let streamingContainer = null;
+        let streamingDiv = null;
+        let passagesDiv = null;
+        let passages = [];
+        
+        // The message the answer streams into, created by the first event that shows something
+        function showStreamingMessage() {
+            if (streamingContainer) return;
+            if (chatBox.classList.contains('empty-chat')) {
+                chatBox.classList.remove('empty-chat');
+            }
+            streamingContainer = document.createElement('div');
+            streamingContainer.className = 'message-container';
+            streamingDiv = document.createElement('div');
+            streamingDiv.className = 'bot-message';
+            streamingContainer.appendChild(streamingDiv);
+            chatBox.appendChild(streamingContainer);
+        }
+        
+        try {
+            const response = await fetch('/query/stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: queryBody(query, turn),
+            });
+            
+            // Fall back to the JSON endpoint if streaming isn't available
+            if (!response.ok || !response.body) {
+                if (response.status === 429) {
+                    const data = await response.json();
+                    loading.style.display = 'none';
+                    addMessage('Sorry, I encountered an error: ' + (data.error || 'Unknown error'));
+                    return;
+                }
+                return sendQueryJson(query, turn);
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const { event, data } = parseEvent(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                    
+                    if (event === 'references') {
+                        // Show the retrieved passages while the answer is being written
+                        passages = (data.references || []).map(formatPassage);
+                        if (passages.length > 0) {
+                            showStreamingMessage();
+                            passagesDiv = document.createElement('div');
+                            passagesDiv.className = 'references-container';
+                            passagesDiv.style.display = 'block';
+                            const passagesTitle = document.createElement('h4');
+                            passagesTitle.textContent = 'Retrieved passages:';
+                            passagesDiv.appendChild(passagesTitle);
+                            const passagesList = document.createElement('ul');
+                            passagesList.className = 'references-list';
+                            passages.forEach(passage => {
+                                const passageItem = document.createElement('li');
+                                passageItem.textContent = passage;
+                                passagesList.appendChild(passageItem);
+                            });
+                            passagesDiv.appendChild(passagesList);
+                            streamingContainer.appendChild(passagesDiv);
+                            chatBox.scrollTop = chatBox.scrollHeight;
+                        }
+                    } else if (event === 'token') {
+                        // Show the answer as soon as the first token arrives
+                        loading.style.display = 'none';
+                        showStreamingMessage();
+                        streamingDiv.textContent += data.text;
+                        chatBox.scrollTop = chatBox.scrollHeight;
+                    } else if (event === 'fallback') {
+                        // The passages didn't answer the question: a direct answer replaces the streamed one
+                        if (streamingDiv) streamingDiv.textContent = '';
+                        if (passagesDiv) streamingContainer.removeChild(passagesDiv);
+                        passagesDiv = null;
+                        passages = [];
+                    } else if (event === 'done') {
+                        // Replace the streamed text with the full message and its buttons,
+                        // keeping the retrieved passages if the answer cites no sources
+                        if (streamingContainer) chatBox.removeChild(streamingContainer);
+                        loading.style.display = 'none';
+                        if (!(data.references && data.references.length) && !data.is_fallback) {
+                            data.references = passages;
+                        }
+                        addAnswer(data);
+                        return;
+                    } else if (event === 'error') {
+                        if (streamingContainer) chatBox.removeChild(streamingContainer);
+                        loading.style.display = 'none';
+                        addMessage('Sorry, I encountered an error: ' + (data.error || 'Unknown error'));
+                        return;
+                    }
+                }
+            }
+            loading.style.display = 'none';
+        } catch (error) {
+            if (streamingContainer) chatBox.removeChild(streamingContainer);
+            loading.style.display = 'none';
+            addMessage('Sorry, an error occurred while processing your request.');
+            console.error('Error:', error);
+        }
+    }
+    
+    // Send a query to the non-streaming endpoint and render the whole answer at once
+    async function sendQueryJson(query, turn = null) {
         loading.style.display = 'block';
         
         try {
@@ -156,19 +309,13 @@ document.addEventListener('DOMContentLoaded', function() {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ query: query }),
+                body: queryBody(query, turn),
             });
             
             const data = await response.json();
             loading.style.display = 'none';
               if (response.ok) {
-                // Pass references and tools data if they exist
-                const references = data.references || [];
-                const toolsUsed = data.tools_used || [];
-                const isFallback = data.is_fallback || false;
-                
-                // Handle regular responses and fallback responses separately
-                addMessage(data.response, false, references, toolsUsed, isFallback);
+                addAnswer(data);
             } else {
                 addMessage('Sorry, I encountered an error: ' + (data.error || 'Unknown error'));
             }
@@ -0,0 +1,47 @@
+"""
+Shared fixtures. The modules live at the top of the repository, so it is put
+on the import path; everything runs offline with the fake LLM
+(LLM_BACKEND=fake) and the benchmark's hashing embedder.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """Make get_gemini_llm return a fresh FakeGeminiLLM."""
+    import llm_ai
+    monkeypatch.setenv("LLM_BACKEND", "fake")
+    monkeypatch.setenv("FAKE_LLM_LATENCY", "0")
+    monkeypatch.setattr(llm_ai, "_shared_llm", None)
+    return llm_ai.get_gemini_llm()
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """A small chunk store of the benchmark's synthetic corpus."""
+    from benchmark import HashingEmbeddings, synthetic_corpus
+    from chunks import LocalChunkStorage
+    texts, metadata = zip(*synthetic_corpus(200))
+    store = LocalChunkStorage(str(tmp_path / "store"), HashingEmbeddings())
+    store.add_chunks(list(texts), list(metadata))
+    return store
+
+
+@pytest.fixture
+def app_module(fake_llm, storage, tmp_path, monkeypatch):
+    """The app module with fresh components, serving from the test store."""
+    import app
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "_components", {})
+    app.use_storage(storage)
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.create_app(warm_up=False).test_client()
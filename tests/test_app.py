@@ -0,0 +1,130 @@
+"""End-to-end tests of the QA chain and the /query endpoints with the fake LLM."""
+import json
+
+QUESTION = "What does Krishna teach about duty and action?"
+
+
+def test_qa_chain_answers_from_retrieved_chunks(app_module, storage, fake_llm):
+    docs = app_module.to_documents(app_module.retrieve_chunks(storage, QUESTION))
+    assert docs
+
+    result = app_module.get_qa_chain()({"input_documents": docs, "question": QUESTION})
+
+    assert "duty" in result["output_text"]
+    assert app_module.extract_sources(result["output_text"]) == ["The Bhagavad Gita"]
+    assert fake_llm.calls == 1
+
+
+def test_query_answers_and_caches(client):
+    response = client.post("/query", json={"query": QUESTION})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert "duty" in body["response"]
+    assert body["references"] == ["The Bhagavad Gita"]
+    assert body["route"] == "rag"
+    assert body["session_id"] and body["turn"] == 1
+    assert "Server-Timing" in response.headers
+
+    repeated = client.post("/query", json={"query": QUESTION}).get_json()
+    assert repeated["cached"] is True
+    assert repeated["response"] == body["response"]
+
+
+def test_session_follow_ups_are_not_cached(client, fake_llm):
+    first = client.post("/query", json={"query": QUESTION}).get_json()
+    explain = f"Explain more: {first['response']}"
+
+    follow_up = client.post("/query", json={"query": explain, "session_id": first["session_id"]}).get_json()
+    assert follow_up["route"] == "explain"
+    assert follow_up["tools_used"] == []
+    assert "cached" not in follow_up
+
+    # Another session asking the same text must not get the first session's explanation
+    other = client.post("/query", json={"query": explain}).get_json()
+    assert "cached" not in other
+    repeated = client.post("/query", json={"query": explain, "session_id": first["session_id"]}).get_json()
+    assert "cached" not in repeated
+    assert fake_llm.calls == 4
+
+
+def test_query_arithmetic_uses_the_calculator(client, fake_llm):
+    body = client.post("/query", json={"query": "(12 + 3) * 7"}).get_json()
+
+    assert body["response"] == "105"
+    assert body["route"] == "calculator"
+    assert fake_llm.calls == 0
+
+
+def test_query_runs_the_agent_for_unrouted_input(client, fake_llm):
+    body = client.post("/query", json={"query": "hello there"}).get_json()
+
+    assert "duty" in body["response"]
+    assert [tool["name"] for tool in body["tools_used"]] == ["RAG_QA"]
+    # Tool choice, the QA chain, and the final answer
+    assert fake_llm.calls == 3
+
+
+def test_query_without_a_question_is_rejected(client):
+    assert client.post("/query", json={"query": ""}).status_code == 400
+
+
+def test_stream_sends_references_tokens_and_done(client):
+    response = client.post("/query/stream", json={"query": QUESTION})
+
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block.strip():
+            name, data = block.split("\n", 1)
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    names = [name for name, _ in events]
+    assert names[0] == "references" and names[-1] == "done"
+    assert "token" in names
+    assert events[0][1]["references"]
+    done = events[-1][1]
+    assert done["response"] == "".join(data["text"] for name, data in events if name == "token").split("SOURCES:")[0].strip()
+
+
+def test_search_spans_have_the_same_labels_with_and_without_batching(client):
+    client.post("/query", json={"query": QUESTION})
+    client.post("/query/batch", json={"queries": ["Who is Arjuna?", "What is karma yoga?"]}).get_data()
+
+    lines = [
+        line for line in client.get("/metrics").get_data(as_text=True).splitlines()
+        if line.startswith("gita_stage_seconds_count") and 'stage="vector_search"' in line
+    ]
+    assert any('batch="false"' in line for line in lines)
+    assert any('batch="true"' in line for line in lines)
+    assert all('batch="' in line and 'mode="' in line for line in lines)
+
+
+def test_batch_falls_back_instead_of_caching_unable_answers(client, fake_llm, monkeypatch):
+    def respond(self, messages):
+        if messages[-1].content.startswith("With reference to the Bhagavad Gita"):
+            return "A direct answer about the Gita."
+        return "I am unable to answer this from the passages.\nSOURCES:"
+    monkeypatch.setattr(type(fake_llm), "_respond", respond)
+
+    response = client.post("/query/batch", json={"queries": [QUESTION, "Explain more: duty is action."]})
+    results = sorted((json.loads(line) for line in response.get_data(as_text=True).splitlines()), key=lambda r: r["index"])
+
+    assert all(result["is_fallback"] and result["response"] == "A direct answer about the Gita." for result in results)
+    # The cache holds the fallback, never the unable answer
+    repeated = client.post("/query", json={"query": QUESTION}).get_json()
+    assert repeated["cached"] is True and repeated["is_fallback"] is True
+
+
+def test_batch_explain_answers_do_not_claim_the_qa_tool(client):
+    response = client.post("/query/batch", json={"queries": ["Explain more: duty is action."]})
+    result = json.loads(response.get_data(as_text=True).splitlines()[0])
+
+    assert result["route"] == "explain"
+    assert result["tools_used"] == []
+
+
+def test_batch_rejects_an_invalid_k(client):
+    for k in (0, -1, 1000, "3", 2.5, True):
+        response = client.post("/query/batch", json={"queries": [QUESTION], "k": k})
+        assert response.status_code == 400, k
+
+    assert client.post("/query/batch", json={"queries": [QUESTION], "k": 5}).status_code == 200
@@ -0,0 +1,65 @@
+"""Tests of the chunk store: migration from the version 1 format."""
+import hashlib
+import json
+import os
+
+from benchmark import HashingEmbeddings, synthetic_corpus
+from chunks import LocalChunkStorage, migrate_storage
+
+
+class CountingEmbeddings(HashingEmbeddings):
+    """HashingEmbeddings that counts the texts it embeds."""
+    def __init__(self):
+        super().__init__()
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+def write_v1_store(storage_dir, texts, metadata, embeddings):
+    """A version 1 store: index.json plus one JSON file per chunk, without the model name."""
+    os.makedirs(os.path.join(storage_dir, "chunks"))
+    entries = []
+    for text, meta, vector in zip(texts, metadata, embeddings.embed_documents(texts)):
+        chunk_id = hashlib.md5(text.encode("utf-8")).hexdigest()
+        entries.append({"id": chunk_id, "metadata": meta})
+        with open(os.path.join(storage_dir, "chunks", f"{chunk_id}.json"), "w", encoding="utf-8") as f:
+            json.dump({"id": chunk_id, "text": text, "metadata": meta, "embedding": vector}, f)
+    with open(os.path.join(storage_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({"chunks": entries, "metadata": {"chunk_count": len(entries)}}, f)
+
+
+def test_migrated_store_keeps_its_embeddings_on_sync(tmp_path):
+    texts, metadata = map(list, zip(*synthetic_corpus(20)))
+    storage_dir = str(tmp_path / "store")
+    write_v1_store(storage_dir, texts, metadata, HashingEmbeddings())
+
+    assert migrate_storage(storage_dir, embedding_model=HashingEmbeddings.model_name) == 20
+
+    embeddings = CountingEmbeddings()
+    storage = LocalChunkStorage(storage_dir, embeddings)
+    assert storage.index["metadata"]["embedding_model"] == HashingEmbeddings.model_name
+    stats = storage.sync_chunks(texts + ["A new chunk about Arjuna."], metadata + [{"source": "test"}])
+
+    assert embeddings.embedded == 1
+    assert stats["reused"] == 20 and stats["added"] == 1
+    assert storage.similarity_search(texts[3], k=1)[0]["text"] == texts[3]
+
+
+def test_sync_reorders_reuses_and_embeds_rows_in_target_order(tmp_path):
+    texts, metadata = map(list, zip(*synthetic_corpus(300)))
+    embeddings = CountingEmbeddings()
+    storage = LocalChunkStorage(str(tmp_path / "store"), embeddings)
+    storage.sync_chunks(texts[:200], metadata[:200], batch_size=16)
+
+    target = texts[250:] + texts[100:150] + texts[200:250] + texts[:20]
+    embeddings.embedded = 0
+    stats = storage.sync_chunks(target, metadata[:len(target)], batch_size=16)
+
+    assert embeddings.embedded == 100
+    assert (stats["added"], stats["reused"], stats["removed"]) == (100, 70, 130)
+    assert stats["chunks_per_sec"] > 0
+    for row, text in enumerate(target):
+        assert storage.similarity_search(text, k=1)[0]["row"] == row
@@ -0,0 +1,26 @@
+"""Tests of the context assembly: duplicate removal and budget cuts keep the text's layout."""
+from context_builder import fit_budget, remove_duplicate_spans
+
+VERSE = (
+    "You have a right to perform your prescribed duty,\n"
+    "but you are not entitled to the fruits of action.\n"
+    "Never consider yourself the cause of the results of your activities."
+)
+
+
+def test_duplicate_removal_keeps_line_breaks():
+    best = {"id": "a", "text": "Arjuna listened closely to every word. Then he spoke."}
+    repeated = {"id": "b", "text": "Arjuna listened closely to every word.\n" + VERSE}
+
+    result = remove_duplicate_spans([best, repeated])
+
+    assert result[0] is best
+    assert result[1]["text"] == VERSE
+
+
+def test_budget_cut_keeps_line_breaks():
+    chunk = {"id": "a", "text": VERSE}
+
+    cut = fit_budget([chunk], max_tokens=30)[0]["text"]
+
+    assert cut == VERSE.rsplit("\n", 1)[0]
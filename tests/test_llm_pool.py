@@ -0,0 +1,110 @@
+"""Tests of GeminiClientPool: key rotation, cooldown and the per-key concurrency limit."""
+import time
+
+import pytest
+
+from llm_ai import GeminiClientPool, UpstreamBusyError
+
+
+class FakeClient:
+    """Stands in for a ChatGoogleGenerativeAI client; raises error while it is set."""
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        self.calls = 0
+
+    def answer(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return self.name
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make(keys=2, **options):
+        options.setdefault("health_check_interval", 3600)
+        pool = GeminiClientPool([f"key-{i}" for i in range(keys)], ["gemini-test"], **options)
+        for client in pool.clients:
+            client["llm"] = FakeClient(client["name"])
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def call(pool):
+    return pool.call(lambda llm: llm.answer())
+
+
+def test_calls_go_to_the_first_key(make_pool):
+    pool = make_pool()
+    assert call(pool) == "gemini-test (key 1)"
+    assert call(pool) == "gemini-test (key 1)"
+    assert [client["requests"] for client in pool.stats()] == [2, 0]
+
+
+def test_quota_error_rotates_to_the_next_key(make_pool):
+    pool = make_pool()
+    first = pool.clients[0]["llm"]
+    first.error = RuntimeError("429 Resource exhausted: quota exceeded")
+
+    assert call(pool) == "gemini-test (key 2)"
+    stats = pool.stats()
+    assert stats[0]["failures"] == 1
+    assert stats[0]["cooldown_remaining"] > 0
+
+    # The failed key is on cooldown, so the next call goes straight to key 2
+    assert call(pool) == "gemini-test (key 2)"
+    assert first.calls == 1
+
+
+def test_key_returns_after_its_cooldown(make_pool):
+    pool = make_pool(quota_cooldown=0.05)
+    first = pool.clients[0]["llm"]
+    first.error = RuntimeError("403 API key not valid")
+    assert call(pool) == "gemini-test (key 2)"
+
+    first.error = None
+    time.sleep(0.1)
+    assert call(pool) == "gemini-test (key 1)"
+
+
+def test_other_errors_are_raised_without_rotating(make_pool):
+    pool = make_pool()
+    pool.clients[0]["llm"].error = ValueError("invalid argument: empty prompt")
+
+    with pytest.raises(ValueError):
+        call(pool)
+    assert pool.clients[1]["llm"].calls == 0
+    assert pool.stats()[0]["failures"] == 0
+
+
+def test_last_error_is_raised_when_every_key_fails(make_pool):
+    pool = make_pool()
+    for client in pool.clients:
+        client["llm"].error = RuntimeError(f"429 quota of {client['name']}")
+
+    with pytest.raises(RuntimeError, match="key 2"):
+        call(pool)
+    assert [client["failures"] for client in pool.stats()] == [1, 1]
+
+
+def test_busy_keys_raise_upstream_busy_error(make_pool):
+    pool = make_pool(max_concurrency_per_key=1, queue_timeout=0.05)
+    held = [pool._reserve([]), pool._reserve([])]
+    assert {client["key_index"] for client in held} == {0, 1}
+    try:
+        started = time.monotonic()
+        with pytest.raises(UpstreamBusyError):
+            call(pool)
+        assert time.monotonic() - started < 1
+    finally:
+        for client in held:
+            pool._release(client)
+
+    assert call(pool) == "gemini-test (key 1)"